@@ -0,0 +1,79 @@
+# Copyright: Krzysztof Kowalczyk
+# Owner: Andrzej Ciarkowski
+#
+# Purpose:
+#  Split converted articles into sections, so that we can send a part of a
+#  long article (see Article-Range and Article-Section in iPediaFields.py).
+#
+#  Sections start with wiki headings (lines like "== History =="), which
+#  conversion leaves in the text. Section 0 is the text before the first
+#  heading (it might be empty). The converter finds sections of each article
+#  and stores them in sections column of articles table, so that the server
+#  can read only the part of the body it sends.
+
+import re, string
+
+headingRe = re.compile(r"^(={1,6})([^=\n].*?)\1[ \t]*$", re.M)
+
+# return a list of tuples (offset, level, title) for each heading in the
+# body. offset is where the heading line starts, level is the number of '='
+def findSections(body):
+    sections = []
+    for match in headingRe.finditer(body):
+        sections.append((match.start(), len(match.group(1)), match.group(2).strip()))
+    return sections
+
+# return the text for sections column of articles table, one line per heading
+def formatSections(sections):
+    return string.join(["%d %d %s" % section for section in sections], "\n")
+
+# parse the text from sections column of articles table. Return the same
+# thing as findSections()
+def parseSections(sectionsTxt):
+    sections = []
+    if 0 == len(sectionsTxt):
+        return sections
+    for line in sectionsTxt.split("\n"):
+        (offset, level, title) = line.split(" ", 2)
+        sections.append((int(offset), int(level), title))
+    return sections
+
+# return the number of sections of an article, including section 0
+def getSectionsCount(sections):
+    return len(sections) + 1
+
+# return a tuple (start, end) with offsets of a given section in the body
+# of bodyLen bytes. Section 0 is the text before the first heading
+def getSectionRange(sections, sectionNo, bodyLen):
+    assert sectionNo >= 0 and sectionNo < getSectionsCount(sections)
+    if 0 == sectionNo:
+        start = 0
+    else:
+        start = sections[sectionNo-1][0]
+    if sectionNo == len(sections):
+        end = bodyLen
+    else:
+        end = sections[sectionNo][0]
+    return (start, end)
+
+# given the first bytes of the body, return them cut after the last complete
+# line, so that we don't send half of a line (and half of a link). If there's
+# no complete line, return it as it is
+def cutAtLineEnd(prefix):
+    pos = prefix.rfind("\n")
+    if -1 == pos:
+        return prefix
+    return prefix[:pos+1]
+
+# return the table of contents sent to the client: a line for each section
+# (including section 0) with its level, size in bytes and title
+def buildToc(sections, bodyLen):
+    lines = []
+    for sectionNo in range(getSectionsCount(sections)):
+        (start, end) = getSectionRange(sections, sectionNo, bodyLen)
+        if 0 == sectionNo:
+            (level, title) = (0, "")
+        else:
+            (offset, level, title) = sections[sectionNo-1]
+        lines.append("%d %d %s" % (level, end - start, title))
+    return string.join(lines, "\n")
@@ -0,0 +1,167 @@
+# Copyright: Krzysztof Kowalczyk
+# Owner: Andrzej Ciarkowski
+#
+# Purpose:
+#  Write-behind logging to MySQL tables. Request handlers only put log
+#  records in a queue and a background thread inserts them into the
+#  database in batches, using multi-row INSERT statements. That way logging
+#  doesn't add a database write to the time it takes to answer a client.
+
+import threading, Queue, time
+
+# we flush when we have that many records waiting...
+FLUSH_RECORDS_COUNT = 200
+# ...or when the oldest waiting record is that old (in seconds)
+FLUSH_INTERVAL = 5.0
+
+# max number of records waiting in the queue
+MAX_QUEUED_RECORDS = 10000
+
+# what to do when the queue is full:
+# OVERFLOW_DROP - drop the record (and count it in droppedCount)
+# OVERFLOW_BLOCK - wait until the writer thread makes space in the queue
+(OVERFLOW_DROP, OVERFLOW_BLOCK) = range(2)
+
+# special queue items used to control the writer thread
+_FLUSH_MARK = "flush"
+_STOP_MARK = "stop"
+
+# return current time as text in the format understood by MySQL. We record
+# the time when a record is logged, not when it's written to the database
+def getLogDate():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+class BatchedLogWriter:
+
+    # connectionPool is a ConnectionPool we use to get connection to dbName
+    # logErrorProc is a function called with a text describing an error
+    def __init__(self, connectionPool, dbName, logErrorProc, overflowPolicy=OVERFLOW_DROP, maxQueued=MAX_QUEUED_RECORDS):
+        self.connectionPool = connectionPool
+        self.dbName = dbName
+        self.logErrorProc = logErrorProc
+        self.overflowPolicy = overflowPolicy
+        self.queue = Queue.Queue(maxQueued)
+        self.thread = None
+        self.writtenCount = 0
+        self.droppedCount = 0
+        self.failedCount = 0
+        self.batchesCount = 0
+
+    def start(self):
+        assert None == self.thread
+        self.thread = threading.Thread(target=self._writerThread)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    # log a record to a given table. columns is a tuple of names of columns
+    # and values is a tuple of values for those columns (None, numbers or strings)
+    def log(self, tableName, columns, values):
+        assert len(columns) == len(values)
+        record = (tableName, columns, values)
+        if OVERFLOW_BLOCK == self.overflowPolicy:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.droppedCount += 1
+
+    # write all records logged so far to the database. Blocks until it's done
+    def flush(self):
+        if None == self.thread:
+            return
+        doneEvent = threading.Event()
+        self.queue.put((_FLUSH_MARK, doneEvent))
+        doneEvent.wait()
+
+    # write all records logged so far and stop the writer thread. Must be
+    # called when the server shuts down or we'll loose records
+    def close(self):
+        if None == self.thread:
+            return
+        self.queue.put((_STOP_MARK, None))
+        self.thread.join()
+        self.thread = None
+
+    def _writerThread(self):
+        records = []
+        firstRecordTime = None
+        while True:
+            timeout = FLUSH_INTERVAL
+            if None != firstRecordTime:
+                timeout = max(0.0, firstRecordTime + FLUSH_INTERVAL - time.time())
+            try:
+                item = self.queue.get(True, timeout)
+            except Queue.Empty:
+                item = None
+
+            if None != item and 2 == len(item):
+                # this is _FLUSH_MARK or _STOP_MARK
+                (mark, doneEvent) = item
+                self._writeRecords(records)
+                records = []
+                firstRecordTime = None
+                if _STOP_MARK == mark:
+                    return
+                doneEvent.set()
+                continue
+
+            if None != item:
+                records.append(item)
+                if None == firstRecordTime:
+                    firstRecordTime = time.time()
+
+            if len(records) >= FLUSH_RECORDS_COUNT or (None != firstRecordTime and time.time() - firstRecordTime >= FLUSH_INTERVAL):
+                self._writeRecords(records)
+                records = []
+                firstRecordTime = None
+
+    def _formatValue(self, db, value):
+        if None == value:
+            return "NULL"
+        if isinstance(value, int) or isinstance(value, long):
+            return "%d" % value
+        return "'%s'" % db.escape_string(value)
+
+    def _writeRecords(self, records):
+        if 0 == len(records):
+            return
+        # group records going to the same table and columns, so that each
+        # group can be written with one INSERT
+        groups = {}
+        groupsOrder = []
+        for (tableName, columns, values) in records:
+            key = (tableName, columns)
+            if not groups.has_key(key):
+                groups[key] = []
+                groupsOrder.append(key)
+            groups[key].append(values)
+
+        db = None
+        cursor = None
+        try:
+            db = self.connectionPool.getConnection(self.dbName)
+            cursor = db.cursor()
+            for key in groupsOrder:
+                (tableName, columns) = key
+                rows = []
+                for values in groups[key]:
+                    rows.append("(%s)" % ",".join([self._formatValue(db, v) for v in values]))
+                sql = "INSERT INTO %s (%s) VALUES %s;" % (tableName, ",".join(columns), ",".join(rows))
+                cursor.execute(sql)
+                self.writtenCount += len(rows)
+                self.batchesCount += 1
+            cursor.close()
+            self.connectionPool.releaseConnection(self.dbName, db)
+        except Exception, ex:
+            self.failedCount += len(records)
+            if cursor:
+                cursor.close()
+            if db:
+                self.connectionPool.discardConnection(self.dbName, db)
+            self.logErrorProc("failed to write %d log records: %s\n" % (len(records), str(ex)))
+
+    # return a one-line description of the writer state, suitable for
+    # displaying in the telnet interface
+    def getStatsLine(self):
+        return "queued %d, written %d in %d batches, dropped %d, failed %d" % (self.queue.qsize(), self.writtenCount, self.batchesCount, self.droppedCount, self.failedCount)
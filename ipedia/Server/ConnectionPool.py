@@ -0,0 +1,186 @@
+# Copyright: Krzysztof Kowalczyk
+# Owner: Andrzej Ciarkowski
+#
+# Purpose:
+#  Bounded, thread-safe pool of MySQL connections shared by server worker
+#  threads. Connections are kept per database name, so that we can share
+#  one pool between management database and all article databases.
+#
+#  Opening a connection to MySQL (connect + authentication) costs more than
+#  the primary-key lookups we do for a typical request, so instead of
+#  opening a new connection for every request we keep idle connections
+#  around and hand them out again.
+
+import threading, time
+
+# how many connections (idle + checked out) we allow per database
+DEFAULT_MAX_CONNECTIONS = 50
+
+# connections that have been idle for less than that (in seconds) are
+# handed out without a health check. Saves one round-trip for busy server
+HEALTH_CHECK_IDLE_TIME = 5.0
+
+class PoolStats:
+    def __init__(self):
+        # number of new connections we had to open
+        self.created = 0
+        # number of times we handed out an existing connection
+        self.reused = 0
+        # number of idle connections that failed health check (e.g. because
+        # MySQL has been restarted) and had to be re-opened
+        self.reconnects = 0
+        # number of connections closed because the code using them
+        # reported an error
+        self.discarded = 0
+        # number of times a thread had to wait for a connection because the
+        # limit has been reached
+        self.waits = 0
+
+class _DbPool:
+    def __init__(self):
+        # list of (connection, time it was returned to the pool)
+        self.idle = []
+        self.inUseCount = 0
+        self.stats = PoolStats()
+
+class ConnectionPool:
+
+    # connectProc is a function that given database name returns a new connection
+    def __init__(self, connectProc, maxConnections=DEFAULT_MAX_CONNECTIONS):
+        self.connectProc = connectProc
+        self.maxConnections = maxConnections
+        self.lock = threading.Condition()
+        # database name => _DbPool
+        self.pools = {}
+
+    def _getDbPool(self, dbName):
+        if not self.pools.has_key(dbName):
+            self.pools[dbName] = _DbPool()
+        return self.pools[dbName]
+
+    # return True if connection is still usable
+    def _fConnectionAlive(self, conn):
+        try:
+            conn.ping()
+        except Exception:
+            return False
+        return True
+
+    def _closeConnection(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            # we don't care, we're getting rid of it anyway
+            pass
+
+    # return a connection to a database dbName. Blocks if there are already
+    # maxConnections connections to this database in use.
+    # Must be followed by releaseConnection() or discardConnection()
+    def getConnection(self, dbName):
+        self.lock.acquire()
+        try:
+            dbPool = self._getDbPool(dbName)
+            while 0 == len(dbPool.idle) and dbPool.inUseCount >= self.maxConnections:
+                dbPool.stats.waits += 1
+                self.lock.wait()
+            # we reserve the slot before releasing the lock, so that we don't
+            # go over the limit while we connect or ping
+            dbPool.inUseCount += 1
+            conn = None
+            lastUsed = None
+            if len(dbPool.idle) > 0:
+                (conn, lastUsed) = dbPool.idle.pop()
+        finally:
+            self.lock.release()
+
+        # talking to MySQL is done without the lock held
+        try:
+            if None != conn:
+                if time.time() - lastUsed < HEALTH_CHECK_IDLE_TIME or self._fConnectionAlive(conn):
+                    self._updateStats(dbName, "reused")
+                    return conn
+                self._closeConnection(conn)
+                self._updateStats(dbName, "reconnects")
+            conn = self.connectProc(dbName)
+            self._updateStats(dbName, "created")
+            return conn
+        except:
+            self._freeSlot(dbName)
+            raise
+
+    def _updateStats(self, dbName, statName):
+        self.lock.acquire()
+        try:
+            stats = self._getDbPool(dbName).stats
+            setattr(stats, statName, getattr(stats, statName) + 1)
+        finally:
+            self.lock.release()
+
+    def _freeSlot(self, dbName):
+        self.lock.acquire()
+        try:
+            self._getDbPool(dbName).inUseCount -= 1
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    # return a connection obtained with getConnection() to the pool
+    def releaseConnection(self, dbName, conn):
+        self.lock.acquire()
+        try:
+            dbPool = self._getDbPool(dbName)
+            dbPool.inUseCount -= 1
+            dbPool.idle.append((conn, time.time()))
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    # close a connection obtained with getConnection() instead of returning it
+    # to the pool. Use it if there was an error talking to the database
+    # since the connection might be in a bad state
+    def discardConnection(self, dbName, conn):
+        self._closeConnection(conn)
+        self._updateStats(dbName, "discarded")
+        self._freeSlot(dbName)
+
+    # close all idle connections to a given database. Used when we stop
+    # using a database (e.g. switch to a newer one)
+    def closeIdleConnections(self, dbName):
+        self.lock.acquire()
+        try:
+            if not self.pools.has_key(dbName):
+                return
+            dbPool = self.pools[dbName]
+            idle = dbPool.idle
+            dbPool.idle = []
+        finally:
+            self.lock.release()
+        for (conn, lastUsed) in idle:
+            self._closeConnection(conn)
+
+    # close idle connections to all databases. Must be called before fork(),
+    # since a connection can't be shared between processes
+    def closeAllIdleConnections(self):
+        self.lock.acquire()
+        try:
+            dbNames = self.pools.keys()
+        finally:
+            self.lock.release()
+        for dbName in dbNames:
+            self.closeIdleConnections(dbName)
+
+    # return a list of lines describing the state of the pool, suitable
+    # for displaying in the telnet interface
+    def getStatsLines(self):
+        lines = []
+        self.lock.acquire()
+        try:
+            dbNames = self.pools.keys()
+            dbNames.sort()
+            for dbName in dbNames:
+                dbPool = self.pools[dbName]
+                s = dbPool.stats
+                lines.append("%s: in use %d, idle %d, created %d, reused %d, reconnects %d, discarded %d, waits %d" % (dbName, dbPool.inUseCount, len(dbPool.idle), s.created, s.reused, s.reconnects, s.discarded, s.waits))
+        finally:
+            self.lock.release()
+        return lines
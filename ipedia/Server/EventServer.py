@@ -0,0 +1,463 @@
+# Copyright: Krzysztof Kowalczyk
+# Owner: Andrzej Ciarkowski
+#
+# Purpose:
+#  Event-loop network front end for LineReceiver protocols. It's a
+#  replacement for runServer() from ThreadedServer.py.
+#
+#  ThreadedServer dedicates a thread to each connection for the whole time
+#  the client is sending its request and reading the response. Slow clients
+#  (e.g. Palms over GPRS) keep those threads busy while they do nothing, and
+#  when all threads are taken, other clients have to wait.
+#
+#  Here one thread (the one calling runEventServer()) does all reading and
+#  writing with non-blocking sockets. Only when a whole request has been
+#  received is the connection handed to one of the worker threads. The
+#  worker calls lineReceived() for each line of the request, just like
+#  ThreadedServer does, and the response is buffered in memory. Then the
+#  network thread sends it back to the client. An idle or slow connection
+#  costs only memory, and worker threads only ever wait for the database.
+#
+#  If the protocol calls keepAlive() on the transport after answering, the
+#  connection goes back to reading the next request once the response has
+#  been sent. A client can also send many requests without waiting for the
+#  responses: they're all processed by one worker in the order they came.
+
+import socket, select, errno, time, threading, Queue
+from ThreadedServer import PeerInfo, MAX_WORKER_THREADS_COUNT, KEEP_ALIVE_TIMEOUT, setNoDelay
+
+# connections that don't send or receive anything for that long (in seconds)
+# are closed. Connections kept alive waiting for the next request are closed
+# after KEEP_ALIVE_TIMEOUT
+REQUEST_TIMEOUT = 120.0
+
+# requests bigger than that are not accepted (we close the connection)
+MAX_REQUEST_SIZE = 64*1024
+
+# how much data we try to read from a socket at once
+RECV_SIZE = 4096
+
+# how long (in seconds) we wait for network events before we check timeouts
+POLL_TIMEOUT = 1.0
+
+# state of a connection
+(STATE_READING, STATE_PROCESSING, STATE_WRITING) = range(3)
+
+class EventServerStats:
+    def __init__(self):
+        self.accepted = 0
+        self.requests = 0
+        self.timeouts = 0
+        self.idleTimeouts = 0
+        self.keptAlive = 0
+        self.tooBig = 0
+
+g_stats = EventServerStats()
+# fd => _Connection for all open connections
+g_connections = {}
+
+# return a one-line description of the server state, suitable for
+# displaying in the telnet interface
+def getStatsLine():
+    global g_stats, g_connections
+    counts = [0, 0, 0]
+    for conn in g_connections.values():
+        counts[conn.state] += 1
+    return "connections %d (reading %d, processing %d, writing %d), accepted %d, requests %d, kept alive %d, timeouts %d, idle timeouts %d, too big %d" % (len(g_connections), counts[STATE_READING], counts[STATE_PROCESSING], counts[STATE_WRITING], g_stats.accepted, g_stats.requests, g_stats.keptAlive, g_stats.timeouts, g_stats.idleTimeouts, g_stats.tooBig)
+
+# transport given to protocol objects. Keeps the response in memory until
+# the network thread sends it
+class BufferedTransport:
+
+    def __init__(self, address, receiver):
+        self.peer = PeerInfo(address)
+        self.receiver = receiver
+        self.closed = False
+        # True if the protocol wants more requests over this connection
+        self.fKeepAlive = False
+        self.buffers = []
+
+    def write(self, data):
+        if self.closed:
+            return
+        self.buffers.append(data)
+
+    def getPeer(self):
+        return self.peer
+
+    # called by the protocol after it answered a request if it wants to get
+    # more requests over this connection
+    def keepAlive(self):
+        self.fKeepAlive = True
+
+    # the connection is closed after the response has been sent
+    def loseConnection(self):
+        self.closed = True
+
+    # return everything written so far and forget it
+    def takeOutput(self):
+        output = "".join(self.buffers)
+        self.buffers = []
+        return output
+
+class _Connection:
+
+    def __init__(self, sock, address, plug):
+        self.socket = sock
+        self.fd = sock.fileno()
+        self.plug = plug
+        self.transport = BufferedTransport(address, plug)
+        plug.transport = self.transport
+        self.state = STATE_READING
+        self.lastActivity = time.time()
+        # a request ends with an empty line i.e. two delimiters in a row
+        self.requestEnd = plug.delimiter + plug.delimiter
+        self.fEof = False
+        # part of the next request that came with the previous one and
+        # wasn't processed
+        self.leftover = ""
+        self.resetRequest()
+        # response being sent and how much of it has been sent
+        self.output = ""
+        self.outputPos = 0
+
+    # start receiving a new request, beginning with the leftover
+    def resetRequest(self):
+        # what we received so far
+        self.chunks = []
+        self.receivedLen = 0
+        # we only look for the end of the request in new data plus the end of
+        # the old data. Starting with a delimiter means that an empty first
+        # line also ends the request. Leftover never has a delimiter
+        self.tail = self.plug.delimiter
+        if len(self.leftover) > 0:
+            self.addData(self.leftover)
+            self.leftover = ""
+
+    # add received data. Return True if we have the whole request
+    def addData(self, data):
+        self.chunks.append(data)
+        self.receivedLen += len(data)
+        tailAndData = self.tail + data
+        if -1 != tailAndData.find(self.requestEnd):
+            return True
+        self.tail = tailAndData[-(len(self.requestEnd)-1):]
+        return False
+
+    def takeRequestData(self):
+        data = "".join(self.chunks)
+        self.chunks = []
+        return data
+
+# a wrapper around the best way of waiting for socket events available:
+# epoll, poll or select
+class _Poller:
+
+    def __init__(self):
+        # fd => (fRead, fWrite)
+        self.fds = {}
+        self.impl = None
+        if hasattr(select, "epoll"):
+            self.impl = select.epoll()
+            self.timeoutScale = 1.0
+            (self.IN, self.OUT, self.ERR) = (select.EPOLLIN, select.EPOLLOUT, select.EPOLLERR | select.EPOLLHUP)
+        elif hasattr(select, "poll"):
+            self.impl = select.poll()
+            # poll() takes timeout in milliseconds
+            self.timeoutScale = 1000.0
+            (self.IN, self.OUT, self.ERR) = (select.POLLIN, select.POLLOUT, select.POLLERR | select.POLLHUP | select.POLLNVAL)
+
+    def _getMask(self, fRead, fWrite):
+        mask = 0
+        if fRead:
+            mask |= self.IN
+        if fWrite:
+            mask |= self.OUT
+        return mask
+
+    # start or change watching a socket for being readable and/or writable
+    def register(self, fd, fRead, fWrite):
+        if None != self.impl:
+            mask = self._getMask(fRead, fWrite)
+            if self.fds.has_key(fd) and hasattr(self.impl, "modify"):
+                self.impl.modify(fd, mask)
+            else:
+                self.impl.register(fd, mask)
+        self.fds[fd] = (fRead, fWrite)
+
+    def unregister(self, fd):
+        if not self.fds.has_key(fd):
+            return
+        del self.fds[fd]
+        if None != self.impl:
+            self.impl.unregister(fd)
+
+    # wait for events. Return a list of tuples (fd, fReadable, fWritable).
+    # Errors are reported as readable so that we find out about them from recv()
+    def poll(self, timeout):
+        if None == self.impl:
+            readFds = [fd for (fd, (fRead, fWrite)) in self.fds.items() if fRead]
+            writeFds = [fd for (fd, (fRead, fWrite)) in self.fds.items() if fWrite]
+            (readable, writable, errors) = select.select(readFds, writeFds, [], timeout)
+            events = {}
+            for fd in readable:
+                events[fd] = (fd, True, False)
+            for fd in writable:
+                if events.has_key(fd):
+                    events[fd] = (fd, True, True)
+                else:
+                    events[fd] = (fd, False, True)
+            return events.values()
+        result = []
+        for (fd, mask) in self.impl.poll(timeout * self.timeoutScale):
+            fReadable = 0 != (mask & (self.IN | self.ERR))
+            fWritable = 0 != (mask & self.OUT)
+            result.append((fd, fReadable, fWritable))
+        return result
+
+# a pair of connected sockets. Worker threads write a byte to one of them
+# to wake up the network thread waiting in poll(). We use sockets and not
+# a pipe so that it works everywhere select() does
+def _createWakeupSockets():
+    listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listenSocket.bind(('127.0.0.1', 0))
+    listenSocket.listen(1)
+    writeSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    writeSocket.connect(listenSocket.getsockname())
+    (readSocket, addr) = listenSocket.accept()
+    listenSocket.close()
+    readSocket.setblocking(0)
+    return (readSocket, writeSocket)
+
+class _EventServer:
+
+    def __init__(self, serverSocket, plugClass, workersCount):
+        self.plugClass = plugClass
+        self.poller = _Poller()
+        # requests waiting for a worker thread
+        self.requestsQueue = Queue.Queue(0)
+        # connections whose requests have been processed by worker threads
+        self.doneQueue = Queue.Queue(0)
+        (self.wakeupReadSocket, self.wakeupWriteSocket) = _createWakeupSockets()
+        self.wakeupLock = threading.Lock()
+        self.poller.register(self.wakeupReadSocket.fileno(), True, False)
+
+        self.serverSocket = serverSocket
+        self.serverSocket.setblocking(0)
+        self.poller.register(self.serverSocket.fileno(), True, False)
+
+        for i in range(workersCount):
+            thread = threading.Thread(target=self._workerThread)
+            thread.setDaemon(True)
+            thread.start()
+
+    def _workerThread(self):
+        while True:
+            (conn, data) = self.requestsQueue.get()
+            try:
+                conn.leftover = conn.plug.processData(data, conn.fEof)
+            except Exception, ex:
+                conn.plug.logException(ex)
+                conn.transport.loseConnection()
+            # protocols like iPediaProtocol close the connection after
+            # answering unless they want more requests. If neither happened,
+            # there's nothing else we can do with this connection
+            if conn.fEof or not conn.transport.fKeepAlive:
+                conn.transport.loseConnection()
+            self.doneQueue.put(conn)
+            self.wakeupLock.acquire()
+            try:
+                self.wakeupWriteSocket.send("x")
+            finally:
+                self.wakeupLock.release()
+
+    def _closeConnection(self, conn):
+        global g_connections
+        self.poller.unregister(conn.fd)
+        if g_connections.has_key(conn.fd):
+            del g_connections[conn.fd]
+        try:
+            conn.socket.close()
+        except socket.error:
+            pass
+
+    def _acceptConnections(self):
+        global g_connections, g_stats
+        while True:
+            try:
+                (sock, address) = self.serverSocket.accept()
+            except socket.error, ex:
+                if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                # e.g. out of file descriptors. We'll try again later
+                print "accept() failed: %s" % str(ex)
+                return
+            sock.setblocking(0)
+            setNoDelay(sock)
+            conn = _Connection(sock, address, self.plugClass())
+            g_connections[conn.fd] = conn
+            g_stats.accepted += 1
+            self.poller.register(conn.fd, True, False)
+
+    def _startProcessing(self, conn):
+        global g_stats
+        conn.state = STATE_PROCESSING
+        # we don't read more until the response has been sent. We don't want
+        # to hear about errors either, the connection must stay open until
+        # the worker thread is done with it
+        self.poller.unregister(conn.fd)
+        g_stats.requests += 1
+        self.requestsQueue.put((conn, conn.takeRequestData()))
+
+    def _readFromConnection(self, conn):
+        global g_stats
+        try:
+            data = conn.socket.recv(RECV_SIZE)
+        except socket.error, ex:
+            if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._closeConnection(conn)
+            return
+        conn.lastActivity = time.time()
+        if not data:
+            # client won't send more. Whatever it sent is the whole request
+            conn.fEof = True
+            if 0 == conn.receivedLen:
+                self._closeConnection(conn)
+            else:
+                self._startProcessing(conn)
+            return
+        if conn.addData(data):
+            self._startProcessing(conn)
+        elif conn.receivedLen > MAX_REQUEST_SIZE:
+            g_stats.tooBig += 1
+            self._closeConnection(conn)
+
+    def _writeToConnection(self, conn):
+        try:
+            # buffer() doesn't copy what's left of a big response every time
+            # a slow client only takes a part of it
+            sent = conn.socket.send(buffer(conn.output, conn.outputPos))
+        except socket.error, ex:
+            if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._closeConnection(conn)
+            return
+        conn.lastActivity = time.time()
+        conn.outputPos += sent
+        if conn.outputPos == len(conn.output):
+            if conn.transport.closed:
+                self._closeConnection(conn)
+            else:
+                self._waitForNextRequest(conn)
+
+    # response to a request on a connection kept alive has been sent
+    def _waitForNextRequest(self, conn):
+        global g_stats
+        g_stats.keptAlive += 1
+        conn.output = ""
+        conn.outputPos = 0
+        conn.state = STATE_READING
+        conn.lastActivity = time.time()
+        conn.resetRequest()
+        self.poller.register(conn.fd, True, False)
+
+    # pick up connections processed by worker threads
+    def _finishProcessing(self):
+        try:
+            while self.wakeupReadSocket.recv(RECV_SIZE):
+                pass
+        except socket.error:
+            pass
+        while True:
+            try:
+                conn = self.doneQueue.get_nowait()
+            except Queue.Empty:
+                return
+            conn.output = conn.transport.takeOutput()
+            conn.outputPos = 0
+            conn.lastActivity = time.time()
+            if 0 == len(conn.output):
+                if conn.transport.closed:
+                    self._closeConnection(conn)
+                else:
+                    self._waitForNextRequest(conn)
+                continue
+            conn.state = STATE_WRITING
+            self.poller.register(conn.fd, False, True)
+            # most responses fit in socket buffer, so try right away
+            self._writeToConnection(conn)
+
+    def _closeTimedOut(self):
+        global g_connections, g_stats
+        now = time.time()
+        for conn in g_connections.values():
+            if STATE_PROCESSING == conn.state:
+                continue
+            if STATE_READING == conn.state and 0 == conn.receivedLen and conn.transport.fKeepAlive:
+                # waiting for the next request
+                if now - conn.lastActivity > KEEP_ALIVE_TIMEOUT:
+                    g_stats.idleTimeouts += 1
+                    self._closeConnection(conn)
+                continue
+            if now - conn.lastActivity > REQUEST_TIMEOUT:
+                g_stats.timeouts += 1
+                self._closeConnection(conn)
+
+    def run(self):
+        global g_connections
+        serverFd = self.serverSocket.fileno()
+        wakeupFd = self.wakeupReadSocket.fileno()
+        lastTimeoutCheck = time.time()
+        try:
+            while True:
+                try:
+                    events = self.poller.poll(POLL_TIMEOUT)
+                except (select.error, IOError), ex:
+                    if ex.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for (fd, fReadable, fWritable) in events:
+                    if fd == serverFd:
+                        self._acceptConnections()
+                        continue
+                    if fd == wakeupFd:
+                        self._finishProcessing()
+                        continue
+                    if not g_connections.has_key(fd):
+                        continue
+                    conn = g_connections[fd]
+                    if fReadable and STATE_READING == conn.state:
+                        self._readFromConnection(conn)
+                    elif fWritable and STATE_WRITING == conn.state:
+                        self._writeToConnection(conn)
+                    elif fReadable and STATE_WRITING == conn.state:
+                        # error or hang-up while we're sending the response
+                        self._closeConnection(conn)
+
+                if time.time() - lastTimeoutCheck >= POLL_TIMEOUT:
+                    self._closeTimedOut()
+                    lastTimeoutCheck = time.time()
+        finally:
+            self.serverSocket.close()
+
+# return a socket listening for connections on a given port
+def createServerSocket(port):
+    serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    serverSocket.bind(('', port))
+    serverSocket.listen(socket.SOMAXCONN)
+    return serverSocket
+
+# accept connections on a given port and serve them with plugClass protocol.
+# Database work (everything done by the protocol) happens in workersCount
+# worker threads. If serverSocket is given, it's used instead of creating a
+# new one (e.g. because it was inherited from the parent process).
+# Never returns
+def runEventServer(port, plugClass, workersCount=MAX_WORKER_THREADS_COUNT, serverSocket=None):
+    print ""
+    print "Starting event server with %d worker threads..." % workersCount
+    if None == serverSocket:
+        serverSocket = createServerSocket(port)
+    server = _EventServer(serverSocket, plugClass, workersCount)
+    server.run()
@@ -0,0 +1,107 @@
+# Copyright: Krzysztof Kowalczyk
+# Owner: Andrzej Ciarkowski
+#
+# Purpose:
+#  Cache of user identities so that figuring out who sent a request doesn't
+#  need to query the management database. Every request has a cookie or a
+#  registration code and we map them to (user id, disabled_p) from users
+#  table. We also keep a set of valid registration codes from reg_codes table.
+#
+#  The cache is write-through: code that creates users or registers them
+#  puts the new values in the cache. Changes made to the database by other
+#  means (e.g. disabling a user or a reg code) are seen after clear() or
+#  when entries expire, IDENTITY_TTL seconds after we cached them.
+
+import threading, time
+from LruCache import LruCache
+
+# memory budget (in bytes) for cookie and reg code to user mappings
+IDENTITY_CACHE_SIZE = 8*1024*1024
+
+# size of (user id, disabled_p) tuple, for LruCache memory accounting
+IDENTITY_SIZE = 60
+
+# how long (in seconds) we trust what we cached
+IDENTITY_TTL = 15*60
+
+class IdentityCache:
+
+    def __init__(self, maxBytes=IDENTITY_CACHE_SIZE, ttl=IDENTITY_TTL):
+        self.ttl = ttl
+        # cookie => (user id, disabled_p)
+        self.cookies = LruCache(maxBytes / 2, ttl)
+        # reg code => (user id, disabled_p)
+        self.regCodes = LruCache(maxBytes / 2, ttl)
+        self.lock = threading.Lock()
+        # valid (not disabled) registration code => time when we stop
+        # trusting that it's valid
+        self.validRegCodes = {}
+
+    # return (user id, disabled_p) of a user with a given cookie or None
+    # if we don't know it
+    def getCookieUser(self, cookie):
+        return self.cookies.get(cookie)
+
+    def putCookieUser(self, cookie, userId, disabledP):
+        self.cookies.put(cookie, (userId, disabledP), len(cookie) + IDENTITY_SIZE)
+
+    # return (user id, disabled_p) of a user registered with a given
+    # reg code or None if we don't know it
+    def getRegCodeUser(self, regCode):
+        return self.regCodes.get(regCode)
+
+    # many users (devices) can register with the same reg code. Like
+    # SELECT without ORDER BY on a MyISAM table, we map it to the one that
+    # was first (has the smallest user id)
+    def putRegCodeUser(self, regCode, userId, disabledP):
+        current = self.regCodes.peek(regCode)
+        if None != current and current[0] < userId:
+            return
+        self.regCodes.put(regCode, (userId, disabledP), len(regCode) + IDENTITY_SIZE)
+
+    # replace the set of valid registration codes
+    def setValidRegCodes(self, regCodes):
+        expires = time.time() + self.ttl
+        validRegCodes = {}
+        for regCode in regCodes:
+            validRegCodes[regCode] = expires
+        self.lock.acquire()
+        try:
+            self.validRegCodes = validRegCodes
+        finally:
+            self.lock.release()
+
+    def addValidRegCode(self, regCode):
+        self.lock.acquire()
+        try:
+            self.validRegCodes[regCode] = time.time() + self.ttl
+        finally:
+            self.lock.release()
+
+    # return True if we know that regCode is valid. False means that we don't
+    # know since reg codes might have been added since we loaded them or we
+    # knew it too long ago
+    def fKnownValidRegCode(self, regCode):
+        self.lock.acquire()
+        try:
+            if not self.validRegCodes.has_key(regCode):
+                return False
+            if time.time() >= self.validRegCodes[regCode]:
+                del self.validRegCodes[regCode]
+                return False
+            return True
+        finally:
+            self.lock.release()
+
+    # forget cookies and reg codes of users. Valid reg codes must be set again
+    # with setValidRegCodes()
+    def clear(self):
+        self.cookies.clear()
+        self.regCodes.clear()
+
+    # return a list of lines describing the state of the cache, suitable
+    # for displaying in the telnet interface
+    def getStatsLines(self):
+        return ["cookies: %s" % self.cookies.getStatsLine(),
+                "reg codes: %s" % self.regCodes.getStatsLine(),
+                "valid reg codes: %d" % len(self.validRegCodes)]
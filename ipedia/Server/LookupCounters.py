@@ -0,0 +1,286 @@
+# Copyright: Krzysztof Kowalczyk
+# Owner: Andrzej Ciarkowski
+#
+# Purpose:
+#  Keep per-user lookup counters in memory, so that checking if an
+#  unregistered user is over lookup limits doesn't need to count rows of
+#  request_log table (which grows forever).
+#
+#  For each user we keep the total number of lookups and times of the most
+#  recent lookups (to count lookups in the last 24 hours). Counters are
+#  updated as requests are logged and periodically saved to lookup_counters
+#  table. At startup we load them from lookup_counters or, if the table is
+#  empty (e.g. the first time we run), calculate them from request_log.
+#
+#  We save increments of total lookups, not the totals, so that many server
+#  processes (see -workers) can share lookup_counters table. Each process
+#  periodically reloads counters from the table to learn about lookups
+#  handled by other processes, so with many processes the limits are
+#  approximate.
+
+import threading, time, bisect
+
+# one day, in seconds
+DAY_SECONDS = 24*60*60
+
+# we only need to know if the number of lookups in the last 24 hours is over
+# the daily limit, so we don't keep times of more lookups than that. Must be
+# small enough for recent_lookups column to fit all of them
+MAX_RECENT_LOOKUPS = 20
+
+# how often (in seconds) we save changed counters to the database
+PERSIST_INTERVAL = 60.0
+
+# how many users we save with one INSERT statement
+PERSIST_ROWS_PER_QUERY = 500
+
+lookupCountersSql = """CREATE TABLE IF NOT EXISTS lookup_counters (
+    user_id         INT(10) NOT NULL REFERENCES users(user_id),
+    -- total number of lookups (see NOT_COUNTED_REQUEST_TYPES)
+    total_lookups   INT(10) NOT NULL,
+    -- comma-separated unix times of the most recent lookups
+    recent_lookups  VARCHAR(255) NOT NULL,
+
+    PRIMARY KEY(user_id)
+) TYPE=MyISAM;"""
+
+# request types (request_type column in request_log table) that aren't
+# lookups: random article and Get-Reverse-Links (for an article the client
+# already got). Every other request counts against the limits of unregistered
+# users
+NOT_COUNTED_REQUEST_TYPES = ['r', 'l']
+
+# return True if a request of requestType is a lookup
+def fCountedRequestType(requestType):
+    return requestType not in NOT_COUNTED_REQUEST_TYPES
+
+# condition for request_log rows that are lookups
+def _countedRequestsSql():
+    return "NOT (request_type IN (%s))" % ",".join(["'%s'" % t for t in NOT_COUNTED_REQUEST_TYPES])
+
+# indexes in the list we keep per user
+(COUNTER_TOTAL, COUNTER_RECENT) = range(2)
+
+class LookupCounters:
+
+    # connectionPool is a ConnectionPool we use to get connection to dbName
+    # (management database), logErrorProc is a function called with a text
+    # describing an error
+    def __init__(self, connectionPool, dbName, logErrorProc):
+        self.connectionPool = connectionPool
+        self.dbName = dbName
+        self.logErrorProc = logErrorProc
+        self.lock = threading.Lock()
+        # user id => [total lookups, list of times of recent lookups]
+        self.counters = {}
+        # user id => number of lookups since we last saved counters
+        self.dirtyUsers = {}
+        self.thread = None
+        self.stopEvent = threading.Event()
+        self.persistedCount = 0
+        self.fShared = False
+
+    def _getCounter(self, userId):
+        if not self.counters.has_key(userId):
+            self.counters[userId] = [0, []]
+        return self.counters[userId]
+
+    def _addRecent(self, counter, when):
+        # requests logged by different threads might come out of order
+        # but we keep times sorted
+        recent = counter[COUNTER_RECENT]
+        bisect.insort(recent, when)
+        if len(recent) > MAX_RECENT_LOOKUPS:
+            del recent[0]
+
+    # record a lookup done by a user at time when (current time if None)
+    def addLookup(self, userId, when=None):
+        if None == when:
+            when = time.time()
+        self.lock.acquire()
+        try:
+            counter = self._getCounter(userId)
+            counter[COUNTER_TOTAL] += 1
+            self._addRecent(counter, int(when))
+            self.dirtyUsers[userId] = self.dirtyUsers.get(userId, 0) + 1
+        finally:
+            self.lock.release()
+
+    # return a tuple (total number of lookups, number of lookups in the last
+    # 24 hours) for a given user
+    def getLookupsCount(self, userId):
+        self.lock.acquire()
+        try:
+            if not self.counters.has_key(userId):
+                return (0, 0)
+            counter = self.counters[userId]
+            since = time.time() - DAY_SECONDS
+            recent = counter[COUNTER_RECENT]
+            # times are sorted so we drop old ones from the front
+            while len(recent) > 0 and recent[0] <= since:
+                del recent[0]
+            return (counter[COUNTER_TOTAL], len(recent))
+        finally:
+            self.lock.release()
+
+    def getUsersCount(self):
+        return len(self.counters)
+
+    # load counters from the database. Must be called before the server
+    # starts handling requests
+    def load(self):
+        db = self.connectionPool.getConnection(self.dbName)
+        cursor = None
+        try:
+            cursor = db.cursor()
+            cursor.execute(lookupCountersSql)
+            cursor.execute("SELECT user_id, total_lookups, recent_lookups FROM lookup_counters;")
+            rows = cursor.fetchall()
+            if len(rows) > 0:
+                self._loadFromRows(rows)
+            else:
+                self._loadFromRequestLog(cursor)
+                # so that next time we start faster
+                for (userId, counter) in self.counters.items():
+                    self.dirtyUsers[userId] = counter[COUNTER_TOTAL]
+            cursor.close()
+        except:
+            if cursor:
+                cursor.close()
+            self.connectionPool.discardConnection(self.dbName, db)
+            raise
+        self.connectionPool.releaseConnection(self.dbName, db)
+        self.persist()
+
+    # save our changes and load counters from the database again, to see
+    # lookups handled by other processes sharing lookup_counters table
+    def reload(self):
+        self.persist()
+        db = self.connectionPool.getConnection(self.dbName)
+        cursor = None
+        try:
+            cursor = db.cursor()
+            cursor.execute("SELECT user_id, total_lookups, recent_lookups FROM lookup_counters;")
+            rows = cursor.fetchall()
+            cursor.close()
+        except:
+            if cursor:
+                cursor.close()
+            self.connectionPool.discardConnection(self.dbName, db)
+            raise
+        self.connectionPool.releaseConnection(self.dbName, db)
+
+        self.lock.acquire()
+        try:
+            oldCounters = self.counters
+            self.counters = {}
+            self._loadFromRows(rows)
+            # lookups logged after persist() above aren't in the database yet
+            for (userId, lookupsCount) in self.dirtyUsers.items():
+                self._getCounter(userId)[COUNTER_TOTAL] += lookupsCount
+            # recent_lookups only has times saved by the last process that
+            # saved a given user, so we also keep the times we know about
+            for (userId, oldCounter) in oldCounters.items():
+                counter = self._getCounter(userId)
+                for when in oldCounter[COUNTER_RECENT]:
+                    if when not in counter[COUNTER_RECENT]:
+                        self._addRecent(counter, when)
+        finally:
+            self.lock.release()
+
+    def _loadFromRows(self, rows):
+        for (userId, totalLookups, recentLookups) in rows:
+            counter = self._getCounter(int(userId))
+            counter[COUNTER_TOTAL] = int(totalLookups)
+            if len(recentLookups) > 0:
+                counter[COUNTER_RECENT] = [int(t) for t in recentLookups.split(",")]
+
+    def _loadFromRequestLog(self, cursor):
+        cursor.execute("SELECT user_id, COUNT(*) FROM request_log WHERE %s GROUP BY user_id;" % _countedRequestsSql())
+        for (userId, totalLookups) in cursor.fetchall():
+            self._getCounter(int(userId))[COUNTER_TOTAL] = int(totalLookups)
+        cursor.execute("SELECT user_id, UNIX_TIMESTAMP(log_date) FROM request_log WHERE %s AND log_date>DATE_SUB(NOW(), INTERVAL 1 DAY) ORDER BY log_date;" % _countedRequestsSql())
+        while True:
+            rows = cursor.fetchmany(10000)
+            if 0 == len(rows):
+                break
+            for (userId, when) in rows:
+                self._addRecent(self._getCounter(int(userId)), int(when))
+
+    # save counters that changed to lookup_counters table
+    def persist(self):
+        self.lock.acquire()
+        try:
+            rows = []
+            for (userId, lookupsCount) in self.dirtyUsers.items():
+                counter = self.counters[userId]
+                recentTxt = ",".join([str(t) for t in counter[COUNTER_RECENT]])
+                rows.append("(%d,%d,'%s')" % (userId, lookupsCount, recentTxt))
+            dirtyUsers = self.dirtyUsers
+            self.dirtyUsers = {}
+        finally:
+            self.lock.release()
+
+        if 0 == len(rows):
+            return
+        db = None
+        cursor = None
+        try:
+            db = self.connectionPool.getConnection(self.dbName)
+            cursor = db.cursor()
+            for start in range(0, len(rows), PERSIST_ROWS_PER_QUERY):
+                values = ",".join(rows[start:start+PERSIST_ROWS_PER_QUERY])
+                cursor.execute("INSERT INTO lookup_counters (user_id, total_lookups, recent_lookups) VALUES %s ON DUPLICATE KEY UPDATE total_lookups=total_lookups+VALUES(total_lookups), recent_lookups=VALUES(recent_lookups);" % values)
+            cursor.close()
+            self.connectionPool.releaseConnection(self.dbName, db)
+            self.persistedCount += len(rows)
+        except Exception, ex:
+            if cursor:
+                cursor.close()
+            if db:
+                self.connectionPool.discardConnection(self.dbName, db)
+            # we'll try again next time
+            self.lock.acquire()
+            try:
+                for (userId, lookupsCount) in dirtyUsers.items():
+                    self.dirtyUsers[userId] = self.dirtyUsers.get(userId, 0) + lookupsCount
+            finally:
+                self.lock.release()
+            self.logErrorProc("failed to save lookup counters of %d users: %s\n" % (len(rows), str(ex)))
+
+    # start a thread that periodically saves counters. If fShared is True,
+    # other processes update lookup_counters table too, so the thread also
+    # reloads counters after saving them
+    def start(self, fShared=False):
+        assert None == self.thread
+        self.fShared = fShared
+        self.thread = threading.Thread(target=self._persistThread)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    # stop the thread started with start() and save counters that changed
+    def close(self):
+        if None != self.thread:
+            self.stopEvent.set()
+            self.thread.join()
+            self.thread = None
+        self.persist()
+
+    def _persistThread(self):
+        while not self.stopEvent.isSet():
+            self.stopEvent.wait(PERSIST_INTERVAL)
+            if self.stopEvent.isSet():
+                break
+            if not self.fShared:
+                self.persist()
+                continue
+            try:
+                self.reload()
+            except Exception, ex:
+                # we'll try again next time
+                self.logErrorProc("failed to reload lookup counters: %s\n" % str(ex))
+
+    # return a one-line description of the counters state, suitable for
+    # displaying in the telnet interface
+    def getStatsLine(self):
+        return "users %d, changed %d, saved %d" % (len(self.counters), len(self.dirtyUsers), self.persistedCount)
@@ -0,0 +1,155 @@
+# Copyright: Krzysztof Kowalczyk
+# Owner: Andrzej Ciarkowski
+#
+# Purpose:
+#  Thread-safe cache that keeps the least recently used items within a
+#  given memory budget (in bytes). Size of each item is given by the caller
+#  when the item is added, since only the caller knows what's in there.
+#  Optionally items expire after a given time.
+
+import threading, time
+
+# we can't know the exact overhead of keeping an item in the cache (python
+# objects, dictionary entry etc.) but it's not 0. This is our guess that we
+# add to the size of each item
+ITEM_OVERHEAD = 100
+
+# indexes in the list we use as a node of doubly-linked list
+(NODE_PREV, NODE_NEXT, NODE_KEY, NODE_VALUE, NODE_SIZE, NODE_EXPIRES) = range(6)
+
+class LruCache:
+
+    # if ttl is not None, items are dropped ttl seconds after they were added
+    def __init__(self, maxBytes, ttl=None):
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key => node
+        self.nodes = {}
+        # sentinel node of the circular doubly-linked list. Node after
+        # self.head is the most recently used, node before is the least
+        # recently used
+        self.head = [None, None, None, None, 0, None]
+        self.head[NODE_PREV] = self.head
+        self.head[NODE_NEXT] = self.head
+        self.curBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _unlink(self, node):
+        node[NODE_PREV][NODE_NEXT] = node[NODE_NEXT]
+        node[NODE_NEXT][NODE_PREV] = node[NODE_PREV]
+
+    def _linkFirst(self, node):
+        node[NODE_PREV] = self.head
+        node[NODE_NEXT] = self.head[NODE_NEXT]
+        self.head[NODE_NEXT][NODE_PREV] = node
+        self.head[NODE_NEXT] = node
+
+    def _remove(self, node):
+        self._unlink(node)
+        del self.nodes[node[NODE_KEY]]
+        self.curBytes -= node[NODE_SIZE]
+
+    # return value for a given key or None if it's not in the cache
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            if not self.nodes.has_key(key):
+                self.misses += 1
+                return None
+            node = self.nodes[key]
+            if None != node[NODE_EXPIRES] and time.time() >= node[NODE_EXPIRES]:
+                self._remove(node)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._unlink(node)
+            self._linkFirst(node)
+            self.hits += 1
+            return node[NODE_VALUE]
+        finally:
+            self.lock.release()
+
+    # like get() but doesn't make the item most recently used and doesn't
+    # count as a hit or miss
+    def peek(self, key):
+        self.lock.acquire()
+        try:
+            if not self.nodes.has_key(key):
+                return None
+            node = self.nodes[key]
+            if None != node[NODE_EXPIRES] and time.time() >= node[NODE_EXPIRES]:
+                return None
+            return node[NODE_VALUE]
+        finally:
+            self.lock.release()
+
+    # add value to the cache under a given key. size is the size of value
+    # in bytes. Evicts least recently used items if needed to stay within
+    # memory budget
+    def put(self, key, value, size):
+        size += ITEM_OVERHEAD
+        if size > self.maxBytes:
+            # wouldn't fit anyway
+            return
+        self.lock.acquire()
+        try:
+            if self.nodes.has_key(key):
+                self._remove(self.nodes[key])
+            while self.curBytes + size > self.maxBytes:
+                self._remove(self.head[NODE_PREV])
+                self.evictions += 1
+            expires = None
+            if None != self.ttl:
+                expires = time.time() + self.ttl
+            node = [None, None, key, value, size, expires]
+            self._linkFirst(node)
+            self.nodes[key] = node
+            self.curBytes += size
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        self.lock.acquire()
+        try:
+            if self.nodes.has_key(key):
+                self._remove(self.nodes[key])
+        finally:
+            self.lock.release()
+
+    # remove all items whose key matches, i.e. fMatchProc(key) returns True.
+    # Return number of removed items
+    def removeMatching(self, fMatchProc):
+        self.lock.acquire()
+        try:
+            toRemove = [node for node in self.nodes.values() if fMatchProc(node[NODE_KEY])]
+            for node in toRemove:
+                self._remove(node)
+        finally:
+            self.lock.release()
+        return len(toRemove)
+
+    def clear(self):
+        self.removeMatching(lambda key: True)
+
+    def getItemsCount(self):
+        return len(self.nodes)
+
+    # return a one-line description of the cache state, suitable for
+    # displaying in the telnet interface
+    def getStatsLine(self):
+        self.lock.acquire()
+        try:
+            lookups = self.hits + self.misses
+            hitRate = 0.0
+            if lookups > 0:
+                hitRate = 100.0 * float(self.hits) / float(lookups)
+            txt = "items %d, bytes %d of %d, hits %d, misses %d (%.1f%% hit rate), evictions %d" % (len(self.nodes), self.curBytes, self.maxBytes, self.hits, self.misses, hitRate, self.evictions)
+            if None != self.ttl:
+                txt += ", expirations %d" % self.expirations
+            return txt
+        finally:
+            self.lock.release()
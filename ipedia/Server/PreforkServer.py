@@ -0,0 +1,200 @@
+# Copyright: Krzysztof Kowalczyk
+# Owner: Andrzej Ciarkowski
+#
+# Purpose:
+#  Multi-process mode of the server (-workers N). A single python process
+#  can only use one CPU for python code, so we fork N worker processes that
+#  all accept connections on the same listening socket, inherited from the
+#  parent. The parent process (supervisor) only restarts workers that died
+#  and passes telnet commands to workers.
+#
+#  Each worker has a control connection (a socket pair) to the supervisor.
+#  The supervisor sends telnet commands over it, one per line. The worker
+#  executes them with the telnet protocol class and sends back the output
+#  preceded by a line with its length.
+#
+#  Unix only, since we need fork().
+#
+#  fork() only copies the thread calling it. If another thread of the
+#  supervisor (e.g. serving a telnet command) held a lock at that moment, the
+#  lock would stay locked forever in the worker. That's why we hold all locks
+#  such threads can take while we fork and why the telnet server is only
+#  started after the first workers are.
+
+import os, sys, socket, signal, time, threading, errno, traceback, random
+from EventServer import BufferedTransport, createServerSocket
+
+# if a worker dies sooner than that (in seconds) after it was started, we
+# wait RESTART_DELAY seconds before starting a new one, so that a worker
+# crashing at startup doesn't make us fork all the time
+MIN_WORKER_LIFETIME = 5.0
+RESTART_DELAY = 5.0
+
+class _WorkerProcess:
+    def __init__(self, pid, controlSocket):
+        self.pid = pid
+        self.controlSocket = controlSocket
+        self.controlFile = controlSocket.makefile("rb")
+        self.startTime = time.time()
+        self.lock = threading.Lock()
+
+    # send a telnet command to the worker and return its output
+    def sendCommand(self, command):
+        self.lock.acquire()
+        try:
+            self.controlSocket.sendall(command + "\n")
+            lenLine = self.controlFile.readline()
+            if not lenLine:
+                raise IOError("worker closed control connection")
+            return self.controlFile.read(int(lenLine))
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.controlFile.close()
+        self.controlSocket.close()
+
+# pid => _WorkerProcess. None if we're not the supervisor
+g_workers = None
+g_workersLock = threading.Lock()
+
+# return True if we're the supervisor process of -workers mode
+def fSupervisor():
+    global g_workers
+    return None != g_workers
+
+# send a telnet command to all workers. Return a list of tuples (pid, output)
+def sendCommandToWorkers(command):
+    global g_workers, g_workersLock
+    g_workersLock.acquire()
+    try:
+        workers = g_workers.values()
+    finally:
+        g_workersLock.release()
+    workers.sort(lambda a, b: cmp(a.pid, b.pid))
+
+    result = []
+    for worker in workers:
+        try:
+            output = worker.sendCommand(command)
+        except (socket.error, IOError, ValueError), ex:
+            output = "no response from worker: %s\n" % str(ex)
+        result.append((worker.pid, output))
+    return result
+
+# in a worker process: execute telnet commands sent by the supervisor
+def _controlThread(controlSocket, telnetPlugClass):
+    controlFile = controlSocket.makefile("rb")
+    while True:
+        line = controlFile.readline()
+        if not line:
+            # supervisor is gone, so should we
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+        plug = telnetPlugClass()
+        plug.transport = BufferedTransport(None, plug)
+        try:
+            plug.lineReceived(line.rstrip("\r\n"))
+        except Exception, ex:
+            plug.transport.closed = False
+            plug.transport.write("exception: %s\n" % str(ex))
+        output = plug.transport.takeOutput()
+        controlSocket.sendall("%d\n%s" % (len(output), output))
+
+def _exitOnSignal(signum, frame):
+    sys.exit(0)
+
+def _startWorker(serverSocket, runWorkerProc, telnetPlugClass, forkLocks):
+    global g_workers, g_workersLock
+    (parentSocket, childSocket) = socket.socketpair()
+    locks = [g_workersLock] + forkLocks
+    for lock in locks:
+        lock.acquire()
+    try:
+        pid = os.fork()
+    finally:
+        # both in the supervisor and in the worker
+        for lock in locks:
+            lock.release()
+    if 0 == pid:
+        # we're the worker. Without reseeding all workers would generate
+        # the same random numbers as the supervisor
+        random.seed()
+        parentSocket.close()
+        for worker in g_workers.values():
+            worker.close()
+        g_workers = None
+        # that's how the supervisor tells us to stop. Raising SystemExit
+        # lets runWorkerProc clean up (e.g. write buffered logs)
+        signal.signal(signal.SIGTERM, _exitOnSignal)
+        exitCode = 0
+        try:
+            thread = threading.Thread(target=_controlThread, args=(childSocket, telnetPlugClass))
+            thread.setDaemon(True)
+            thread.start()
+            runWorkerProc(serverSocket)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        except:
+            traceback.print_exc()
+            exitCode = 1
+        os._exit(exitCode)
+
+    childSocket.close()
+    g_workersLock.acquire()
+    try:
+        g_workers[pid] = _WorkerProcess(pid, parentSocket)
+    finally:
+        g_workersLock.release()
+    print "started worker process %d" % pid
+
+# start workersCount processes accepting connections on a given port. Each
+# calls runWorkerProc(serverSocket) which should serve connections. Crashed
+# workers are restarted. beforeForkProc is called before each fork(), so
+# that we can e.g. close database connections that can't be shared with
+# a child. forkLocks is a list of locks of objects shared with other threads,
+# we hold them during fork(). startedProc is called once the first workers
+# are started, that's where threads of the supervisor should be started.
+# telnetPlugClass is used by workers to execute telnet commands.
+# Never returns
+def runPreforkServer(port, workersCount, runWorkerProc, beforeForkProc, forkLocks, startedProc, telnetPlugClass):
+    global g_workers, g_workersLock
+    serverSocket = createServerSocket(port)
+    g_workers = {}
+    print ""
+    print "Starting %d worker processes..." % workersCount
+    try:
+        for i in range(workersCount):
+            beforeForkProc()
+            _startWorker(serverSocket, runWorkerProc, telnetPlugClass, forkLocks)
+        startedProc()
+
+        while True:
+            try:
+                (pid, status) = os.wait()
+            except OSError, ex:
+                if errno.EINTR == ex.args[0]:
+                    continue
+                raise
+            g_workersLock.acquire()
+            try:
+                worker = g_workers.pop(pid, None)
+            finally:
+                g_workersLock.release()
+            if None == worker:
+                # not one of our workers (e.g. a child of a telnet command)
+                continue
+            worker.close()
+            print "worker process %d exited with status %d" % (pid, status)
+            if time.time() - worker.startTime < MIN_WORKER_LIFETIME:
+                time.sleep(RESTART_DELAY)
+            beforeForkProc()
+            _startWorker(serverSocket, runWorkerProc, telnetPlugClass, forkLocks)
+    finally:
+        for pid in g_workers.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        serverSocket.close()
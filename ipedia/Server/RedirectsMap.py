@@ -0,0 +1,59 @@
+# Copyright: Krzysztof Kowalczyk
+# Owner: Andrzej Ciarkowski
+#
+# Purpose:
+#  Keep the whole redirects table of an articles database in memory so that
+#  resolving redirects doesn't need to query MySQL.
+#
+#  Redirects don't change once a database is built. There are hundreds of
+#  thousands of them so instead of a dictionary we use two sorted, parallel
+#  lists (titles and redirects) and binary search. Many redirects point to the
+#  same article, so redirect targets are interned to share the strings.
+
+import bisect
+
+# rough size of python string object without the text, used to estimate
+# memory used by the map
+STR_OVERHEAD = 40
+# size of a reference in a list
+REF_SIZE = 8
+
+class RedirectsMap:
+
+    # pairs is a list of (title, redirect) tuples where title is already
+    # normalized the way we'll look it up. The list is sorted in place
+    def __init__(self, pairs):
+        pairs.sort()
+        self.titles = []
+        self.redirects = []
+        prevTitle = None
+        for (title, redirect) in pairs:
+            if title == prevTitle:
+                # titles MySQL considers equal are the same title for us
+                continue
+            self.titles.append(title)
+            self.redirects.append(intern(redirect))
+            prevTitle = title
+
+    def getCount(self):
+        return len(self.titles)
+
+    # return the title of the article a (normalized) title redirects to
+    # or None if it's not a redirect
+    def getRedirect(self, title):
+        pos = bisect.bisect_left(self.titles, title)
+        if pos < len(self.titles) and self.titles[pos] == title:
+            return self.redirects[pos]
+        return None
+
+    # return an estimate of the memory used by the map, in bytes
+    def getMemoryUsage(self):
+        total = 2 * REF_SIZE * len(self.titles)
+        for title in self.titles:
+            total += STR_OVERHEAD + len(title)
+        unique = {}
+        for redirect in self.redirects:
+            unique[id(redirect)] = redirect
+        for redirect in unique.values():
+            total += STR_OVERHEAD + len(redirect)
+        return total
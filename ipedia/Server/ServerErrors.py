@@ -55,3 +55,8 @@ forceUpgrade = 12
 # return langNotAvailable if Use-Lang gave us language code for which
 # we don't have a database
 langNotAvailable = 13
+
+# return searchCursorExpired if client sent Search-Next with a cursor we
+# can't use anymore (e.g. we switched to a new database and the search has
+# fewer results). Client should send the Search again
+searchCursorExpired = 14
@@ -0,0 +1,171 @@
+# Copyright: Krzysztof Kowalczyk
+# Owner: Andrzej Ciarkowski
+#
+# Purpose:
+#  In-memory index of article titles used to suggest titles similar to a
+#  title we don't have (e.g. misspelled), which is much faster than
+#  full-text search.
+#
+#  We index trigrams (3-character substrings) of titles padded with a space
+#  at both ends. For each trigram we keep an array with numbers of titles
+#  that contain it, in increasing order. Similar titles share most trigrams,
+#  so we find titles with most trigrams in common with the title we look for
+#  and rank them by Dice coefficient (2 * common / (trigrams of a + trigrams
+#  of b)).
+#
+#  Trigrams that are in a lot of titles (e.g. "the") would make us look at
+#  most of the titles, so we only use them to score titles found by other
+#  trigrams (with binary search in their arrays).
+#
+#  Building the index for a big database takes a while, so we save it to a
+#  file (with marshal) and load it from there next time. Articles databases
+#  shouldn't change once they're built, but one can be rebuilt under the same
+#  name, so the file also has a stamp of the database it was built from (e.g.
+#  the number of articles) and we don't load it if the stamp is different.
+
+import array, bisect, marshal, os
+
+# change when the format of the file changes, so that we don't load old files
+FILE_VERSION = 2
+
+# type of arrays with title numbers
+ARRAY_TYPE = 'l'
+
+# trigrams in more titles than that are too common to find candidates with
+MAX_SCANNED_POSTINGS = 20000
+# how many titles with most trigrams in common we score
+MAX_CANDIDATES = 200
+# titles less similar than that are not suggested
+MIN_SCORE = 0.5
+# default number of suggestions
+SUGGESTIONS_COUNT = 10
+
+# rough size of python string and array objects without the data (and
+# a reference to them), used to estimate memory used by the index
+STR_OVERHEAD = 48
+ARRAY_OVERHEAD = 64
+
+# return a list of unique trigrams of a (normalized) title
+def getTrigrams(key):
+    padded = " %s " % key
+    trigrams = {}
+    for i in range(len(padded) - 2):
+        trigrams[padded[i:i+3]] = True
+    return trigrams.keys()
+
+class SuggestionIndex:
+
+    # titles is a list of titles, postings a dictionary mapping trigrams to
+    # arrays of numbers of titles in titles. Use buildSuggestionIndex() or
+    # loadSuggestionIndex() to create one
+    def __init__(self, titles, postings):
+        self.titles = titles
+        self.postings = postings
+
+    def getCount(self):
+        return len(self.titles)
+
+    # return a list of titles similar to a (normalized) title, the most
+    # similar first
+    def getSuggestions(self, key, maxCount=SUGGESTIONS_COUNT):
+        trigrams = getTrigrams(key)
+        postingsList = [self.postings[trigram] for trigram in trigrams if self.postings.has_key(trigram)]
+        postingsList.sort(lambda a, b: cmp(len(a), len(b)))
+
+        # count trigrams in common with titles using all but too common
+        # trigrams (but at least one)
+        counts = {}
+        skipped = []
+        for postings in postingsList:
+            if len(counts) > 0 and len(postings) > MAX_SCANNED_POSTINGS:
+                skipped.append(postings)
+                continue
+            for titleNo in postings:
+                counts[titleNo] = counts.get(titleNo, 0) + 1
+        if 0 == len(counts):
+            return []
+
+        best = max(counts.values())
+        candidates = [(count, titleNo) for (titleNo, count) in counts.items() if count * 2 >= best]
+        candidates.sort()
+        candidates = candidates[-MAX_CANDIDATES:]
+
+        scored = []
+        for (count, titleNo) in candidates:
+            # add trigrams we skipped
+            for postings in skipped:
+                pos = bisect.bisect_left(postings, titleNo)
+                if pos < len(postings) and postings[pos] == titleNo:
+                    count += 1
+            title = self.titles[titleNo]
+            # a padded title of length n has n trigrams (unless some repeat)
+            score = 2.0 * count / (len(trigrams) + max(len(title), 1))
+            if score >= MIN_SCORE:
+                scored.append((-score, abs(len(title) - len(key)), title))
+        scored.sort()
+        return [title for (score, lenDiff, title) in scored[:maxCount]]
+
+    # return an estimate of the memory used by the index, in bytes
+    def getMemoryUsage(self):
+        total = 0
+        for title in self.titles:
+            total += STR_OVERHEAD + len(title)
+        for postings in self.postings.values():
+            total += STR_OVERHEAD + ARRAY_OVERHEAD + len(postings) * postings.itemsize
+        return total
+
+    # save the index to a file, so that it can be loaded with
+    # loadSuggestionIndex(). sourceStamp is a value (that marshal can save)
+    # describing the data the index was built from. We write to a temporary
+    # file first so that nobody ever sees a partially written file
+    def save(self, fileName, sourceStamp=None):
+        postings = {}
+        for (trigram, titleNos) in self.postings.items():
+            postings[trigram] = titleNos.tostring()
+        itemSize = array.array(ARRAY_TYPE).itemsize
+        tmpFileName = fileName + ".tmp"
+        fo = open(tmpFileName, "wb")
+        try:
+            marshal.dump((FILE_VERSION, itemSize, sourceStamp, self.titles, postings), fo)
+        finally:
+            fo.close()
+        os.rename(tmpFileName, fileName)
+
+# pairs is a list of tuples (normalized title, title) of all titles we want
+# to suggest
+def buildSuggestionIndex(pairs):
+    titles = []
+    postings = {}
+    for (key, title) in pairs:
+        titleNo = len(titles)
+        titles.append(title)
+        for trigram in getTrigrams(key):
+            titleNos = postings.get(trigram)
+            if None == titleNos:
+                titleNos = array.array(ARRAY_TYPE)
+                postings[trigram] = titleNos
+            titleNos.append(titleNo)
+    return SuggestionIndex(titles, postings)
+
+# return SuggestionIndex saved with SuggestionIndex.save() or None if
+# there's no such file, it was saved in a different format or with
+# a different sourceStamp (i.e. it's out of date)
+def loadSuggestionIndex(fileName, sourceStamp=None):
+    try:
+        fo = open(fileName, "rb")
+    except IOError:
+        return None
+    try:
+        try:
+            (fileVersion, itemSize, fileSourceStamp, titles, postings) = marshal.load(fo)
+        except (EOFError, ValueError, TypeError):
+            return None
+    finally:
+        fo.close()
+    if FILE_VERSION != fileVersion or array.array(ARRAY_TYPE).itemsize != itemSize:
+        return None
+    if sourceStamp != fileSourceStamp:
+        return None
+    for (trigram, titleNos) in postings.items():
+        postings[trigram] = array.array(ARRAY_TYPE, titleNos)
+    return SuggestionIndex(titles, postings)
@@ -7,6 +7,10 @@ requestsQueue = None
 
 REQUEST_TIMEOUT = 120.0
 
+# how long (in seconds) we wait for the next request on a connection kept
+# open with keepAlive()
+KEEP_ALIVE_TIMEOUT = 30.0
+
 class PeerInfo:
     def __init__(self, addr=None):
         if None == addr:
@@ -15,6 +19,17 @@ class PeerInfo:
             # addr is a tuple (ipAddr, port)
             self.host = str(addr[0])
 
+# disable Nagle's algorithm on a socket. We send whole responses at once, so
+# there's nothing to gain from waiting for more data and with keep-alive it
+# would delay responses after the first one
+def setNoDelay(sock):
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except socket.error:
+        pass
+
+# data written to the transport is kept in memory and sent with one sendall()
+# when the protocol is done with a response (see flush())
 class _Transport:
 
     def __init__(self, conn, receiver):
@@ -22,15 +37,28 @@ class _Transport:
         self.peer = PeerInfo(self.address)
         self.closed = False
         self.receiver = receiver
+        # True if we're waiting for the next request after keepAlive()
+        self.fIdle = False
+        self.buffers = []
         try:
             self.socket.settimeout(REQUEST_TIMEOUT)
         except:
             # not available in python2.2, but that's ok
             pass
+        setNoDelay(self.socket)
 
     def write(self, data):
         if self.closed:
             return
+        self.buffers.append(data)
+
+    # send everything written so far. Called before we wait for more data
+    # from the client and before closing the connection
+    def flush(self):
+        if self.closed or 0 == len(self.buffers):
+            return
+        data = "".join(self.buffers)
+        self.buffers = []
         try:
             self.socket.sendall(data)
         except Exception, ex:
@@ -40,9 +68,27 @@ class _Transport:
     def getPeer(self):
         return self.peer
 
+    # called by the protocol after it answered a request if it wants to get
+    # more requests over this connection. We only wait KEEP_ALIVE_TIMEOUT
+    # for the next one
+    def keepAlive(self):
+        self.fIdle = True
+        try:
+            self.socket.settimeout(KEEP_ALIVE_TIMEOUT)
+        except:
+            pass
+
+    def setBusy(self):
+        self.fIdle = False
+        try:
+            self.socket.settimeout(REQUEST_TIMEOUT)
+        except:
+            pass
+
     def loseConnection(self):
         if self.closed:
             return
+        self.flush()
         self.closed = True
         try:
             self.socket.shutdown(2)
@@ -63,32 +109,66 @@ class LineReceiver:
 
     def processConnection(self):
         try:
-            request = ""
-            start = 0
+            # parts of the line we're receiving, that came in previous chunks.
+            # We only look for the delimiter in new data and join the parts
+            # once, when the line is complete
+            lineParts = []
             while True:
-                chunk = self.transport.socket.recv(4096)
+                # send responses to what we got so far before waiting for more
+                self.transport.flush()
+                try:
+                    chunk = self.transport.socket.recv(4096)
+                except socket.timeout:
+                    # a client kept alive doesn't have to send anything more
+                    if self.transport.fIdle:
+                        return
+                    raise
                 if not chunk:
                     break
-                request += chunk
+                if self.transport.fIdle:
+                    self.transport.setBusy()
 
+                start = 0
                 while True:
-                    pos = request.find(self.delimiter, start)
+                    pos = chunk.find(self.delimiter, start)
                     if -1 == pos:
                         break
-                    line = request[start:pos]
+                    lineParts.append(chunk[start:pos])
+                    line = "".join(lineParts)
+                    lineParts = []
                     start = pos + 1
                     self.lineReceived(line)
                     if self.transport.closed:
                         return
-                    if start == len(request):
-                        break
+                if start != len(chunk):
+                    lineParts.append(chunk[start:])
 
-            if (not self.transport.closed) and (start != len(request)):
-                line = request[start:]
+            if (not self.transport.closed) and (0 != len(lineParts)):
+                line = "".join(lineParts)
                 self.lineReceived(line)
         except Exception, ex:
             self.logException(ex)
 
+    # process a request that has been received as a whole (used by
+    # EventServer). fEof is True if the client closed the connection after
+    # sending data, in which case the last line doesn't need a delimiter.
+    # Return the data after the last delimiter which we didn't process
+    # (part of the next request sent over a connection kept alive)
+    def processData(self, data, fEof):
+        start = 0
+        while not self.transport.closed:
+            pos = data.find(self.delimiter, start)
+            if -1 == pos:
+                break
+            line = data[start:pos]
+            start = pos + 1
+            self.lineReceived(line)
+
+        if fEof and (not self.transport.closed) and (start != len(data)):
+            self.lineReceived(data[start:])
+            return ""
+        return data[start:]
+
 def runClientThread(plugClass):
     global requestsQueue
     threadId = get_ident()
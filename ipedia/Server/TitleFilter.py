@@ -0,0 +1,78 @@
+# Copyright: Krzysztof Kowalczyk
+# Owner: Andrzej Ciarkowski
+#
+# Purpose:
+#  Bloom filter with all article and redirect titles of an articles database,
+#  so that we can tell that we don't have an article without asking MySQL.
+#  Many Get-Article requests are for misspelled titles and for each of them
+#  we would query articles and redirects tables before doing full-text search.
+#
+#  The filter can say that a title might be in the database when it isn't
+#  (a false positive, then we query MySQL as we would without the filter)
+#  but never the other way around. With BITS_PER_TITLE bits per title and
+#  HASHES_COUNT hashes, false positives are about 1% of the titles we don't
+#  have. The filter uses BITS_PER_TITLE/8 bytes per title, much less than
+#  keeping the titles themselves.
+
+import array, struct, md5, math
+
+BITS_PER_TITLE = 10
+HASHES_COUNT = 7
+
+class TitleFilter:
+
+    # titlesCount is the number of titles we'll add, used to figure out the
+    # size of the filter
+    def __init__(self, titlesCount):
+        self.bitsCount = max(titlesCount * BITS_PER_TITLE, 64)
+        self.bits = array.array('B', [0]) * ((self.bitsCount + 7) / 8)
+        self.titlesCount = 0
+        # stats. They're updated without a lock so they might be a bit off
+        # but that's good enough for stats
+        self.lookups = 0
+        self.rejected = 0
+        self.falsePositives = 0
+
+    # return bit numbers for a (normalized) title. We calculate them from
+    # two 32-bit hashes (h1 + i*h2), which is as good as independent hashes
+    def _getBits(self, title):
+        (h1, h2) = struct.unpack("<LL", md5.new(title).digest()[:8])
+        return [(h1 + i * h2) % self.bitsCount for i in range(HASHES_COUNT)]
+
+    # add a title, already normalized the way we'll look it up
+    def add(self, title):
+        bits = self.bits
+        for bit in self._getBits(title):
+            bits[bit >> 3] |= 1 << (bit & 7)
+        self.titlesCount += 1
+
+    # return False if we don't have a (normalized) title for sure. True if
+    # we might have it
+    def fMightContain(self, title):
+        self.lookups += 1
+        bits = self.bits
+        for bit in self._getBits(title):
+            if 0 == bits[bit >> 3] & (1 << (bit & 7)):
+                self.rejected += 1
+                return False
+        return True
+
+    # called when fMightContain() returned True for a title we don't have
+    def noteFalsePositive(self):
+        self.falsePositives += 1
+
+    def getMemoryUsage(self):
+        return len(self.bits)
+
+    # return expected rate of false positives (0.0 to 1.0), given the
+    # number of titles we added
+    def getFalsePositiveRate(self):
+        return math.pow(1.0 - math.exp(-float(HASHES_COUNT) * self.titlesCount / self.bitsCount), HASHES_COUNT)
+
+    def getStatsLine(self):
+        # false positives among lookups of titles we don't have
+        missing = self.rejected + self.falsePositives
+        observed = 0.0
+        if missing > 0:
+            observed = 100.0 * self.falsePositives / missing
+        return "titles %d, %d kB, expected false positives %.2f%%, lookups %d, rejected %d, false positives %d (%.2f%%)" % (self.titlesCount, self.getMemoryUsage() / 1024, 100.0 * self.getFalsePositiveRate(), self.lookups, self.rejected, self.falsePositives, observed)
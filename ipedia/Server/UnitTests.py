@@ -5,8 +5,8 @@
 #  Unit testing for python code
 #  see http://diveintopython.org/unit_testing/index.html for more info
 
-import unittest
-import arsutils,wikipediasql
+import unittest, time, os, tempfile, shutil, zlib
+import arsutils,iPediaServer,wikipediasql,wikiToDbConvert,ConnectionPool,LruCache,RedirectsMap,BatchedLogWriter,LookupCounters,IdentityCache,ThreadedServer,EventServer,ArticleSections,TitleFilter,SuggestionIndex
 from articleconvert import *
 
 # tests for functions in arsutils module
@@ -96,6 +96,28 @@ lost""", "div", "\n\nlost"],
             txt = removeImageStr(td[0])
             self.assertEqual(txt,td[1])
 
+    def test_convertArticleSinglePass(self):
+        testData = [ "a {{Infobox|x={{convert|1}}|y=2}} b",
+                     "a {{t {{msg:x}} u}} b",
+                     "{{msg:spoiler}} {{msg:stub}}",
+                     "<div>a<!-- </div> -->b</div>c",
+                     "<table><div></table></div>a</table>b",
+                     "<div><table></div></table>a",
+                     "{|\n|a {{t|}}\n|}b",
+                     "[[[Category:C]] [[de:Foo &amp; bar]] [[Image:x.jpg|[[a]] b]]c",
+                     "&amp;#233; &#324; &sup2 &sup2; &foo; &#10;&#10;&#10;x",
+                     "a\r\n\r\n<!-- x -->\n\n__NOTOC__b",
+                     "<b>a</b> <I>b</I> <p class=x> <hr> <span>c</span> </div>",
+                     "<script>x</script>y<div ",
+                     ]
+        # list page with thousands of matches of each pattern
+        listItems = []
+        for i in range(3000):
+            listItems.append("* <b>[[Item %d]]</b> {{flag|%d}} <!-- %d --> <span>in</span> <div>%d</div> [[Image:%d.jpg]] [[Category:List %d]]\n\n\n" % (i, i, i, i, i, i))
+        testData.append("".join(listItems))
+        for td in testData:
+            self.assertEqual(convertArticle("test", td), convertArticleMultiPass("test", td))
+
     def test_removeImageStr(self):
         tdCopy = [t for t in testDataImg]
         tdCopy.append(["oh[[image:man[[bo[[la]]e]]]]gal", "ohgal"])
@@ -146,5 +168,574 @@ class WikipediaSql(unittest.TestCase):
         for t in testData:
             self.assertEqual(wikipediasql.fIsRedirectLine(t[0]), t[1])
 
+    def getTokens(self, st):
+        tokens = []
+        while st.fSkipUntilTxt(wikipediasql.BEG_TXT):
+            token = None
+            while wikipediasql.TOKEN_SEP != token:
+                token = st.getToken()
+                if wikipediasql.fTokenVal(token):
+                    tokens.append((token, st.getTokenVal()))
+                else:
+                    tokens.append(token)
+        st.close()
+        return tokens
+
+    def test_fastSqlTokenizer(self):
+        dump = "-- dump\nINSERT INTO `cur` VALUES (1,0,'Foo','a\\'b\\\\c\\nd\\\"e\\Z\\0f\\r',1.5,-3,2e-05,''),(2,0,'Bar','\\\\',0,.5,'x\\\\\\'y');\nINSERT INTO `cur` VALUES (3,0,'\\'\\'Baz\\'\\'','long text',1,1,'');\n"
+        fileName = tempfile.mktemp()
+        fo = open(fileName, "wb")
+        fo.write(dump)
+        fo.close()
+        try:
+            expected = self.getTokens(wikipediasql.SQLTokenizer(fileName))
+            self.assertEqual(len(expected), 50)
+            self.assertEqual(expected[7], (wikipediasql.TOKEN_STR, "a'b\\c\nd\"e%s0f\r" % chr(26)))
+            self.assertEqual(expected[11], (wikipediasql.TOKEN_NUM, "-3"))
+            for bufSize in [1, 2, 3, 5, 7, 64, 1024]:
+                self.assertEqual(self.getTokens(wikipediasql.FastSQLTokenizer(fileName, bufSize)), expected)
+        finally:
+            os.remove(fileName)
+
+    def getArticles(self, dump, columns=None):
+        dirName = tempfile.mkdtemp()
+        fileName = os.path.join(dirName, "pl_cur_table.sql")
+        fo = open(fileName, "wb")
+        fo.write(dump)
+        fo.close()
+        try:
+            return [article for article in wikipediasql.iterWikipediaArticles(fileName, columns=columns)]
+        finally:
+            shutil.rmtree(dirName)
+
+    def test_iterWikipediaArticles(self):
+        dump = "-- dump\nINSERT INTO `cur` VALUES (1,0,'Foo','foo text ','',0,'','20050202123456','',7,0,0,0,0.1,79949797876543,'20050202123456'),(2,1,'Foo','talk text','',0,'','20050202123456','',3,0,0,0,0.2,79949797876543,'20050202123456'),(3,0,'Bar','bar text','',0,'','20050202123456','',0,0,0,0,0.3,79949797876543,'20050202123456');\n"
+        articles = self.getArticles(dump)
+        self.assertEqual([article.getTitle() for article in articles], ["Foo", "Bar"])
+        self.assertEqual(articles[0].getText(), "foo text")
+        self.assertEqual(articles[0].getViewCount(), 7)
+        self.assertEqual(articles[0].getId(), 1)
+        # columns we don't need by default are not read
+        self.assertEqual(articles[0].getTimestamp(), None)
+        self.assertEqual(articles[1].fRedirect(), False)
+        articles = self.getArticles(dump, [wikipediasql.CUR_TIMESTAMP])
+        self.assertEqual(articles[0].getTimestamp(), "20050202123456")
+
+class WikiToDbConvert(unittest.TestCase):
+    def test_iterConvertedArticlesParallel(self):
+        rows = []
+        for i in range(20):
+            rows.append("(%d,0,'Article_%d','<b>Article %d</b>\\n\\nlinks to [[Article %d]], [[Missing %d]] and [[Redirect]]. {{stub}}','',0,'','20050202123456','',0,0,0,0,0.1,79949797876543,'20050202123456')" % (i+1, i, i, (i+1) % 20, i))
+        rows.append("(21,0,'Redirect','#REDIRECT [[Article 3]]','',0,'','20050202123456','',0,1,0,0,0.1,79949797876543,'20050202123456')")
+        dirName = tempfile.mkdtemp()
+        fileName = os.path.join(dirName, "pl_cur_table.sql")
+        fo = open(fileName, "wb")
+        fo.write("-- dump\nINSERT INTO `cur` VALUES %s;\n" % ",".join(rows))
+        fo.close()
+        try:
+            redirects = {}
+            articleTitles = {}
+            # the first pass also creates the cache jobs read articles from
+            for article in wikipediasql.iterWikipediaArticles(fileName, None, True, False):
+                if article.fRedirect():
+                    redirects[article.getTitle()] = article.getRedirect()
+                else:
+                    articleTitles[article.getTitle()] = 1
+            serial = [(article.getTitle(), converted) for (article, converted) in wikiToDbConvert.iterConvertedArticles(fileName, None, redirects, articleTitles)]
+            jobs = wikiToDbConvert.startConversionJobs(fileName, None, redirects, articleTitles, 3)
+            try:
+                parallel = [(article.getTitle(), converted) for (article, converted) in wikiToDbConvert.iterConvertedArticlesParallel(fileName, None, jobs)]
+            finally:
+                wikiToDbConvert.stopConversionJobs(jobs)
+        finally:
+            shutil.rmtree(dirName)
+        self.assertEqual(len(serial), 21)
+        self.assertEqual(parallel, serial)
+
+# emulates MySQL connection for testing ConnectionPool
+class FakeCursor:
+    def __init__(self,conn):
+        self.conn = conn
+    def execute(self,sql):
+        self.conn.executed.append(sql)
+    def fetchall(self):
+        return self.conn.rows
+    def fetchmany(self,size):
+        return self.conn.rows[:size]
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self,dbName):
+        self.dbName = dbName
+        self.fAlive = True
+        self.fClosed = False
+        self.executed = []
+        # returned by every query
+        self.rows = []
+    def ping(self):
+        if not self.fAlive:
+            raise Exception("MySQL server has gone away")
+    def close(self):
+        self.fClosed = True
+    def cursor(self):
+        return FakeCursor(self)
+    def escape_string(self,txt):
+        return txt.replace("'", "\\'")
+
+class ConnectionPoolTests(unittest.TestCase):
+    def test_reuse(self):
+        pool = ConnectionPool.ConnectionPool(FakeConnection, 2)
+        conn = pool.getConnection("db1")
+        self.assertEqual(conn.dbName, "db1")
+        pool.releaseConnection("db1", conn)
+        self.assertEqual(pool.getConnection("db1"), conn)
+        # connections are kept per database
+        conn2 = pool.getConnection("db2")
+        self.assertEqual(conn2.dbName, "db2")
+
+    def test_reconnect(self):
+        pool = ConnectionPool.ConnectionPool(FakeConnection, 2)
+        conn = pool.getConnection("db1")
+        pool.releaseConnection("db1", conn)
+        # emulate MySQL restart
+        conn.fAlive = False
+        savedIdleTime = ConnectionPool.HEALTH_CHECK_IDLE_TIME
+        ConnectionPool.HEALTH_CHECK_IDLE_TIME = -1
+        try:
+            conn2 = pool.getConnection("db1")
+        finally:
+            ConnectionPool.HEALTH_CHECK_IDLE_TIME = savedIdleTime
+        self.assertNotEqual(conn, conn2)
+        self.assertEqual(conn.fClosed, True)
+
+    def test_discard(self):
+        pool = ConnectionPool.ConnectionPool(FakeConnection, 1)
+        conn = pool.getConnection("db1")
+        pool.discardConnection("db1", conn)
+        self.assertEqual(conn.fClosed, True)
+        # discarding frees the slot so this doesn't block
+        conn2 = pool.getConnection("db1")
+        self.assertNotEqual(conn, conn2)
+
+class LruCacheTests(unittest.TestCase):
+    def test_getPut(self):
+        cache = LruCache.LruCache(10000)
+        self.assertEqual(cache.get("a"), None)
+        cache.put("a", "value a", 7)
+        self.assertEqual(cache.get("a"), "value a")
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_eviction(self):
+        itemSize = 100
+        cache = LruCache.LruCache(3*(itemSize+LruCache.ITEM_OVERHEAD))
+        cache.put("a", "a", itemSize)
+        cache.put("b", "b", itemSize)
+        cache.put("c", "c", itemSize)
+        # makes "b" the least recently used item
+        cache.get("a")
+        cache.put("d", "d", itemSize)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), "a")
+        self.assertEqual(cache.get("d"), "d")
+        self.assertEqual(cache.evictions, 1)
+        # items bigger than the whole cache are not cached at all
+        cache.put("e", "e", 10*itemSize)
+        self.assertEqual(cache.get("e"), None)
+        self.assertEqual(cache.getItemsCount(), 3)
+
+    def test_removeMatching(self):
+        cache = LruCache.LruCache(10000)
+        cache.put(("db1","a"), "a", 1)
+        cache.put(("db2","a"), "a", 1)
+        cache.put(("db1","b"), "b", 1)
+        removed = cache.removeMatching(lambda key: key[0] == "db1")
+        self.assertEqual(removed, 2)
+        self.assertEqual(cache.get(("db1","a")), None)
+        self.assertEqual(cache.get(("db2","a")), "a")
+
+    def test_ttl(self):
+        cache = LruCache.LruCache(10000, 0.1)
+        cache.put("a", "a", 1)
+        self.assertEqual(cache.get("a"), "a")
+        time.sleep(0.2)
+        self.assertEqual(cache.peek("a"), None)
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.expirations, 1)
+        self.assertEqual(cache.getItemsCount(), 0)
+
+class RedirectsMapTests(unittest.TestCase):
+    def test_getRedirect(self):
+        pairs = [("seattle, washington", "Seattle"), ("emerald city", "Seattle"), ("usa", "United States")]
+        redirects = RedirectsMap.RedirectsMap(pairs)
+        self.assertEqual(redirects.getCount(), 3)
+        self.assertEqual(redirects.getRedirect("emerald city"), "Seattle")
+        self.assertEqual(redirects.getRedirect("usa"), "United States")
+        self.assertEqual(redirects.getRedirect("seattle"), None)
+        self.assertEqual(redirects.getRedirect("zzz"), None)
+        self.assertEqual(redirects.getMemoryUsage() > 0, True)
+
+class TitleKeysTests(unittest.TestCase):
+    def test_normalizeTitle(self):
+        self.assertEqual(iPediaServer.normalizeTitle("New York  "), "new york")
+        self.assertEqual(iPediaServer.normalizeTitle("Caf\xc9"), "caf\xe9")
+        # multiplication sign has no lower-case version
+        self.assertEqual(iPediaServer.normalizeTitle("2\xd73"), "2\xd73")
+        self.assertNotEqual(iPediaServer.normalizeTitle("Cafe"), iPediaServer.normalizeTitle("Caf\xe9"))
+
+    def test_foldTitle(self):
+        fold = iPediaServer.foldTitle
+        self.assertEqual(fold("Caf\xe9 "), "CAFE")
+        self.assertEqual(fold("cafe"), fold("CAF\xc9"))
+        self.assertEqual(fold("\xe4"), fold("\xc6"))
+        self.assertNotEqual(fold("a"), fold("\xe4"))
+        self.assertEqual(fold("\xfc"), "Y")
+        self.assertEqual(fold("2\xd73"), "2\xd73")
+        # folding a key again doesn't change it
+        self.assertEqual(fold(fold("\xc5ngstr\xf6m")), fold("\xc5ngstr\xf6m"))
+
+# cursor returning the next list of rows from results for each query
+class ScriptedCursor:
+    def __init__(self,results):
+        self.results = results
+        self.executed = []
+    def execute(self,sql):
+        self.executed.append(sql)
+    def fetchall(self):
+        return self.results.pop(0)
+    def fetchone(self):
+        return self.results.pop(0)[0]
+    def close(self):
+        pass
+
+class FindArticlesTests(unittest.TestCase):
+    def test_accents(self):
+        db = FakeConnection("db")
+        # MySQL finds "Caf\xe9" when we ask for "Cafe"
+        cursor = ScriptedCursor([[(1, "Caf\xe9", "body")]])
+        articles = iPediaServer.findArticles(db, cursor, ["Cafe"])
+        self.assertEqual(articles, {iPediaServer.foldTitle("Cafe") : (1, "Caf\xe9", "body")})
+        self.assertEqual(len(cursor.executed), 1)
+
+    def test_redirects(self):
+        db = FakeConnection("db")
+        fold = iPediaServer.foldTitle
+        redirects = RedirectsMap.RedirectsMap([(fold("Caf\xe9 au lait"), "Coffee with milk")])
+        cursor = ScriptedCursor([[(1, "Caf\xe9", "body")], [(2, "Coffee With Milk", "milk")]])
+        articles = iPediaServer.findArticles(db, cursor, ["Cafe au Lait", "cafe"], redirects)
+        self.assertEqual(len(articles), 2)
+        self.assertEqual(articles[fold("cafe")], (1, "Caf\xe9", "body"))
+        self.assertEqual(articles[fold("Cafe au Lait")], (2, "Coffee With Milk", "milk"))
+        self.assertEqual(len(cursor.executed), 2)
+
+    def test_reverseLinks(self):
+        db = FakeConnection("db")
+        cursor = ScriptedCursor([[("cafe", "Coffee\nParis")]])
+        reverseLinks = iPediaServer.getReverseLinksForTitles(db, cursor, ["Caf\xe9"])
+        self.assertEqual(reverseLinks.get(iPediaServer.foldTitle("Caf\xe9")), "Coffee\nParis")
+
+class BatchedLogWriterTests(unittest.TestCase):
+    def test_batching(self):
+        pool = ConnectionPool.ConnectionPool(FakeConnection, 1)
+        conn = pool.getConnection("db")
+        pool.releaseConnection("db", conn)
+        writer = BatchedLogWriter.BatchedLogWriter(pool, "db", None)
+        writer.start()
+        writer.log("t1", ("a","b"), (1, "x'y"))
+        writer.log("t2", ("c",), (None,))
+        writer.log("t1", ("a","b"), (2, "z"))
+        writer.flush()
+        self.assertEqual(conn.executed, ["INSERT INTO t1 (a,b) VALUES (1,'x\\'y'),(2,'z');", "INSERT INTO t2 (c) VALUES (NULL);"])
+        writer.log("t2", ("c",), (3,))
+        writer.close()
+        self.assertEqual(conn.executed[-1], "INSERT INTO t2 (c) VALUES (3);")
+        self.assertEqual(writer.writtenCount, 4)
+
+    def test_overflow(self):
+        pool = ConnectionPool.ConnectionPool(FakeConnection, 1)
+        # writer isn't started so nothing takes records from the queue
+        writer = BatchedLogWriter.BatchedLogWriter(pool, "db", None, BatchedLogWriter.OVERFLOW_DROP, 2)
+        for i in range(5):
+            writer.log("t", ("a",), (i,))
+        self.assertEqual(writer.droppedCount, 3)
+
+class LookupCountersTests(unittest.TestCase):
+    def test_counting(self):
+        pool = ConnectionPool.ConnectionPool(FakeConnection, 1)
+        counters = LookupCounters.LookupCounters(pool, "db", None)
+        self.assertEqual(counters.getLookupsCount(1), (0,0))
+        now = time.time()
+        # lookup older than a day counts only in total
+        counters.addLookup(1, now - 2*LookupCounters.DAY_SECONDS)
+        counters.addLookup(1)
+        counters.addLookup(2)
+        self.assertEqual(counters.getLookupsCount(1), (2,1))
+        self.assertEqual(counters.getLookupsCount(2), (1,1))
+        for i in range(LookupCounters.MAX_RECENT_LOOKUPS + 5):
+            counters.addLookup(3, now)
+        self.assertEqual(counters.getLookupsCount(3), (LookupCounters.MAX_RECENT_LOOKUPS + 5, LookupCounters.MAX_RECENT_LOOKUPS))
+
+    def test_persist(self):
+        pool = ConnectionPool.ConnectionPool(FakeConnection, 1)
+        conn = pool.getConnection("db")
+        pool.releaseConnection("db", conn)
+        counters = LookupCounters.LookupCounters(pool, "db", None)
+        counters.addLookup(7, 1000)
+        counters.addLookup(7, 999)
+        counters.persist()
+        self.assertEqual(conn.executed, ["INSERT INTO lookup_counters (user_id, total_lookups, recent_lookups) VALUES (7,2,'999,1000') ON DUPLICATE KEY UPDATE total_lookups=total_lookups+VALUES(total_lookups), recent_lookups=VALUES(recent_lookups);"])
+        # nothing changed so nothing to save
+        counters.persist()
+        self.assertEqual(len(conn.executed), 1)
+        # we save the number of lookups since the last save
+        counters.addLookup(7, 1001)
+        counters.persist()
+        self.assertEqual(conn.executed[-1], "INSERT INTO lookup_counters (user_id, total_lookups, recent_lookups) VALUES (7,1,'999,1000,1001') ON DUPLICATE KEY UPDATE total_lookups=total_lookups+VALUES(total_lookups), recent_lookups=VALUES(recent_lookups);")
+
+    def test_reload(self):
+        pool = ConnectionPool.ConnectionPool(FakeConnection, 1)
+        conn = pool.getConnection("db")
+        pool.releaseConnection("db", conn)
+        counters = LookupCounters.LookupCounters(pool, "db", None)
+        now = int(time.time())
+        counters.addLookup(7, now)
+        # other processes saved lookups of user 7 and 8
+        conn.rows = [(7, 5, str(now-1)), (8, 3, "")]
+        counters.reload()
+        self.assertEqual(conn.executed[-2], "INSERT INTO lookup_counters (user_id, total_lookups, recent_lookups) VALUES (7,1,'%d') ON DUPLICATE KEY UPDATE total_lookups=total_lookups+VALUES(total_lookups), recent_lookups=VALUES(recent_lookups);" % now)
+        self.assertEqual(counters.getLookupsCount(7), (5,2))
+        self.assertEqual(counters.getLookupsCount(8), (3,0))
+
+    def test_countedRequestTypes(self):
+        # everything but a random article and reverse links is a lookup,
+        # like it was when we counted rows of request_log
+        self.assertEqual(LookupCounters.fCountedRequestType('s'), True)
+        self.assertEqual(LookupCounters.fCountedRequestType('e'), True)
+        self.assertEqual(LookupCounters.fCountedRequestType('r'), False)
+        self.assertEqual(LookupCounters.fCountedRequestType('l'), False)
+        pool = ConnectionPool.ConnectionPool(FakeConnection, 1)
+        conn = pool.getConnection("db")
+        pool.releaseConnection("db", conn)
+        counters = LookupCounters.LookupCounters(pool, "db", None)
+        # lookup_counters is empty so we count lookups in request_log
+        counters.load()
+        self.assertEqual(conn.executed[2], "SELECT user_id, COUNT(*) FROM request_log WHERE NOT (request_type IN ('r','l')) GROUP BY user_id;")
+        self.assertEqual(conn.executed[3], "SELECT user_id, UNIX_TIMESTAMP(log_date) FROM request_log WHERE NOT (request_type IN ('r','l')) AND log_date>DATE_SUB(NOW(), INTERVAL 1 DAY) ORDER BY log_date;")
+
+class IdentityCacheTests(unittest.TestCase):
+    def test_users(self):
+        cache = IdentityCache.IdentityCache()
+        self.assertEqual(cache.getCookieUser("c1"), None)
+        cache.putCookieUser("c1", 5, 'f')
+        self.assertEqual(cache.getCookieUser("c1"), (5, 'f'))
+        # the first user registered with a reg code wins
+        cache.putRegCodeUser("r1", 7, 'f')
+        cache.putRegCodeUser("r1", 9, 't')
+        self.assertEqual(cache.getRegCodeUser("r1"), (7, 'f'))
+        cache.putRegCodeUser("r1", 3, 't')
+        self.assertEqual(cache.getRegCodeUser("r1"), (3, 't'))
+        cache.clear()
+        self.assertEqual(cache.getCookieUser("c1"), None)
+        self.assertEqual(cache.getRegCodeUser("r1"), None)
+
+    def test_validRegCodes(self):
+        cache = IdentityCache.IdentityCache()
+        cache.setValidRegCodes(["a", "b"])
+        self.assertEqual(cache.fKnownValidRegCode("a"), True)
+        self.assertEqual(cache.fKnownValidRegCode("c"), False)
+        cache.addValidRegCode("c")
+        self.assertEqual(cache.fKnownValidRegCode("c"), True)
+        cache.setValidRegCodes(["b"])
+        self.assertEqual(cache.fKnownValidRegCode("a"), False)
+
+    def test_ttl(self):
+        # users disabled in the database by something else than the server
+        # stop being cached as enabled after the ttl
+        cache = IdentityCache.IdentityCache(ttl=0.1)
+        cache.putCookieUser("c1", 5, 'f')
+        cache.putRegCodeUser("r1", 7, 'f')
+        cache.setValidRegCodes(["a"])
+        cache.addValidRegCode("b")
+        self.assertEqual(cache.getCookieUser("c1"), (5, 'f'))
+        self.assertEqual(cache.fKnownValidRegCode("b"), True)
+        time.sleep(0.2)
+        self.assertEqual(cache.getCookieUser("c1"), None)
+        self.assertEqual(cache.getRegCodeUser("r1"), None)
+        self.assertEqual(cache.fKnownValidRegCode("a"), False)
+        self.assertEqual(cache.fKnownValidRegCode("b"), False)
+        # a reg code we checked in the database again
+        cache.addValidRegCode("a")
+        self.assertEqual(cache.fKnownValidRegCode("a"), True)
+
+# remembers lines it got and keeps the connection alive after each request
+class KeepAliveReceiver(ThreadedServer.LineReceiver):
+    def __init__(self):
+        ThreadedServer.LineReceiver.__init__(self)
+        self.lines = []
+        self.transport = EventServer.BufferedTransport(None, self)
+
+    def lineReceived(self, line):
+        self.lines.append(line)
+        if "" == line:
+            self.transport.write("done\n")
+            self.transport.keepAlive()
+
+class LineReceiverTests(unittest.TestCase):
+    def test_pipelined(self):
+        receiver = KeepAliveReceiver()
+        leftover = receiver.processData("a\n\nb\n\nc", False)
+        self.assertEqual(leftover, "c")
+        self.assertEqual(receiver.lines, ["a", "", "b", ""])
+        self.assertEqual(receiver.transport.takeOutput(), "done\ndone\n")
+        self.assertEqual(receiver.transport.fKeepAlive, True)
+
+    def test_eof(self):
+        receiver = KeepAliveReceiver()
+        leftover = receiver.processData("a\nb", True)
+        self.assertEqual(leftover, "")
+        self.assertEqual(receiver.lines, ["a", "b"])
+
+class ArticleResponseTests(unittest.TestCase):
+    def test_plain(self):
+        txt = iPediaServer.buildArticleResponse("Seattle", "City.\n", "Article 1\nArticle 2")
+        self.assertEqual(txt, "Format-Version: 1\nArticle-Title: Seattle\nArticle-Body: 6\nCity.\n\nReverse-Links: 19\nArticle 1\nArticle 2\n")
+        txt = iPediaServer.buildArticleResponse("Seattle", "City.\n", None)
+        self.assertEqual(txt, "Format-Version: 1\nArticle-Title: Seattle\nArticle-Body: 6\nCity.\n\n")
+
+    def test_encoding(self):
+        body = zlib.compress("City.\n")
+        reverseLinks = zlib.compress("Article 1\nArticle 2")
+        txt = iPediaServer.buildArticleResponse("Seattle", "City.\n", "Article 1\nArticle 2", iPediaServer.ENCODING_ZLIB)
+        self.assertEqual(txt, "Format-Version: 1\nArticle-Title: Seattle\nPayload-Encoding: zlib\nArticle-Body: %d\n%s\nReverse-Links: %d\n%s\n" % (len(body), body, len(reverseLinks), reverseLinks))
+
+    def test_hash(self):
+        articleHash = iPediaServer.getArticleHash("City.\n")
+        self.assertEqual(len(articleHash), 32)
+        txt = iPediaServer.buildArticleResponse("Seattle", "City.\n", None, None, articleHash)
+        self.assertEqual(txt, "Format-Version: 1\nArticle-Title: Seattle\nArticle-Hash: %s\nArticle-Body: 6\nCity.\n\n" % articleHash)
+        txt = iPediaServer.buildNotModifiedResponse("Seattle", articleHash)
+        self.assertEqual(txt, "Format-Version: 1\nArticle-Title: Seattle\nArticle-Hash: %s\nNot-Modified:\n" % articleHash)
+
+    def test_reverseLinks(self):
+        txt = iPediaServer.buildReverseLinksResponse("Seattle", "Article 1\nArticle 2")
+        self.assertEqual(txt, "Article-Title: Seattle\nReverse-Links: 19\nArticle 1\nArticle 2\n")
+        reverseLinks = zlib.compress("Article 1\nArticle 2")
+        txt = iPediaServer.buildReverseLinksResponse("Seattle", "Article 1\nArticle 2", iPediaServer.ENCODING_ZLIB)
+        self.assertEqual(txt, "Article-Title: Seattle\nPayload-Encoding: zlib\nReverse-Links: %d\n%s\n" % (len(reverseLinks), reverseLinks))
+
+class ArticlePartTests(unittest.TestCase):
+    body = "Intro.\n== History ==\nOld.\n=== Early ===\nOlder.\n"
+
+    def test_partRange(self):
+        body = ArticlePartTests.body
+        sections = ArticleSections.findSections(body)
+        getPartRange = iPediaServer.getPartRange
+        self.assertEqual(getPartRange(sections, (iPediaServer.PART_SECTION, 0), len(body)), (0, 7))
+        self.assertEqual(getPartRange(sections, (iPediaServer.PART_SECTION, 1), len(body)), (7, 26))
+        self.assertEqual(getPartRange(sections, (iPediaServer.PART_SECTION, 2), len(body)), (26, len(body)))
+        self.assertEqual(getPartRange(sections, (iPediaServer.PART_SECTION, 3), len(body)), None)
+        self.assertEqual(getPartRange(sections, (iPediaServer.PART_RANGE, 10), len(body)), (0, 10))
+        self.assertEqual(getPartRange(sections, (iPediaServer.PART_RANGE, 1000), len(body)), (0, len(body)))
+
+    def test_articlePart(self):
+        body = ArticlePartTests.body
+        toc = ArticleSections.buildToc(ArticleSections.findSections(body), len(body))
+        # a range is cut after the last complete line
+        self.assertEqual(iPediaServer.getArticlePart(body, (iPediaServer.PART_RANGE, 10)), ("Intro.\n", (0, len(body), toc)))
+        self.assertEqual(iPediaServer.getArticlePart(body, (iPediaServer.PART_SECTION, 1)), ("== History ==\nOld.\n", (7, len(body), toc)))
+        self.assertEqual(iPediaServer.getArticlePart(body, (iPediaServer.PART_SECTION, 5)), (None, None))
+
+    def test_readArticlePart(self):
+        body = ArticlePartTests.body
+        sections = ArticleSections.findSections(body)
+        toc = ArticleSections.buildToc(sections, len(body))
+        partInfoRow = (3, "Seattle", "hash", ArticleSections.formatSections(sections), len(body))
+        cursor = ScriptedCursor([[("=== Early ===\nOlder.\n",)]])
+        part = iPediaServer.readArticlePart(cursor, partInfoRow, (iPediaServer.PART_SECTION, 2))
+        self.assertEqual(part, ("Seattle", "hash", "=== Early ===\nOlder.\n", (26, len(body), toc)))
+        # SUBSTRING() counts from 1
+        self.assertEqual(cursor.executed, ["SELECT SUBSTRING(body, 27, %d) FROM articles WHERE id=3;" % (len(body) - 26)])
+
+    def test_response(self):
+        body = ArticlePartTests.body
+        (bodyPart, partInfo) = iPediaServer.getArticlePart(body, (iPediaServer.PART_SECTION, 1))
+        txt = iPediaServer.buildArticleResponse("Seattle", bodyPart, None, None, None, partInfo)
+        self.assertEqual(txt, "Format-Version: 1\nArticle-Title: Seattle\nArticle-Part: 7 %d\nArticle-Body: 19\n== History ==\nOld.\n\nTable-Of-Contents: %d\n%s\n" % (len(body), len(partInfo[2]), partInfo[2]))
+
+class SearchCursorTests(unittest.TestCase):
+    def test_roundTrip(self):
+        cursor = iPediaServer.formatSearchCursor("new-york city", 20, 10)
+        self.assertEqual(iPediaServer.parseSearchCursor(cursor), ("new-york city", 20, 10))
+        cursor = iPediaServer.formatSearchCursor("caf\xe9\n", 1, 1)
+        self.assertEqual(iPediaServer.parseSearchCursor(cursor), ("caf\xe9\n", 1, 1))
+
+    def test_invalid(self):
+        for cursor in ["", "20-10", "x-10-61", "20-x-61", "20-10-6", "20-10-zz", "20-10-", "0-10-61", "20-0-61", "-5-10-61"]:
+            self.assertEqual(iPediaServer.parseSearchCursor(cursor), None)
+
+class ArticleSectionsTests(unittest.TestCase):
+    body = "Intro.\n== History ==\nOld.\n=== Early ===\nOlder.\n== Bad =\n"
+
+    def test_findSections(self):
+        sections = ArticleSections.findSections(ArticleSectionsTests.body)
+        self.assertEqual(sections, [(7, 2, "History"), (26, 3, "Early")])
+        self.assertEqual(ArticleSections.parseSections(ArticleSections.formatSections(sections)), sections)
+        self.assertEqual(ArticleSections.parseSections(""), [])
+
+    def test_ranges(self):
+        body = ArticleSectionsTests.body
+        sections = ArticleSections.findSections(body)
+        self.assertEqual(ArticleSections.getSectionsCount(sections), 3)
+        self.assertEqual(ArticleSections.getSectionRange(sections, 0, len(body)), (0, 7))
+        self.assertEqual(ArticleSections.getSectionRange(sections, 2, len(body)), (26, len(body)))
+        self.assertEqual(ArticleSections.buildToc(sections, len(body)), "0 7 \n2 19 History\n3 %d Early" % (len(body) - 26))
+        self.assertEqual(ArticleSections.cutAtLineEnd("abc\nde"), "abc\n")
+        self.assertEqual(ArticleSections.cutAtLineEnd("abc"), "abc")
+
+class TitleFilterTests(unittest.TestCase):
+    def test_filter(self):
+        titleFilter = TitleFilter.TitleFilter(1000)
+        for i in range(1000):
+            titleFilter.add("title %d" % i)
+        for i in range(1000):
+            self.assert_(titleFilter.fMightContain("title %d" % i))
+        falsePositives = 0
+        for i in range(1000, 11000):
+            if titleFilter.fMightContain("title %d" % i):
+                falsePositives += 1
+        self.assert_(falsePositives < 300)
+        self.assert_(titleFilter.getFalsePositiveRate() < 0.02)
+        self.assertEqual(titleFilter.getMemoryUsage(), 1250)
+
+class SuggestionIndexTests(unittest.TestCase):
+    titles = ["Seattle", "Seattle Mariners", "Emerald City", "New York City", "York", "Article 1", "Article 2"]
+
+    def getIndex(self):
+        pairs = [(title.lower(), title) for title in SuggestionIndexTests.titles]
+        return SuggestionIndex.buildSuggestionIndex(pairs)
+
+    def test_suggestions(self):
+        index = self.getIndex()
+        self.assertEqual(index.getCount(), 7)
+        self.assertEqual(index.getSuggestions("seatle"), ["Seattle"])
+        self.assertEqual(index.getSuggestions("new yrok city"), ["New York City"])
+        self.assertEqual(index.getSuggestions("artcle 2")[0], "Article 2")
+        self.assertEqual(index.getSuggestions("qqq"), [])
+        self.assertEqual(index.getSuggestions(""), [])
+
+    def test_saveLoad(self):
+        fileName = tempfile.mktemp()
+        try:
+            self.getIndex().save(fileName, (7, 10))
+            index = SuggestionIndex.loadSuggestionIndex(fileName, (7, 10))
+            self.assertEqual(index.getCount(), 7)
+            self.assertEqual(index.getSuggestions("emrald city"), ["Emerald City"])
+            # built from a different database
+            self.assertEqual(SuggestionIndex.loadSuggestionIndex(fileName, (8, 11)), None)
+        finally:
+            os.remove(fileName)
+        self.assertEqual(SuggestionIndex.loadSuggestionIndex(fileName), None)
+
 if __name__ == "__main__":
     unittest.main()
@@ -5,9 +5,9 @@
 #  Unit testing for server
 #  see http://diveintopython.org/unit_testing/index.html for more info on unittest
 
-import string,unittest
+import string,unittest,zlib,md5
 import client
-from client import getRequestHandleCookie, Response, Request, g_exampleDeviceInfo, g_uniqueDeviceInfo, g_nonUniqueDeviceInfo
+from client import getRequestHandleCookie, getResponsesKeepAlive, parseArticlesPayload, Response, Request, g_exampleDeviceInfo, g_uniqueDeviceInfo, g_nonUniqueDeviceInfo
 import iPediaFields
 from iPediaServer import *
 
@@ -349,6 +349,225 @@ class ServerTests(unittest.TestCase):
         self.getResponse([iPediaFields.transactionId, iPediaFields.availableLangs])
         self.assertEqual("en de fr", self.rsp.getField(iPediaFields.availableLangs))
 
+    # requests sent over one connection are answered in order and the
+    # connection is closed after a request without Keep-Alive
+    def test_KeepAlive(self):
+        req1 = getRequestHandleCookie(iPediaFields.getArticleCount, None)
+        req1.addField(iPediaFields.keepAlive, None)
+        req2 = getRequestHandleCookie(iPediaFields.getDatabaseTime, None)
+        (rsp1, rsp2) = getResponsesKeepAlive([req1, req2])
+        self.assertFieldsExist(rsp1, [iPediaFields.transactionId, iPediaFields.articleCount, iPediaFields.keepAlive])
+        self.assertEqual(rsp1.getField(iPediaFields.transactionId), req1.transactionId)
+        self.assertFieldsExist(rsp2, [iPediaFields.transactionId, iPediaFields.databaseTime])
+        self.assertEqual(rsp2.getField(iPediaFields.transactionId), req2.transactionId)
+        self.assertFieldDoesntExist(rsp2, iPediaFields.keepAlive)
+
+    # articles are sent in the order of titles in Get-Articles, redirects are
+    # followed and titles we don't have aren't searched for
+    def test_GetArticles(self):
+        titles = ["Seattle", "emerald city", "asdfasdflkj324;l1kjasd13214aasdf341l324"]
+        self.req = getRequestHandleCookie(iPediaFields.getArticles, string.join(titles, "|"))
+        self.getResponse([iPediaFields.transactionId,iPediaFields.cookie,iPediaFields.articles])
+        entries = parseArticlesPayload(self.rsp.getField(iPediaFields.articles))
+        self.assertEqual([entry[iPediaFields.requestedTitle] for entry in entries], titles)
+        for entry in entries[:2]:
+            self.assertEqual(entry[iPediaFields.articleTitle], "Seattle")
+            self.assertEqual(entry[iPediaFields.formatVersion], DEFINITION_FORMAT_VERSION)
+            self.assertEqual(entry.has_key(iPediaFields.articleBody), True)
+            self.assertEqual(entry.has_key(iPediaFields.reverseLinks), True)
+        self.assertEqual(entries[2].has_key(iPediaFields.notFound), True)
+        self.assertEqual(entries[2].has_key(iPediaFields.articleBody), False)
+
+    # with Accept-Encoding we get the same article, compressed
+    def test_AcceptEncoding(self):
+        self.req = getRequestHandleCookie(iPediaFields.getArticle, "seattle")
+        self.getResponse([iPediaFields.articleBody,iPediaFields.reverseLinks])
+        self.assertFieldDoesntExist(self.rsp, iPediaFields.payloadEncoding)
+        body = self.rsp.getField(iPediaFields.articleBody)
+        reverseLinks = self.rsp.getField(iPediaFields.reverseLinks)
+        self.req = getRequestHandleCookie(iPediaFields.getArticle, "seattle")
+        self.req.addField(iPediaFields.acceptEncoding, "gzip zlib")
+        self.getResponse([iPediaFields.payloadEncoding,iPediaFields.articleBody,iPediaFields.reverseLinks])
+        self.assertFieldEqual(self.rsp, iPediaFields.payloadEncoding, "zlib")
+        self.assertEqual(zlib.decompress(self.rsp.getField(iPediaFields.articleBody)), body)
+        self.assertEqual(zlib.decompress(self.rsp.getField(iPediaFields.reverseLinks)), reverseLinks)
+
+    # encodings we don't know are ignored
+    def test_AcceptEncodingUnknown(self):
+        self.req = getRequestHandleCookie(iPediaFields.getArticle, "seattle")
+        self.req.addField(iPediaFields.acceptEncoding, "gzip")
+        self.getResponse([iPediaFields.articleBody])
+        self.assertFieldDoesntExist(self.rsp, iPediaFields.payloadEncoding)
+
+    # we get Article-Hash of the article and Not-Modified when we send it back
+    def test_ArticleHash(self):
+        self.req = getRequestHandleCookie(iPediaFields.getArticle, "seattle")
+        self.req.addField(iPediaFields.acceptArticleHash, None)
+        self.getResponse([iPediaFields.articleTitle,iPediaFields.articleHash,iPediaFields.articleBody])
+        articleHash = self.rsp.getField(iPediaFields.articleHash)
+        self.assertEqual(articleHash, md5.new(self.rsp.getField(iPediaFields.articleBody)).hexdigest())
+        self.req = getRequestHandleCookie(iPediaFields.getArticle, "seattle")
+        self.req.addField(iPediaFields.articleHash, articleHash)
+        self.getResponse([iPediaFields.formatVersion,iPediaFields.articleTitle,iPediaFields.articleHash,iPediaFields.notModified])
+        self.assertFieldsDontExist(self.rsp, [iPediaFields.articleBody,iPediaFields.reverseLinks])
+        self.assertFieldEqual(self.rsp, iPediaFields.articleHash, articleHash)
+
+    # an article that changed is sent with its new hash
+    def test_ArticleHashModified(self):
+        self.req = getRequestHandleCookie(iPediaFields.getArticle, "seattle")
+        self.req.addField(iPediaFields.articleHash, "0" * 32)
+        self.getResponse([iPediaFields.articleTitle,iPediaFields.articleHash,iPediaFields.articleBody,iPediaFields.reverseLinks])
+        self.assertFieldDoesntExist(self.rsp, iPediaFields.notModified)
+        self.assertEqual(self.rsp.getField(iPediaFields.articleHash), md5.new(self.rsp.getField(iPediaFields.articleBody)).hexdigest())
+
+    # return a list of (level, size, title) tuples from Table-Of-Contents
+    def getTableOfContents(self):
+        toc = []
+        for line in self.rsp.getField(iPediaFields.tableOfContents).split("\n"):
+            (level,size,title) = line.split(" ",2)
+            toc.append((int(level),int(size),title))
+        return toc
+
+    # return (offset, length of the whole body) from Article-Part
+    def getArticlePart(self):
+        (offset,bodyLen) = self.rsp.getField(iPediaFields.articlePart).split()
+        return (int(offset),int(bodyLen))
+
+    # we get the beginning of the article, cut after the last complete line
+    def test_ArticleRange(self):
+        self.req = getRequestHandleCookie(iPediaFields.getArticle, "seattle")
+        self.req.addField(iPediaFields.articleRange, "100")
+        self.getResponse([iPediaFields.articleTitle,iPediaFields.articlePart,iPediaFields.articleBody,iPediaFields.tableOfContents])
+        body = self.rsp.getField(iPediaFields.articleBody)
+        (offset,bodyLen) = self.getArticlePart()
+        self.assertEqual(offset, 0)
+        self.assertEqual(len(body) <= 100, True)
+        self.assertEqual(body[-1], "\n")
+        # reverse links are only sent with the end of the article
+        self.assertFieldDoesntExist(self.rsp, iPediaFields.reverseLinks)
+        toc = self.getTableOfContents()
+        self.assertEqual(toc[0][0], 0)
+        self.assertEqual(bodyLen, reduce(lambda total,section: total+section[1], toc, 0))
+
+    # sections follow each other as described in Table-Of-Contents
+    def test_ArticleSection(self):
+        self.req = getRequestHandleCookie(iPediaFields.getArticle, "seattle")
+        self.req.addField(iPediaFields.articleSection, "1")
+        self.getResponse([iPediaFields.articleTitle,iPediaFields.articlePart,iPediaFields.articleBody,iPediaFields.tableOfContents])
+        toc = self.getTableOfContents()
+        (offset,bodyLen) = self.getArticlePart()
+        self.assertEqual(offset, toc[0][1])
+        body = self.rsp.getField(iPediaFields.articleBody)
+        self.assertEqual(len(body), toc[1][1])
+        self.assertEqual(body.startswith("=" * toc[1][0]), True)
+        # the last section ends where the article ends
+        self.req = getRequestHandleCookie(iPediaFields.getArticle, "seattle")
+        self.req.addField(iPediaFields.articleSection, "%d" % (len(toc)-1))
+        self.getResponse([iPediaFields.articlePart,iPediaFields.articleBody,iPediaFields.reverseLinks])
+        (offset,bodyLen) = self.getArticlePart()
+        self.assertEqual(offset + len(self.rsp.getField(iPediaFields.articleBody)), bodyLen)
+
+    def test_ArticleSectionInvalid(self):
+        self.req = getRequestHandleCookie(iPediaFields.getArticle, "seattle")
+        self.req.addField(iPediaFields.articleSection, "100000")
+        self.getResponse([iPediaFields.transactionId,iPediaFields.error])
+        self.assertError(ServerErrors.malformedRequest)
+        # range and section can't be sent together
+        self.req = getRequestHandleCookie(iPediaFields.getArticle, "seattle")
+        self.req.addField(iPediaFields.articleRange, "100")
+        self.req.addField(iPediaFields.articleSection, "1")
+        self.getResponse([iPediaFields.transactionId,iPediaFields.error])
+        self.assertError(ServerErrors.malformedRequest)
+
+    # with Lazy-Reverse-Links we get the same reverse links with
+    # Get-Reverse-Links
+    def test_LazyReverseLinks(self):
+        self.req = getRequestHandleCookie(iPediaFields.getArticle, "seattle")
+        self.getResponse([iPediaFields.articleTitle,iPediaFields.articleBody,iPediaFields.reverseLinks])
+        title = self.rsp.getField(iPediaFields.articleTitle)
+        reverseLinks = self.rsp.getField(iPediaFields.reverseLinks)
+        self.req = getRequestHandleCookie(iPediaFields.getArticle, "seattle")
+        self.req.addField(iPediaFields.lazyReverseLinks, None)
+        self.getResponse([iPediaFields.articleTitle,iPediaFields.articleBody])
+        self.assertFieldDoesntExist(self.rsp, iPediaFields.reverseLinks)
+        self.req = getRequestHandleCookie(iPediaFields.getReverseLinks, title)
+        self.getResponse([iPediaFields.transactionId,iPediaFields.articleTitle,iPediaFields.reverseLinks])
+        self.assertFieldEqual(self.rsp, iPediaFields.articleTitle, title)
+        self.assertFieldEqual(self.rsp, iPediaFields.reverseLinks, reverseLinks)
+        self.assertFieldDoesntExist(self.rsp, iPediaFields.articleBody)
+
+    def test_GetReverseLinksNotFound(self):
+        self.req = getRequestHandleCookie(iPediaFields.getReverseLinks, "asdfasdflkj324;l1kjasd13214aasdf341l324")
+        self.getResponse([iPediaFields.transactionId,iPediaFields.notFound])
+
+    def test_GetReverseLinksWithRandom(self):
+        self.req = getRequestHandleCookie(iPediaFields.getReverseLinks, "Seattle")
+        self.req.addField(iPediaFields.getRandom, None)
+        self.getResponse([iPediaFields.transactionId,iPediaFields.error])
+        self.assertError(ServerErrors.malformedRequest)
+
+    # return a list of titles from Search-Results
+    def getSearchResults(self):
+        return self.rsp.getField(iPediaFields.searchResults).split("\n")
+
+    # pages of search results follow each other
+    def test_SearchPages(self):
+        self.req = getRequestHandleCookie(iPediaFields.search, "seattle")
+        self.req.addField(iPediaFields.searchPageSize, "20")
+        self.getResponse([iPediaFields.articleTitle,iPediaFields.searchResults,iPediaFields.searchCursor])
+        self.assertFieldEqual(self.rsp, iPediaFields.articleTitle, "seattle")
+        titles = self.getSearchResults()
+        self.assertEqual(len(titles), 20)
+        self.req = getRequestHandleCookie(iPediaFields.search, "seattle")
+        self.req.addField(iPediaFields.searchPageSize, "10")
+        self.getResponse([iPediaFields.searchResults,iPediaFields.searchCursor])
+        self.assertEqual(self.getSearchResults(), titles[:10])
+        # page size of the next page is the one from Search unless we send it
+        self.req = getRequestHandleCookie(iPediaFields.searchNext, self.rsp.getField(iPediaFields.searchCursor))
+        self.getResponse([iPediaFields.articleTitle,iPediaFields.searchResults,iPediaFields.searchCursor])
+        self.assertFieldEqual(self.rsp, iPediaFields.articleTitle, "seattle")
+        self.assertEqual(self.getSearchResults(), titles[10:20])
+        self.req = getRequestHandleCookie(iPediaFields.searchNext, self.rsp.getField(iPediaFields.searchCursor))
+        self.req.addField(iPediaFields.searchPageSize, "5")
+        self.getResponse([iPediaFields.searchResults])
+        self.assertEqual(len(self.getSearchResults()), 5)
+
+    def test_SearchNextInvalid(self):
+        self.req = getRequestHandleCookie(iPediaFields.searchNext, "not a cursor")
+        self.getResponse([iPediaFields.transactionId,iPediaFields.error])
+        self.assertError(ServerErrors.malformedRequest)
+        self.req = getRequestHandleCookie(iPediaFields.search, "seattle")
+        self.req.addField(iPediaFields.searchPageSize, "0")
+        self.getResponse([iPediaFields.transactionId,iPediaFields.error])
+        self.assertError(ServerErrors.malformedRequest)
+
+    # we don't have that many results
+    def test_SearchNextExpired(self):
+        self.req = getRequestHandleCookie(iPediaFields.searchNext, formatSearchCursor("seattle", 1000000, 10))
+        self.getResponse([iPediaFields.transactionId,iPediaFields.error])
+        self.assertError(ServerErrors.searchCursorExpired)
+
+    # a misspelled title gets titles similar to it instead of full-text search
+    def test_AcceptSuggestions(self):
+        self.req = getRequestHandleCookie(iPediaFields.getArticle, "seatle")
+        self.req.addField(iPediaFields.acceptSuggestions, None)
+        self.getResponse([iPediaFields.transactionId,iPediaFields.articleTitle,iPediaFields.suggestions])
+        self.assertFieldEqual(self.rsp, iPediaFields.articleTitle, "seatle")
+        self.assertFieldsDontExist(self.rsp, [iPediaFields.articleBody,iPediaFields.searchResults,iPediaFields.notFound])
+        suggestions = self.rsp.getField(iPediaFields.suggestions).split("\n")
+        self.assertEqual("Seattle" in suggestions, True)
+
+    # without Accept-Suggestions we don't send them
+    def test_NoSuggestions(self):
+        self.req = getRequestHandleCookie(iPediaFields.getArticle, "seatle")
+        self.getResponse([iPediaFields.transactionId])
+        self.assertFieldDoesntExist(self.rsp, iPediaFields.suggestions)
+        # an article we have is sent as usual
+        self.req = getRequestHandleCookie(iPediaFields.getArticle, "seattle")
+        self.req.addField(iPediaFields.acceptSuggestions, None)
+        self.getResponse([iPediaFields.articleTitle,iPediaFields.articleBody])
+        self.assertFieldDoesntExist(self.rsp, iPediaFields.suggestions)
+
     # verify that a registered user doesn't trigger lookup limits
     def test_RegisteredNoLookupLimits(self):
         # TODO:
@@ -8,12 +8,33 @@
 import sys,traceback,re,unicodedata,entities, string
 import arsutils
 
+# compiled regular expressions used by stripBlocks() and replaceTagList() so
+# that we don't compile them for each article
+g_blockRes = {}
+g_tagRes = {}
+
+def getBlockRe(startPattern, endPattern):
+    global g_blockRes
+    key = (startPattern, endPattern)
+    if not g_blockRes.has_key(key):
+        g_blockRes[key] = re.compile(r"(%s)|(%s)" % key, re.I+re.S)
+    return g_blockRes[key]
+
+def getTagRe(tag):
+    global g_tagRes
+    if not g_tagRes.has_key(tag):
+        g_tagRes[tag] = re.compile(r'<(/)?%s(\s+.*?)?>' % tag, re.I)
+    return g_tagRes[tag]
+
+# remove blocks that start with startPattern and end with endPattern
+# (counting nested blocks). We collect parts of the text between blocks and
+# join them once, because slicing the text for every block takes time
+# proportional to the number of blocks times the size of the text
 def stripBlocks(text, startPattern, endPattern):
     opened=0
     spanStart=-1
     spans=[]
-    pattern=r"(%s)|(%s)" % (startPattern, endPattern)
-    blockRe=re.compile(pattern, re.I+re.S)
+    blockRe=getBlockRe(startPattern, endPattern)
     for match in blockRe.finditer(text):
         if match.lastindex==1: # This means it's a start tag
             if not opened:
@@ -27,36 +48,41 @@ def stripBlocks(text, startPattern, endPattern):
                 opened=0
     if opened:
         spans.append((spanStart, len(text)))
-    spans.reverse()             # Iterate from end so that text indices remain valid when we slice and concatenate text
-    for span in spans:
-        start, end=span
-        text=text[:start]+text[end:]
-    return text
+    if 0 == len(spans):
+        return text
+    parts=[]
+    pos=0
+    for (start, end) in spans:
+        parts.append(text[pos:start])
+        pos=end
+    parts.append(text[pos:])
+    return string.join(parts, "")
 
 def stripTagBlocks(text, blockElem):
     return stripBlocks(text, '<%s.*?>' % blockElem, '</%s>' % blockElem)
 
+# replace all matches of regExp in text with repl, except those matching
+# exceptionRe. Like stripBlocks() we collect parts of the result and
+# join them once
 def replaceRegExp(text, regExp, repl, exceptionRe = None):
-    match=regExp.search(text)
-    while match:
-        pos = match.end()
-        
+    parts=[]
+    pos=0
+    for match in regExp.finditer(text):
         if (exceptionRe is None) or not exceptionRe.match(match.group()):
 #            print "Replacing: ", match.group(), " with: ", repl
-            text=text[0:match.start()]+repl+text[match.end():]
-            matchLength = pos - match.start()
-            replLength = len(repl)
-            pos += (replLength - matchLength)
+            parts.append(text[pos:match.start()])
+            parts.append(repl)
+            pos=match.end()
         else:
             print "Not replacing link: ", match.group()
-                
-        match=regExp.search(text, pos)
-        
-    return text
+    if 0 == len(parts):
+        return text
+    parts.append(text[pos:])
+    return string.join(parts, "")
 
 def replaceTagList(text, tagList, repl):
     for tag in tagList:
-        text=replaceRegExp(text, re.compile(r'<(/)?%s(\s+.*?)?>' % tag, re.I), repl)
+        text=replaceRegExp(text, getTagRe(tag), repl)
     return text
 
 # this is a hack to change "&sup2" entities without trailing ";" into "&sup2;"
@@ -236,9 +262,19 @@ def replaceWikiMacros(text):
 #    print sys.exc_info()[1]
 #    print traceback.print_tb(sys.exc_info()[2])
 
-# main function: given the text of wikipedia article in original wikipedia
-# format, return the article in our own format
-def convertArticle(term, text):
+# html tags we replace with wikipedia markup (or remove) and their replacements
+tagReplacements = [
+    (['b', 'strong'], "'''"),
+    (['em', 'i', 'cite'], "''"),
+    (['hr'], '----'),
+    (['p'], '<br>'),
+    (['dfn', 'code', 'samp', 'kbd', 'var', 'abbr', 'acronym', 'blockquote', 'q', 'pre', 'ins', 'del', 'dir', 'menu', 'img', 'object', 'big', 'span', 'applet', 'font', 'basefont', 'tr', 'td', 'table', 'center', 'div'], ''),
+]
+
+# given the text of wikipedia article in original wikipedia format, return
+# the article in our own format. Applies conversion rules one after another
+# to the whole text. convertArticle() does the same in one pass over the text
+def convertArticleMultiPass(term, text):
     try:
         text=text.replace('__NOTOC__', '')
         text=fixSup2(text)
@@ -261,14 +297,11 @@ def convertArticle(term, text):
 
         text=replaceRegExp(text, scriptRe, '')
 
-        text=replaceTagList(text, ['b', 'strong'], "'''")
-        text=replaceTagList(text, ['em', 'i', 'cite'], "''")
-        text=replaceTagList(text, ['hr'], '----')
-        text=replaceTagList(text, ['p'], '<br>')
-        text=replaceTagList(text, ['dfn', 'code', 'samp', 'kbd', 'var', 'abbr', 'acronym', 'blockquote', 'q', 'pre', 'ins', 'del', 'dir', 'menu', 'img', 'object', 'big', 'span', 'applet', 'font', 'basefont', 'tr', 'td', 'table', 'center', 'div'], '')
+        for (tagList, repl) in tagReplacements:
+            text=replaceTagList(text, tagList, repl)
         text=replaceRegExp(text, badLinkRe, '', supportedLanguagesRe())
-        text=entities.convertNamedEntities(term, text)
-        text=entities.convertNumberedEntities(term, text)
+        text=entities.convertNamedEntities(text)
+        text=entities.convertNumberedEntities(text)
         text=stripMultipleNewLines(text)
         text=text.strip()
         text+='\n'
@@ -278,6 +311,375 @@ def convertArticle(term, text):
         print arsutils.exceptionAsStr(ex)
         return ''
 
+# Single-pass conversion.
+# We scan the text once looking for places where one of the rules of
+# convertArticleMultiPass() might apply (convTokenRe), decide what to do there
+# and append the result to a list that we join at the end. Text between such
+# places is copied to the list as is. Only replacing multiple empty lines
+# with one is done on the result, because removed text can leave empty lines
+# next to each other.
+# convertArticleMultiPass() applies a rule only after the rules before it
+# were applied to the whole text. We mimic that where it matters for real
+# articles (e.g. when looking for the end of a div block we skip comments and
+# templates, which were removed before) but when markup is badly nested
+# across rules (e.g. a comment that ends inside a template) the results can
+# differ.
+
+# places where a rule might apply
+convTokenRe = re.compile(r"\[\[|\{\{|\{\||<|&|__NOTOC__|\r")
+# places that matter when looking for the end of a block
+blockTokenRe = re.compile(r"\[\[|\{\{|\{\||\|\}|<")
+
+# kinds of blocks we remove, in the order convertArticleMultiPass() removes them
+BLOCK_DIV = 0
+BLOCK_TABLE = 1
+BLOCK_WIKI_TABLE = 2
+blockKinds = { "div" : BLOCK_DIV, "table" : BLOCK_TABLE }
+# start tag of a block is from here to the next ">"
+blockStartRe = re.compile(r"<(div|table)", re.I)
+blockEndRe = re.compile(r"</(div|table)>", re.I)
+
+wikiMacroStartRe = re.compile(r"\{\{((msg)|(subst))\:", re.I)
+
+# starts and ends of things that can span many lines. We look for the end
+# separately (with MatchFinder) instead of using e.g. commentRe or scriptRe,
+# which would look for it from every start
+tagEndRe = re.compile(">")
+commentEndRe = re.compile("-->")
+templateEndRe = re.compile(r"\}\}")
+linkEndRe = re.compile(r"\]\]")
+linkTokenRe = re.compile(r"\[\[|\]\]")
+scriptStartRe = re.compile("<script", re.I)
+scriptEndRe = re.compile("</script>", re.I)
+# badLinkRe up to the ":"
+badLinkStartRe = re.compile(r"\[\[((\w+?(-\w\w)?)|(simple)|(image)|(media)|(tokipona)):", re.I)
+
+# return a dictionary mapping tag names in tagReplacements to their replacements
+def getTagReplacementsDict():
+    replacements = {}
+    for (tagList, repl) in tagReplacements:
+        for tag in tagList:
+            replacements[tag] = repl
+    return replacements
+
+tagReplacementsDict = getTagReplacementsDict()
+# matches the same as replaceTagList() with any of the tags
+tagRe = re.compile(r"<(/)?(%s)(\s+.*?)?>" % string.join(tagReplacementsDict.keys(), "|"), re.I)
+
+namedEntityRe = re.compile(r"&(\w+);")
+numberedEntityRe = re.compile(r"&#(\d+);")
+# numbered entity after "&amp;"
+ampNumberedEntityRe = re.compile(r"#(\d+);")
+SUP2_ENTITY = "&sup2"
+SUP2_CHAR = entities.getNamedEntityText("sup2")
+
+# finds the first match of a regular expression at or after a given position
+# of a text. When something (e.g. a comment) doesn't end, searching for its
+# end from each of its starts would scan the rest of the text every time,
+# which takes time proportional to the number of starts times the size of
+# the text (e.g. a list page with thousands of unclosed comments). So we
+# remember where the last search for a regular expression started and what
+# it found, which is also the answer for any position up to the match
+class MatchFinder:
+    def __init__(self, text):
+        self.text = text
+        # regular expression => (position search started at, match or None)
+        self.lastSearches = {}
+        # remembered by getImageEnd()
+        self.imageEnds = {}
+
+    def search(self, regExp, pos):
+        last = self.lastSearches.get(regExp)
+        if None != last:
+            (lastPos, match) = last
+            if lastPos <= pos and (None == match or pos <= match.start()):
+                return match
+        match = regExp.search(self.text, pos)
+        self.lastSearches[regExp] = (pos, match)
+        return match
+
+# if there's a block start or end tag at pos, return a tuple (kind of block,
+# True if it's an end tag, position after the tag). Otherwise return None
+def matchBlockTag(text, pos, finder):
+    if text.startswith("{|", pos):
+        return (BLOCK_WIKI_TABLE, False, pos+2)
+    if text.startswith("|}", pos):
+        return (BLOCK_WIKI_TABLE, True, pos+2)
+    match = blockEndRe.match(text, pos)
+    if None != match:
+        return (blockKinds[match.group(1).lower()], True, match.end())
+    match = blockStartRe.match(text, pos)
+    if None != match:
+        endMatch = finder.search(tagEndRe, match.end())
+        if None != endMatch:
+            return (blockKinds[match.group(1).lower()], False, endMatch.end())
+    return None
+
+# return position after the end of wikipedia template that starts at pos
+# or -1 if it doesn't end
+def getTemplateEnd(text, pos, finder):
+    match = wikiMacroRe.match(text, pos)
+    if None != match:
+        return match.end()
+    if None != wikiMacroRe.match(text, pos+1):
+        # "{{{msg:...}}" the macro is removed first and leaves a lone "{"
+        return -1
+    searchPos = pos + 2
+    while True:
+        endMatch = finder.search(templateEndRe, searchPos)
+        if None == endMatch:
+            return -1
+        end = endMatch.start()
+        # {{msg:...}} and {{subst:...}} macros are removed before templates
+        # so the template doesn't end inside of them
+        match = wikiMacroStartRe.search(text, searchPos, end)
+        if None == match:
+            return end + 2
+        match = wikiMacroRe.match(text, match.start())
+        if None == match:
+            return end + 2
+        searchPos = match.end()
+
+# return position after the end of an image that starts at pos or -1 if it's
+# not an image. imageRe matches "[[image:" and text with links (from "[[" to
+# the next "]]") up to the first "]]" that doesn't end a link. If there's no
+# such "]]", it backtracks to the end of the last of those links. We do the
+# same without backtracking, which takes exponential time when an image
+# doesn't end and many links follow it
+def getImageEnd(text, pos, finder):
+    match = imageStartRe.match(text, pos)
+    if None == match:
+        return -1
+    pos = match.end()
+    match = finder.search(linkTokenRe, pos)
+    if None != match and "]]" == match.group():
+        # most images don't have links in them
+        return match.end()
+    # we go from link to link, so looking for the end of another image we
+    # might come to the same positions. For each of them finder.imageEnds
+    # has a tuple (end of image or -1, end of the last link after it or -1)
+    visited = []
+    while True:
+        if finder.imageEnds.has_key(pos):
+            (end, lastLinkEnd) = finder.imageEnds[pos]
+            if -1 == lastLinkEnd and len(visited) > 0:
+                # we came here from a link
+                lastLinkEnd = pos
+            break
+        visited.append(pos)
+        (end, lastLinkEnd) = (-1, -1)
+        match = finder.search(linkTokenRe, pos)
+        if None == match:
+            break
+        if "]]" == match.group():
+            end = match.end()
+            break
+        match = finder.search(linkEndRe, match.end())
+        if None == match:
+            break
+        pos = match.end()
+    # all but the first position we visited are ends of links
+    for i in range(len(visited)-1, -1, -1):
+        finder.imageEnds[visited[i]] = (end, lastLinkEnd)
+        if -1 == lastLinkEnd and i > 0:
+            lastLinkEnd = visited[i]
+    if -1 == end:
+        return lastLinkEnd
+    return end
+
+# return position after the end of a link we remove (see badLinkRe) that
+# starts at pos or -1 if there's none
+def getBadLinkEnd(text, pos, finder):
+    match = badLinkStartRe.match(text, pos)
+    if None == match:
+        return -1
+    endMatch = finder.search(linkEndRe, match.end())
+    if None == endMatch:
+        return -1
+    if None != supportedLanguagesRe().match(text, pos, endMatch.end()):
+        return -1
+    return endMatch.end()
+
+# return position after the end of a comment that starts at pos or -1 if it's
+# not a comment
+def getCommentEnd(text, pos, finder):
+    if not text.startswith("<!--", pos):
+        return -1
+    endMatch = finder.search(commentEndRe, pos+4)
+    if None == endMatch:
+        return -1
+    return endMatch.end()
+
+# return position after the end of a script that starts at pos or -1 if it's
+# not a script (see scriptRe)
+def getScriptEnd(text, pos, finder):
+    match = scriptStartRe.match(text, pos)
+    if None == match:
+        return -1
+    endMatch = finder.search(scriptEndRe, match.end())
+    if None == endMatch:
+        return -1
+    return endMatch.end()
+
+# return position after the end of a block of blockKind whose start tag ends
+# at pos (or length of the text if the block doesn't end)
+def getBlockEnd(text, pos, blockKind, finder):
+    depth = 1
+    while True:
+        match = blockTokenRe.search(text, pos)
+        if None == match:
+            return len(text)
+        start = match.start()
+        pos = start + 1
+        token = match.group()
+        # images, templates and comments were removed before blocks so
+        # block tags inside them don't count
+        if "[[" == token:
+            end = getImageEnd(text, start, finder)
+        elif "{{" == token:
+            end = getTemplateEnd(text, start, finder)
+        else:
+            end = getCommentEnd(text, start, finder)
+        if -1 != end:
+            pos = end
+            continue
+        blockTag = matchBlockTag(text, start, finder)
+        if None == blockTag:
+            continue
+        (kind, fEnd, pos) = blockTag
+        if kind == blockKind:
+            if fEnd:
+                depth -= 1
+                if 0 == depth:
+                    return pos
+            else:
+                depth += 1
+        elif kind < blockKind and not fEnd:
+            # blocks of that kind were removed before blocks of blockKind,
+            # together with our tags inside of them
+            pos = getBlockEnd(text, pos, kind, finder)
+
+# convert entity that starts at pos. Return a tuple (replacement, position
+# after the entity) or None if there's no entity at pos (or we don't change it)
+def convertEntity(text, pos):
+    if text.startswith(SUP2_ENTITY, pos):
+        # see fixSup2()
+        end = pos + len(SUP2_ENTITY)
+        if text.startswith(";", end):
+            end += 1
+        return (SUP2_CHAR, end)
+    match = namedEntityRe.match(text, pos)
+    if None != match:
+        repl = entities.getNamedEntityText(match.group(1))
+        if "&" == repl:
+            # numbered entities are converted after named entities so e.g.
+            # "&amp;#233;" becomes "&#233;" and then a letter
+            numMatch = ampNumberedEntityRe.match(text, match.end())
+            if None != numMatch:
+                numRepl = entities.getNumberedEntityText(int(numMatch.group(1)))
+                if None != numRepl:
+                    return (numRepl, numMatch.end())
+        return (repl, match.end())
+    match = numberedEntityRe.match(text, pos)
+    if None == match:
+        return None
+    repl = entities.getNumberedEntityText(int(match.group(1)))
+    if None == repl:
+        return None
+    return (repl, match.end())
+
+# main function: given the text of wikipedia article in original wikipedia
+# format, return the article in our own format
+def convertArticle(term, text):
+    try:
+        out = []
+        finder = MatchFinder(text)
+        pos = 0
+        while True:
+            match = convTokenRe.search(text, pos)
+            if None == match:
+                start = len(text)
+            else:
+                start = match.start()
+            if start > pos:
+                out.append(text[pos:start])
+            if None == match:
+                break
+            token = match.group()
+            c = token[0]
+            pos = match.end()
+            # by default we keep the token
+            repl = token
+            if "\r" == c or "_" == c:
+                # "\r" or "__NOTOC__"
+                repl = ""
+            elif "[" == c:
+                end = getImageEnd(text, start, finder)
+                if -1 == end:
+                    end = getBadLinkEnd(text, start, finder)
+                if -1 != end:
+                    repl = ""
+                    pos = end
+                else:
+                    # there might be an image or a link after the first "["
+                    repl = "["
+                    pos = start + 1
+            elif "{" == c:
+                if "{|" == token:
+                    repl = ""
+                    pos = getBlockEnd(text, pos, BLOCK_WIKI_TABLE, finder)
+                else:
+                    for (macro, macroRepl) in wikiMacrosReplacements.items():
+                        if text.startswith(macro, start):
+                            repl = macroRepl
+                            pos = start + len(macro)
+                            break
+                    else:
+                        end = getTemplateEnd(text, start, finder)
+                        if -1 == end:
+                            # there might be "{|" after the first "{"
+                            repl = "{"
+                            pos = start + 1
+                        else:
+                            repl = ""
+                            pos = end
+            elif "<" == c:
+                end = getCommentEnd(text, start, finder)
+                if -1 != end:
+                    repl = ""
+                    pos = end
+                else:
+                    # end tags of blocks that didn't start are removed with
+                    # other tags
+                    blockTag = matchBlockTag(text, start, finder)
+                    if None != blockTag and not blockTag[1]:
+                        repl = ""
+                        pos = getBlockEnd(text, blockTag[2], blockTag[0], finder)
+                    else:
+                        end = getScriptEnd(text, start, finder)
+                        if -1 != end:
+                            repl = ""
+                            pos = end
+                        else:
+                            tagMatch = tagRe.match(text, start)
+                            if None != tagMatch:
+                                repl = tagReplacementsDict[tagMatch.group(2).lower()]
+                                pos = tagMatch.end()
+            elif "&" == c:
+                entity = convertEntity(text, start)
+                if None != entity:
+                    (repl, pos) = entity
+            if len(repl) > 0:
+                out.append(repl)
+        text = multipleLinesRe.sub("\n\n", string.join(out, ""))
+        text = text.strip()
+        text+='\n'
+        return text
+    except Exception, ex:
+        print "Exception while converting term: ", term
+        print arsutils.exceptionAsStr(ex)
+        return ''
+
 class WikipediaLink:
     def __init__(self,link,name):
         self.link = link
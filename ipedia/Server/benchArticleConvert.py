@@ -0,0 +1,120 @@
+# Copyright: Krzysztof Kowalczyk
+# Owner: Andrzej Ciarkowski
+#
+# Purpose:
+#   Compare the speed of articleconvert.convertArticleMultiPass() and
+#   convertArticle() (single pass) on articles from a wikipedia sql dump
+#   (*.sql, *.sql.bz2 or *.sql.gz), grouped by the size of an article, and
+#   check that they return the same text.
+#   Then time convertArticle() on made up list pages with markup that doesn't
+#   end on every line, with n and 4*n lines. Time should grow linearly.
+#
+# Usage:
+#   -limit n : only convert first n articles
+#   -listitems n : number of lines of made up pages (default 2000)
+#   fileName - sql dump with articles to convert (like wikiToDbConvert.py,
+#              we create and use the cache of articles next to it)
+
+import sys, time, string
+import arsutils, wikipediasql, articleconvert
+
+# upper limits of sizes of articles in each group
+SIZE_BUCKETS = [1024, 4*1024, 16*1024, 64*1024, None]
+
+LIST_ITEMS_COUNT = 2000
+# lines of made up pages, with markup whose end we look for from every line
+WORST_CASE_LINES = [
+    ("comments", "* [[Item %d]] <!-- %d\n"),
+    ("templates", "* [[Item %d]] {{flag|%d\n"),
+    ("images", "* [[Image:item%d.jpg|thumb|Item %d\n"),
+    ("div tags", "* [[Item %d]] <div class=a%d\n"),
+    ("scripts", "* [[Item %d]] <script>%d\n"),
+    ("language links", "* Item %d [[fr:Item %d\n"),
+]
+
+def usageAndExit():
+    print "benchArticleConvert.py [-limit n] [-listitems n] fileName"
+    sys.exit(0)
+
+def getBucketNo(size):
+    bucketNo = 0
+    while None != SIZE_BUCKETS[bucketNo] and size >= SIZE_BUCKETS[bucketNo]:
+        bucketNo += 1
+    return bucketNo
+
+def getBucketName(bucketNo):
+    if 0 == bucketNo:
+        low = "0"
+    else:
+        low = "%dk" % (SIZE_BUCKETS[bucketNo-1] / 1024)
+    if None == SIZE_BUCKETS[bucketNo]:
+        return "%s+" % low
+    return "%s-%dk" % (low, SIZE_BUCKETS[bucketNo] / 1024)
+
+def makeWorstCasePage(line, itemsCount):
+    return string.join([line % (i, i) for i in range(itemsCount)], "")
+
+# time convertArticle() on made up pages with itemsCount and 4*itemsCount lines
+def benchWorstCases(itemsCount):
+    print "%-20s %12s %12s %8s" % ("made up page", "%d lines" % itemsCount, "%d lines" % (4*itemsCount), "ratio")
+    for (name, line) in WORST_CASE_LINES:
+        times = []
+        for count in [itemsCount, 4*itemsCount]:
+            txt = makeWorstCasePage(line, count)
+            startTime = time.time()
+            articleconvert.convertArticle(name, txt)
+            times.append(time.time() - startTime)
+        print "%-20s %10.3f s %10.3f s %7.1fx" % (name, times[0], times[1], times[1] / max(times[0], 0.001))
+
+class BucketStats:
+    def __init__(self):
+        self.count = 0
+        self.multiPassTime = 0.0
+        self.singlePassTime = 0.0
+        self.diffCount = 0
+
+def main():
+    limit = arsutils.getRemoveCmdArgInt("-limit")
+    listItemsCount = arsutils.getRemoveCmdArgInt("-listitems")
+    if None == listItemsCount:
+        listItemsCount = LIST_ITEMS_COUNT
+    if len(sys.argv) != 2:
+        usageAndExit()
+    fileName = sys.argv[1]
+
+    buckets = [BucketStats() for size in SIZE_BUCKETS]
+    diffTitles = []
+    for article in wikipediasql.iterWikipediaArticles(fileName, limit, True, False):
+        if article.fRedirect():
+            continue
+        title = article.getTitle()
+        txt = article.getText()
+        stats = buckets[getBucketNo(len(txt))]
+
+        startTime = time.time()
+        multiPass = articleconvert.convertArticleMultiPass(title, txt)
+        stats.multiPassTime += time.time() - startTime
+
+        startTime = time.time()
+        singlePass = articleconvert.convertArticle(title, txt)
+        stats.singlePassTime += time.time() - startTime
+
+        stats.count += 1
+        if multiPass != singlePass:
+            stats.diffCount += 1
+            diffTitles.append(title)
+
+    print "%-8s %8s %12s %12s %8s %6s" % ("size", "articles", "multi-pass", "single-pass", "speedup", "diff")
+    for bucketNo in range(len(buckets)):
+        stats = buckets[bucketNo]
+        if 0 == stats.count:
+            continue
+        speedup = stats.multiPassTime / max(stats.singlePassTime, 0.001)
+        print "%-8s %8d %10.2f s %10.2f s %7.1fx %6d" % (getBucketName(bucketNo), stats.count, stats.multiPassTime, stats.singlePassTime, speedup, stats.diffCount)
+    if len(diffTitles) > 0:
+        print "different result for: %s" % string.join(diffTitles[:10], ", ")
+    print
+    benchWorstCases(listItemsCount)
+
+if __name__=="__main__":
+    main()
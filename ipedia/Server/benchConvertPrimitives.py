@@ -0,0 +1,159 @@
+# Copyright: Krzysztof Kowalczyk
+# Owner: Andrzej Ciarkowski
+#
+# Purpose:
+#   Worst-case benchmark of text replacement functions in articleconvert
+#   (replaceRegExp(), replaceTagList() and stripBlocks()) used by
+#   convertArticleMultiPass(). We run them on the largest articles of a
+#   wikipedia sql dump (*.sql, *.sql.bz2 or *.sql.gz) and on a made up list
+#   page with thousands of matches, compare the time with their previous
+#   versions (which copied the whole text for each match, so they took time
+#   proportional to the number of matches times the size of the text) and
+#   check that they return the same text.
+#
+# Usage:
+#   -largest n : use n largest articles (default 20)
+#   -limit n : only look at first n articles of the dump
+#   -listitems n : number of items in made up list page (default 5000)
+#   fileName - sql dump with articles (like wikiToDbConvert.py, we create
+#              and use the cache of articles next to it)
+
+import sys, time, re, string
+import arsutils, wikipediasql, articleconvert
+
+LARGEST_COUNT = 20
+LIST_ITEMS_COUNT = 5000
+
+def usageAndExit():
+    print "benchConvertPrimitives.py [-largest n] [-limit n] [-listitems n] fileName"
+    sys.exit(0)
+
+# previous versions of articleconvert functions
+def replaceRegExpOld(text, regExp, repl, exceptionRe = None):
+    match=regExp.search(text)
+    while match:
+        pos = match.end()
+        if (exceptionRe is None) or not exceptionRe.match(match.group()):
+            text=text[0:match.start()]+repl+text[match.end():]
+            matchLength = pos - match.start()
+            replLength = len(repl)
+            pos += (replLength - matchLength)
+        match=regExp.search(text, pos)
+    return text
+
+def replaceTagListOld(text, tagList, repl):
+    for tag in tagList:
+        text=replaceRegExpOld(text, re.compile(r'<(/)?%s(\s+.*?)?>' % tag, re.I), repl)
+    return text
+
+def stripBlocksOld(text, startPattern, endPattern):
+    opened=0
+    spanStart=-1
+    spans=[]
+    pattern=r"(%s)|(%s)" % (startPattern, endPattern)
+    blockRe=re.compile(pattern, re.I+re.S)
+    for match in blockRe.finditer(text):
+        if match.lastindex==1:
+            if not opened:
+                spanStart=match.start(match.lastindex)
+            opened+=1
+        else:
+            if opened==1:
+                spans.append((spanStart, match.end(match.lastindex)))
+            opened-=1;
+            if opened<0:
+                opened=0
+    if opened:
+        spans.append((spanStart, len(text)))
+    spans.reverse()
+    for span in spans:
+        start, end=span
+        text=text[:start]+text[end:]
+    return text
+
+# steps of convertArticleMultiPass() that use the functions we benchmark,
+# as tuples (name, new version, old version)
+def getSteps():
+    steps = []
+    for (name, regExp) in [("templates", articleconvert.wikiTemplateRe), ("comments", articleconvert.commentRe), ("images", articleconvert.imageRe), ("newlines", articleconvert.multipleLinesRe)]:
+        steps.append((name, lambda txt, regExp=regExp: articleconvert.replaceRegExp(txt, regExp, ""), lambda txt, regExp=regExp: replaceRegExpOld(txt, regExp, "")))
+    steps.append(("tags", lambda txt: applyTagReplacements(articleconvert.replaceTagList, txt), lambda txt: applyTagReplacements(replaceTagListOld, txt)))
+    for (startPattern, endPattern) in [('<div.*?>', '</div>'), ('<table.*?>', '</table>'), (r'\{\|', r'\|\}')]:
+        steps.append((startPattern, lambda txt, s=startPattern, e=endPattern: articleconvert.stripBlocks(txt, s, e), lambda txt, s=startPattern, e=endPattern: stripBlocksOld(txt, s, e)))
+    return steps
+
+def applyTagReplacements(replaceTagListFunc, txt):
+    for (tagList, repl) in articleconvert.tagReplacements:
+        txt = replaceTagListFunc(txt, tagList, repl)
+    return txt
+
+# return a list of tuples (size, title, text) of count largest articles
+def getLargestArticles(fileName, limit, count):
+    largest = []
+    for article in wikipediasql.iterWikipediaArticles(fileName, limit, True, False):
+        if article.fRedirect():
+            continue
+        txt = article.getText()
+        largest.append((len(txt), article.getTitle(), txt))
+        if len(largest) > 2 * count:
+            largest.sort()
+            largest = largest[-count:]
+    largest.sort()
+    largest.reverse()
+    return largest[:count]
+
+# return a made up list page (like "List of ...") with a lot of markup we
+# remove or replace on each line
+def makeListPage(itemsCount):
+    lines = []
+    for i in range(itemsCount):
+        lines.append("* <b>[[Item %d]]</b> {{flag|%d}} <!-- %d --> <span>in</span> <div>%d</div> [[Category:List %d]]\n\n\n" % (i, i, i, i, i))
+    return string.join(lines, "")
+
+def timeFunc(func, txt):
+    startTime = time.time()
+    result = func(txt)
+    return (result, time.time() - startTime)
+
+def main():
+    largestCount = arsutils.getRemoveCmdArgInt("-largest")
+    if None == largestCount:
+        largestCount = LARGEST_COUNT
+    listItemsCount = arsutils.getRemoveCmdArgInt("-listitems")
+    if None == listItemsCount:
+        listItemsCount = LIST_ITEMS_COUNT
+    limit = arsutils.getRemoveCmdArgInt("-limit")
+    if len(sys.argv) != 2:
+        usageAndExit()
+    fileName = sys.argv[1]
+
+    articles = getLargestArticles(fileName, limit, largestCount)
+    listPage = makeListPage(listItemsCount)
+    articles.insert(0, (len(listPage), "(made up list with %d items)" % listItemsCount, listPage))
+
+    steps = getSteps()
+    totals = {}
+    for (name, newFunc, oldFunc) in steps:
+        totals[name] = [0.0, 0.0]
+    print "%-40s %9s %10s %10s %8s" % ("article", "size", "old", "new", "speedup")
+    for (size, title, txt) in articles:
+        oldTime = 0.0
+        newTime = 0.0
+        for (name, newFunc, oldFunc) in steps:
+            (oldResult, stepOldTime) = timeFunc(oldFunc, txt)
+            (newResult, stepNewTime) = timeFunc(newFunc, txt)
+            if oldResult != newResult:
+                print "DIFFERENT result of %s for %s" % (name, title)
+            oldTime += stepOldTime
+            newTime += stepNewTime
+            totals[name][0] += stepOldTime
+            totals[name][1] += stepNewTime
+        print "%-40s %9d %8.3f s %8.3f s %7.1fx" % (title[:40], size, oldTime, newTime, oldTime / max(newTime, 0.001))
+    print
+    print "%-40s %9s %10s %10s %8s" % ("function", "", "old", "new", "speedup")
+    for (name, newFunc, oldFunc) in steps:
+        (oldTime, newTime) = totals[name]
+        print "%-40s %9s %8.3f s %8.3f s %7.1fx" % (name, "", oldTime, newTime, oldTime / max(newTime, 0.001))
+
+if __name__=="__main__":
+    main()
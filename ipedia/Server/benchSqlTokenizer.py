@@ -0,0 +1,89 @@
+# Copyright: Krzysztof Kowalczyk
+# Owner: Andrzej Ciarkowski
+#
+# Purpose:
+#   Compare the speed of wikipediasql.SQLTokenizer and FastSQLTokenizer on
+#   a wikipedia sql dump (*.sql, *.sql.bz2 or *.sql.gz) and check that they
+#   return the same values.
+#
+# Usage:
+#   -limit n : only tokenize first n rows
+#   -makesample n : instead of benchmarking, write a dump with n made up
+#                   rows of cur table to fileName (to benchmark without
+#                   downloading a real dump)
+#   fileName - sql dump to tokenize (or to create with -makesample)
+
+import sys, string, time, md5, random
+import arsutils, wikipediasql
+from wikipediasql import BEG_TXT, TOKEN_SEP, TOKEN_RIGHT_BRACE, fTokenVal
+
+def usageAndExit():
+    print "benchSqlTokenizer.py [-limit n] [-makesample n] fileName"
+    sys.exit(0)
+
+# tokenize a dump with a given tokenizer. Return a tuple (rows, seconds,
+# md5 of all tokens and values)
+def tokenizeDump(tokenizerClass, fileName, limit):
+    hash = md5.new()
+    rows = 0
+    startTime = time.time()
+    st = tokenizerClass(fileName)
+    while st.fSkipUntilTxt(BEG_TXT):
+        token = None
+        while TOKEN_SEP != token:
+            token = st.getToken()
+            hash.update(str(token))
+            if fTokenVal(token):
+                val = st.getTokenVal()
+                hash.update("%d:%s" % (len(val), val))
+            elif TOKEN_RIGHT_BRACE == token:
+                rows += 1
+                if limit and rows >= limit:
+                    break
+        if limit and rows >= limit:
+            break
+    st.close()
+    return (rows, time.time() - startTime, hash.hexdigest())
+
+g_words = ["the", "of", "[[Seattle]]", "city", "\\'\\'italic\\'\\'", "\\'\\'\\'bold\\'\\'\\'", "{{stub}}", "\\n", "\\n== History ==\\n", "\\'", "\\\"", "\\\\", "[[Image:x.jpg|thumb]]", "1851", "&amp;"]
+
+def makeSampleRow(id):
+    words = [random.choice(g_words) for i in range(random.randint(50, 3000))]
+    text = string.join(words, " ")
+    return "(%d,0,'Article_%d','%s','comment',1,'User','20050202123456','',%d,0,0,0,0.%d,79949797876543,'20050202123456')" % (id, id, text, random.randint(0, 1000), random.randint(0, 99999))
+
+def makeSample(rowsCount, fileName):
+    fo = open(fileName, "wb")
+    fo.write("-- sample dump made by benchSqlTokenizer.py\n")
+    id = 1
+    while id <= rowsCount:
+        rows = []
+        # mysqldump makes INSERTs of about 1 MB
+        while id <= rowsCount and len(rows) < 100:
+            rows.append(makeSampleRow(id))
+            id += 1
+        fo.write("%s%s;\n" % (BEG_TXT, string.join(rows, ",")))
+    fo.close()
+
+def main():
+    limit = arsutils.getRemoveCmdArgInt("-limit")
+    sampleRows = arsutils.getRemoveCmdArgInt("-makesample")
+    if len(sys.argv) != 2:
+        usageAndExit()
+    fileName = sys.argv[1]
+    if None != sampleRows:
+        makeSample(sampleRows, fileName)
+        return
+
+    results = []
+    for tokenizerClass in [wikipediasql.SQLTokenizer, wikipediasql.FastSQLTokenizer]:
+        (rows, seconds, hash) = tokenizeDump(tokenizerClass, fileName, limit)
+        print "%-18s %7d rows in %7.2f s, %8.1f rows/sec" % (tokenizerClass.__name__, rows, seconds, rows / max(seconds, 0.001))
+        results.append((rows, seconds, hash))
+    if results[0][2] != results[1][2]:
+        print "DIFFERENT tokens!"
+    else:
+        print "same tokens, %.1fx faster" % (results[0][1] / max(results[1][1], 0.001))
+
+if __name__=="__main__":
+    main()
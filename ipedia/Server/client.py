@@ -15,9 +15,19 @@
 #   -invalidcookie : send a request with invalid cookie
 #   -malformed : send malformed request
 #   -tcnc : test get cookie no cookie
-import sys, string, re, socket, random, pickle, time
+#   -keepalive $n : send $n requests over one connection
+#   -getarticles titles : get articles for '|'-separated titles
+#   -getcompressed title : get article compressed with zlib
+#   -getmodified title : get article and check that it's not modified
+#   -getrange title $n : get at most $n first bytes of article
+#   -getsection title $n : get section $n of article
+#   -getlazy title : get article without reverse links and then its reverse links
+#   -searchpages term $n : do a full-text search, $n results at a time
+#   -suggest title : get article or titles similar to it
+import sys, string, re, socket, random, pickle, time, zlib, md5
 import arsutils
-import Fields
+# Fields module was renamed to iPediaFields
+import iPediaFields as Fields
 from iPediaServer import *
 
 # server string must be of form "name:port"
@@ -212,15 +222,67 @@ def parseServerResponse(response):
         if None == rest:
             return result
 
+# split text of responses to requests sent over one connection (see
+# Fields.keepAlive) into a list of texts of each response
+def splitServerResponses(responsesTxt):
+    result = []
+    start = 0
+    pos = 0
+    while pos < len(responsesTxt):
+        end = responsesTxt.find("\n", pos)
+        if -1 == end:
+            end = len(responsesTxt)
+        fld = responsesTxt[pos:end]
+        pos = end + 1
+        if 0 == len(fld):
+            # empty line ends a response
+            result.append(responsesTxt[start:pos])
+            start = pos
+            continue
+        (field,value) = parseRequestLine(fld)
+        if None != field and Fields.fPayloadField(field):
+            # skip the payload and '\n' after it
+            pos += int(value) + 1
+    if start < len(responsesTxt):
+        result.append(responsesTxt[start:])
+    return result
+
+# parse payload of Fields.articles. Returns a list with a dictionary (like
+# parseServerResponse()) for each entry, in the order of the payload
+def parseArticlesPayload(payload):
+    result = []
+    rest = payload
+    while len(rest) > 0:
+        parts = rest.split("\n",1)
+        rest = ""
+        if len(parts) > 1:
+            rest = parts[1]
+        (field,value) = parseRequestLine(parts[0])
+        if None == field:
+            print "'%s' is not a valid request line" % parts[0]
+            return None
+        if Fields.requestedTitle == field:
+            result.append({})
+        if Fields.fPayloadField(field):
+            payloadLen = int(value)
+            value = rest[:payloadLen]
+            assert '\n'==rest[payloadLen]
+            rest = rest[payloadLen+1:]
+        result[-1][field] = value
+    return result
+
 class Response:
-    def __init__(self,request):
+    # if responseTxt is given, it's a response we already got from the server
+    def __init__(self,request,responseTxt=None):
         # request can be either a string or class Request
         assert request
         if isinstance(request, Request):
             self.txt = request.getString()
         else:
             self.txt = request
-        self.responseTxt = getResponseFromServer(self.txt)
+        if None == responseTxt:
+            responseTxt = getResponseFromServer(self.txt)
+        self.responseTxt = responseTxt
         self.responseDict = parseServerResponse(self.responseTxt)
         if None == self.responseDict:
             # TODO: throw an exception
@@ -241,6 +303,18 @@ class Response:
     def getText(self):
         return self.responseTxt
 
+# send all requests over one connection, without waiting for responses, and
+# return a list of their responses. All requests but the last one should have
+# Fields.keepAlive, otherwise the server closes the connection
+def getResponsesKeepAlive(requests):
+    txt = string.join([req.getString() for req in requests], "")
+    responsesTxt = splitServerResponses(getResponseFromServer(txt))
+    assert len(responsesTxt) == len(requests)
+    result = []
+    for i in range(len(requests)):
+        result.append(Response(requests[i], responsesTxt[i]))
+    return result
+
 def handleCookie(rsp):
     global g_cookie
     if not getGlobalCookie() and rsp.hasField(Fields.cookie):
@@ -409,6 +483,186 @@ def doInvalidCookie():
     assert rsp.hasField(Fields.transactionId)
     assert rsp.getField(Fields.transactionId) == req.transactionId
 
+def doGetArticles(titles):
+    print "titles: %s" % titles
+    req = getRequestHandleCookie(Fields.getArticles, titles)
+    rsp = Response(req.getString())
+    handleCookie(rsp)
+    assert rsp.hasField(Fields.transactionId)
+    assert rsp.getField(Fields.transactionId) == req.transactionId
+    assert rsp.hasField(Fields.articles)
+    for entry in parseArticlesPayload(rsp.getField(Fields.articles)):
+        if entry.has_key(Fields.notFound):
+            print "%s: not found" % entry[Fields.requestedTitle]
+        else:
+            assert entry[Fields.formatVersion] == CUR_FORMAT_VER
+            print "%s: '%s', %d bytes" % (entry[Fields.requestedTitle], entry[Fields.articleTitle], len(entry[Fields.articleBody]))
+
+def doGetCompressed(term):
+    print "term: %s" % term
+    req = getRequestHandleCookie(Fields.getArticle, term)
+    req.addField(Fields.acceptEncoding, "zlib")
+    rsp = Response(req.getString())
+    handleCookie(rsp)
+    assert rsp.hasField(Fields.transactionId)
+    assert rsp.getField(Fields.transactionId) == req.transactionId
+    if not rsp.hasField(Fields.articleTitle):
+        assert rsp.hasField(Fields.notFound)
+        print "not found"
+        return
+    assert rsp.getField(Fields.payloadEncoding) == "zlib"
+    compressedBody = rsp.getField(Fields.articleBody)
+    body = zlib.decompress(compressedBody)
+    print "Article body: %d bytes, %d compressed" % (len(body), len(compressedBody))
+    if rsp.hasField(Fields.reverseLinks):
+        compressedLinks = rsp.getField(Fields.reverseLinks)
+        reverseLinks = zlib.decompress(compressedLinks)
+        print "Reverse links: %d bytes, %d compressed" % (len(reverseLinks), len(compressedLinks))
+
+def doGetModified(term):
+    print "term: %s" % term
+    req = getRequestHandleCookie(Fields.getArticle, term)
+    req.addField(Fields.acceptArticleHash, None)
+    rsp = Response(req.getString())
+    handleCookie(rsp)
+    assert rsp.hasField(Fields.transactionId)
+    if not rsp.hasField(Fields.articleTitle):
+        assert rsp.hasField(Fields.notFound)
+        print "not found"
+        return
+    articleHash = rsp.getField(Fields.articleHash)
+    assert articleHash == md5.new(rsp.getField(Fields.articleBody)).hexdigest()
+    print "Article hash: %s" % articleHash
+    # we have the article now, so it's not modified
+    req = getRequestHandleCookie(Fields.getArticle, term)
+    req.addField(Fields.articleHash, articleHash)
+    rsp = Response(req.getString())
+    assert rsp.hasField(Fields.notModified)
+    assert not rsp.hasField(Fields.articleBody)
+    assert rsp.getField(Fields.articleHash) == articleHash
+    print "Not modified"
+
+def doGetPart(term,partField,partValue):
+    print "term: %s" % term
+    req = getRequestHandleCookie(Fields.getArticle, term)
+    req.addField(partField, partValue)
+    rsp = Response(req.getString())
+    handleCookie(rsp)
+    assert rsp.hasField(Fields.transactionId)
+    if rsp.hasField(Fields.error):
+        print "Error: %s" % rsp.getField(Fields.error)
+        return
+    if not rsp.hasField(Fields.articleTitle):
+        assert rsp.hasField(Fields.notFound)
+        print "not found"
+        return
+    (offset,bodyLen) = [int(n) for n in rsp.getField(Fields.articlePart).split()]
+    body = rsp.getField(Fields.articleBody)
+    print "Article part: %d bytes at %d of %d" % (len(body), offset, bodyLen)
+    print "Table of contents:"
+    sectionNo = 0
+    for line in rsp.getField(Fields.tableOfContents).split("\n"):
+        (level,size,title) = line.split(" ",2)
+        print "  %d: %s%s (%s bytes)" % (sectionNo, "  " * int(level), title, size)
+        sectionNo += 1
+    print "# body:"
+    print body
+
+def doGetRange(term,maxBytes):
+    doGetPart(term,Fields.articleRange,maxBytes)
+
+def doGetSection(term,sectionNo):
+    doGetPart(term,Fields.articleSection,sectionNo)
+
+def doGetLazy(term):
+    print "term: %s" % term
+    req = getRequestHandleCookie(Fields.getArticle, term)
+    req.addField(Fields.lazyReverseLinks, None)
+    rsp = Response(req.getString())
+    handleCookie(rsp)
+    assert rsp.hasField(Fields.transactionId)
+    if not rsp.hasField(Fields.articleTitle):
+        assert rsp.hasField(Fields.notFound)
+        print "not found"
+        return
+    assert not rsp.hasField(Fields.reverseLinks)
+    title = rsp.getField(Fields.articleTitle)
+    print "Article '%s': %d bytes" % (title, len(rsp.getField(Fields.articleBody)))
+    req = getRequestHandleCookie(Fields.getReverseLinks, title)
+    rsp = Response(req.getString())
+    if rsp.hasField(Fields.notFound):
+        print "no reverse links"
+        return
+    assert rsp.getField(Fields.articleTitle) == title
+    print "Reverse links:"
+    print rsp.getField(Fields.reverseLinks)
+
+def doSearchPages(term,pageSize):
+    print "full-text search for: %s" % term
+    req = getRequestHandleCookie(Fields.search, term)
+    req.addField(Fields.searchPageSize, pageSize)
+    pageNo = 0
+    while True:
+        rsp = Response(req.getString())
+        handleCookie(rsp)
+        assert rsp.hasField(Fields.transactionId)
+        if rsp.hasField(Fields.error):
+            print "Error: %s" % rsp.getField(Fields.error)
+            return
+        if rsp.hasField(Fields.notFound):
+            print "not found"
+            return
+        titles = rsp.getField(Fields.searchResults).split("\n")
+        assert len(titles) <= int(pageSize)
+        print "# page %d:" % pageNo
+        print string.join(titles, "\n")
+        if not rsp.hasField(Fields.searchCursor):
+            break
+        req = getRequestHandleCookie(Fields.searchNext, rsp.getField(Fields.searchCursor))
+        pageNo += 1
+
+def doSuggest(term):
+    print "term: %s" % term
+    req = getRequestHandleCookie(Fields.getArticle, term)
+    req.addField(Fields.acceptSuggestions, None)
+    rsp = Response(req.getString())
+    handleCookie(rsp)
+    assert rsp.hasField(Fields.transactionId)
+    if rsp.hasField(Fields.suggestions):
+        assert rsp.getField(Fields.articleTitle) == term
+        assert not rsp.hasField(Fields.articleBody)
+        print "Did you mean:"
+        print rsp.getField(Fields.suggestions)
+    elif rsp.hasField(Fields.articleBody):
+        print "Found article '%s'" % rsp.getField(Fields.articleTitle)
+    elif rsp.hasField(Fields.searchResults):
+        print "Search results:"
+        print rsp.getField(Fields.searchResults)
+    else:
+        assert rsp.hasField(Fields.notFound)
+        print "not found"
+
+def doKeepAlive(count):
+    count = int(count)
+    requests = []
+    for i in range(count):
+        req = getRequestHandleCookie(Fields.getArticleCount, None)
+        if i < count-1:
+            req.addField(Fields.keepAlive, None)
+        requests.append(req)
+    timer = arsutils.Timer(fStart=True)
+    responses = getResponsesKeepAlive(requests)
+    timer.stop()
+    for i in range(count):
+        rsp = responses[i]
+        handleCookie(rsp)
+        assert rsp.getField(Fields.transactionId) == requests[i].transactionId
+        assert rsp.hasField(Fields.articleCount)
+        assert rsp.hasField(Fields.keepAlive) == (i < count-1)
+    print "Got %d responses over one connection" % count
+    if g_fShowTiming:
+        timer.dumpInfo()
+
 def usageAndExit():
     print "client.py [-showtiming] [-perfrandom N] [-getrandom] [-get term] [-articlecount] [-dbtime] [-ping] [-verifyregcode $regCode] [-malformed]"
 
@@ -427,6 +681,15 @@ argsInfo = {
     "malformed" : (0, doMalformed),
     "tcnc" : (0, test_NoCookieAndGetCookie),
     "availablelangs" : (0, doAvailableLangs),
+    "keepalive" : (1, doKeepAlive),
+    "getarticles" : (1, doGetArticles),
+    "getcompressed" : (1, doGetCompressed),
+    "getmodified" : (1, doGetModified),
+    "getrange" : (2, doGetRange),
+    "getsection" : (2, doGetSection),
+    "getlazy" : (1, doGetLazy),
+    "searchpages" : (2, doSearchPages),
+    "suggest" : (1, doSuggest),
 }
 
 def buildUsage():
@@ -463,17 +463,34 @@ approx_refs[16422]='...'
 numEntityRe=re.compile(r'&#(\d+);')
 entityRefRe=re.compile(r'&(\w+);')
 
+# return text that replaces named entity "&name;"
+def getNamedEntityText(name):
+    if latin1_refs.has_key(name):
+        return chr(latin1_refs[name])
+    return '/'+name+'/'
+
+# return text that replaces numbered entity "&#num;" or None if we don't
+# change it
+def getNumberedEntityText(num):
+    if 160 == num: # nbsp i.e. ' '
+        return " "
+    elif num > 255:
+        if approx_refs.has_key(num):
+            return approx_refs[num]
+        elif greek_refs.has_key(num):
+            return '/'+greek_refs[num]+'/'
+        else:
+            # don't change the text
+            return None
+    return chr(num)
+
 def convertNamedEntities(text):
     matches=[]
     for iter in entityRefRe.finditer(text):
         matches.append(iter)
     matches.reverse()
     for match in matches:
-        name=match.group(1)
-        if latin1_refs.has_key(name):
-            text=text[:match.start()]+chr(latin1_refs[name])+text[match.end():]
-        else:
-            text=text[:match.start()]+'/'+name+'/'+text[match.end():]
+        text=text[:match.start()]+getNamedEntityText(match.group(1))+text[match.end():]
     return text;
 
 def convertNumberedEntities(text):
@@ -482,19 +499,9 @@ def convertNumberedEntities(text):
         matches.append(iter)
     matches.reverse()
     for match in matches:
-        num=int(match.group(1))
-        if 160 == num: # nbsp i.e. ' '
-            text = text[:match.start()] + " " + text[match.end():]
-        elif num > 255:
-            if approx_refs.has_key(num):
-                text = text[:match.start()]+approx_refs[num]+text[match.end():]
-            elif greek_refs.has_key(num):
-                text = text[:match.start()]+'/'+greek_refs[num]+'/'+text[match.end():]
-            else:
-                # don't change the text
-                pass
-        else:
-            text=text[:match.start()]+chr(num)+text[match.end():]
+        repl=getNumberedEntityText(int(match.group(1)))
+        if None != repl:
+            text=text[:match.start()]+repl+text[match.end():]
     return text
 
 # This function uses .normalize function only available in python 2.3
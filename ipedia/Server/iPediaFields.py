@@ -45,6 +45,24 @@ getArticle =        "Get-Article"
 # used in special "unlocked" builds that we sometimes have to generate.
 getArticleU =        "Get-Article-U"
 
+# Client uses Get-Articles to request many articles at once (e.g. to prefetch
+# articles from history). Titles that aren't found are not searched for.
+# Server only handles a limited number of titles (the rest is ignored) and
+# stops adding articles to the response when it gets too big, so client
+# should request again titles it didn't get back.
+# Value: '|'-separated list of titles
+# Response: Articles
+getArticles =       "Get-Articles"
+# Sent by server in response to Get-Articles.
+# Value: payload with an entry for each requested title we send back, in the
+#   order of the request. Entry starts with Requested-Title followed by
+#   fields of Get-Article response (Format-Version, Article-Title,
+#   Article-Body, Reverse-Links) or by Not-Found
+articles =          "Articles"
+# Starts an entry in Articles payload
+# Value: title as sent in Get-Articles
+requestedTitle =    "Requested-Title"
+
 # Client uses Get-Random-Article to get a random article
 # Value: none
 # Response: (Article-Title, Article-Body, Format-Version)
@@ -71,9 +89,88 @@ articleTitle =      "Article-Title"
 # send a lot of data (the biggest was around 100 kB) and more wouldn't be useful anyway.
 # Value: payload, a '\n'-separated list of article titles that link to a given article.
 reverseLinks =     "Reverse-Links"
+# Client sends Lazy-Reverse-Links with Get-Article, Get-Articles and
+# Get-Random-Article if it doesn't want Reverse-Links with articles (they're
+# only needed when the user wants to see linking articles). Server then
+# doesn't send them and the client asks for them with Get-Reverse-Links.
+# Value: none
+# Response: none
+lazyReverseLinks = "Lazy-Reverse-Links"
+# Client sends Get-Reverse-Links to get Reverse-Links of an article. Can't be
+# sent with Get-Article, Get-Articles, Get-Random-Article or Search.
+# Value: title of the article, as sent by server in Article-Title
+# Response: Article-Title and Reverse-Links (preceded by Payload-Encoding if
+#   client sent Accept-Encoding) or Not-Found if we have no reverse links
+#   for this article
+getReverseLinks =  "Get-Reverse-Links"
+# Client sends Accept-Encoding if it can decode compressed payloads. Article-Body
+# and Reverse-Links of all articles in the response are then compressed with
+# one of the encodings client accepts.
+# Value: space-separated list of encodings. Currently we only have "zlib"
+#   (data compressed with zlib, i.e. deflate with zlib header and checksum)
+# Response: none (Payload-Encoding is sent with each compressed article)
+acceptEncoding =    "Accept-Encoding"
+# Sent by server before Article-Body if Article-Body and Reverse-Links that
+# follow are compressed. Payload sizes are sizes of compressed data.
+# Value: encoding (one of the encodings client sent in Accept-Encoding)
+payloadEncoding =   "Payload-Encoding"
+# Server sends Article-Hash with articles (after Article-Title) if client sent
+# Article-Hash or Accept-Article-Hash. It's md5 of article body (before
+# compression), as a 32-character hex string.
+# Client can send it with Get-Article, with the hash of the article it already
+# has (e.g. from history). If the article didn't change, server responds
+# with Not-Modified instead of Article-Body and Reverse-Links.
+# Value: hash
+articleHash =       "Article-Hash"
+# Client sends Accept-Article-Hash with Get-Article, Get-Articles or
+# Get-Random-Article if it wants Article-Hash of articles (e.g. to send it
+# later with Get-Article) but doesn't have a hash to send.
+# Value: none
+# Response: Article-Hash with each article
+acceptArticleHash = "Accept-Article-Hash"
+# Sent by server in response to Get-Article with Article-Hash, if the body of
+# the article has the same hash. Sent along with Format-Version,
+# Article-Title and Article-Hash. Client should use the article it has.
+notModified =       "Not-Modified"
+# Client sends Article-Range with Get-Article if it only wants the beginning
+# of the article (e.g. what fits on the first screens). Server sends at most
+# that many bytes of the body, cut after the last complete line.
+# Value: max number of bytes of article body
+# Response: Article-Part and Table-Of-Contents along with the article
+articleRange =      "Article-Range"
+# Client sends Article-Section with Get-Article if it only wants one section
+# of the article, e.g. one chosen from Table-Of-Contents. Section 0 is the text
+# before the first heading.
+# Value: number of the section
+# Response: Article-Part and Table-Of-Contents along with the article
+articleSection =    "Article-Section"
+# Sent by server before Article-Body if the body is only a part of the
+# article (a response to Article-Range or Article-Section). Reverse-Links are
+# only sent if the part ends where the article ends.
+# Value: "$offset $length" - offset of the part in the whole body and
+#   length of the whole body (before compression)
+articlePart =       "Article-Part"
+# Sent by server after Article-Body if the body is only a part of the article
+# Value: payload, a '\n'-separated list of all sections of the article. Each
+#   line is "$level $size $title" where level is the number of '=' of the
+#   heading (0 for section 0) and size is the size of the section in bytes
+tableOfContents =   "Table-Of-Contents"
 # Retruned by the server in response to Get-Article, if the article hasn't been
 # found.
 notFound =          "Not-Found"
+# Client sends Accept-Suggestions with Get-Article if it can show titles
+# similar to a title we don't have ("did you mean"). Server then sends
+# Suggestions instead of Search-Results if we have titles similar enough
+# (if not, it does full-text search as usual). Client can still send Search
+# if the user wants full-text search results.
+# Value: none
+# Response: Suggestions (with Article-Title) if the article isn't found
+acceptSuggestions = "Accept-Suggestions"
+# Sent by server in response to Get-Article with Accept-Suggestions, after
+# Article-Title with the requested title, if we don't have the article.
+# Value: payload, a '\n'-separated list of titles of articles, the most
+#   similar first
+suggestions =       "Suggestions"
 # Error is returned by the server if there was an error.
 # Value: error number
 error =             "Error"
@@ -86,6 +183,24 @@ error =             "Error"
 regCode =           "Registration-Code"
 search =            "Search"
 searchResults =     "Search-Results"
+# Client sends Search-Page-Size with Search if it wants results one page at
+# a time. Server then sends at most that many titles in Search-Results and
+# Search-Cursor if there are more results.
+# Value: max number of titles in Search-Results
+# Response: Search-Cursor if there are more results
+searchPageSize =    "Search-Page-Size"
+# Sent by server after Search-Results if there are more results than client
+# got. Ranked results of the search are kept by the server for some time, so
+# getting the next page usually doesn't repeat the search.
+# Value: cursor, which client should treat as an opaque string
+searchCursor =      "Search-Cursor"
+# Client sends Search-Next to get the next page of results of a search. Can
+# be sent with Search-Page-Size (otherwise we use the size from Search).
+# Value: cursor from Search-Cursor
+# Response: Article-Title (search term), Search-Results and Search-Cursor if
+#   there are more results or Error searchCursorExpired if results of this
+#   search changed and don't have that many titles anymore
+searchNext =        "Search-Next"
 # Client sends Get-Article-Count to retrieve the number of articles in the database.
 # Value: none
 # Server response: Article-Count
@@ -137,6 +252,16 @@ getAvailableLangs = "Get-Available-Langs"
 # requests as first parameter
 availableLangs = "Available-Langs"
 
+# Client sends Keep-Alive if it wants to send more requests over the same
+# connection. Server answers with Keep-Alive at the end of the response, followed
+# by an empty line that marks the end of the response, and waits for the next
+# request. If the response has no Keep-Alive, the server closes the connection
+# after it (e.g. because the client sent too many requests over it) and the
+# client has to open a new one.
+# Value: none
+# Response: Keep-Alive and an empty line at the end of the response
+keepAlive = "Keep-Alive"
+
 (fieldTypeClient, fieldTypeServer, fieldTypeBoth) = range(3)
 (valueNone, valueInline, valuePayload) = range(3)
 
@@ -150,10 +275,24 @@ fieldsInfo = {
     articleBody     : (fieldTypeServer, valuePayload),
     articleTitle    : (fieldTypeServer, valueInline),
     reverseLinks    : (fieldTypeServer, valuePayload),
+    lazyReverseLinks: (fieldTypeClient, valueNone),
+    getReverseLinks : (fieldTypeClient, valueInline),
     notFound        : (fieldTypeServer, valueNone),
+    acceptSuggestions : (fieldTypeClient, valueNone),
+    suggestions     : (fieldTypeServer, valuePayload),
+    articleHash     : (fieldTypeBoth,   valueInline),
+    acceptArticleHash : (fieldTypeClient, valueNone),
+    notModified     : (fieldTypeServer, valueNone),
+    articleRange    : (fieldTypeClient, valueInline),
+    articleSection  : (fieldTypeClient, valueInline),
+    articlePart     : (fieldTypeServer, valueInline),
+    tableOfContents : (fieldTypeServer, valuePayload),
     error           : (fieldTypeServer, valueInline),
     regCode         : (fieldTypeBoth,   valueInline),
     searchResults   : (fieldTypeServer, valuePayload),
+    searchPageSize  : (fieldTypeClient, valueInline),
+    searchCursor    : (fieldTypeServer, valueInline),
+    searchNext      : (fieldTypeClient, valueInline),
     articleCount    : (fieldTypeServer, valueInline),
     databaseTime    : (fieldTypeServer, valueInline),
     verifyRegCode   : (fieldTypeClient, valueInline),
@@ -161,6 +300,9 @@ fieldsInfo = {
 
     getArticle      : (fieldTypeClient, valueInline),
     getArticleU     : (fieldTypeClient, valueInline),
+    getArticles     : (fieldTypeClient, valueInline),
+    articles        : (fieldTypeServer, valuePayload),
+    requestedTitle  : (fieldTypeServer, valueInline),
     getRandom       : (fieldTypeClient, valueNone),
     search          : (fieldTypeClient, valueInline),
     getDatabaseTime : (fieldTypeClient, valueNone),
@@ -169,6 +311,9 @@ fieldsInfo = {
     getAvailableLangs : (fieldTypeClient, valueNone),
     availableLangs    : (fieldTypeServer, valueInline),
     useLang           : (fieldTypeClient, valueInline),
+    acceptEncoding    : (fieldTypeClient, valueInline),
+    payloadEncoding   : (fieldTypeServer, valueInline),
+    keepAlive         : (fieldTypeBoth,   valueNone),
 }
 
 # return True if this is a valid field
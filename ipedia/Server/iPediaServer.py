@@ -12,11 +12,28 @@
 #   -db name  : use database name
 #   -listdbs  : list all available ipedia databases
 #   -demon    : start in deamon mode
+#   -articlecache bytes : size of the cache of Get-Article responses
+#   -searchcache bytes : size of the cache of full-text search results
+#   -batchtitles N : max number of titles handled in one Get-Articles request
+#   -batchbytes bytes : max size of Articles sent in response to Get-Articles
+#   -suggestdir dir : directory where we keep suggestion indexes of databases
+#   -threaded : use a thread per connection instead of the event server
+#   -workers N : serve clients from N worker processes
 
-import sys, string, re, random, time, MySQLdb, _mysql_exceptions
+import sys, os, string, re, random, time, array, signal, zlib, md5, binascii, MySQLdb, _mysql_exceptions
 
 import iPediaFields, ServerErrors, arsutils
 from ThreadedServer import *
+import EventServer, PreforkServer
+from ConnectionPool import ConnectionPool
+from LruCache import LruCache
+from RedirectsMap import RedirectsMap
+from TitleFilter import TitleFilter
+import SuggestionIndex
+from BatchedLogWriter import BatchedLogWriter, getLogDate
+import LookupCounters
+from IdentityCache import IdentityCache
+import ArticleSections
 
 try:
     import psyco
@@ -34,6 +51,16 @@ g_fDisableRegistrationCheck     = False
 g_unregisteredLookupsLimit      = 30
 g_unregisteredLookupsDailyLimit = 2
 
+# limits on Get-Articles, so that one request doesn't keep a worker busy for
+# too long. Can be changed with -batchtitles and -batchbytes
+g_batchTitlesLimit = 20
+g_batchBytesLimit  = 256*1024
+
+# directory where we save suggestion indexes (see SuggestionIndex.py) so that
+# we don't have to build them every time we start. Can be changed with
+# -suggestdir
+g_suggestionsDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "suggestions")
+
 g_fDumpPayload = False
 
 DEFINITION_FORMAT_VERSION = "1"
@@ -57,6 +84,27 @@ testDisabledRegCode = "2347"
 # testing only
 g_fForceUpgrade = False
 
+# default size (in bytes) of the cache of Get-Article responses. Can be changed
+# with -articlecache command line argument
+ARTICLE_CACHE_SIZE = 32*1024*1024
+
+# default size (in bytes) of the cache of full-text search results. Can be
+# changed with -searchcache command line argument
+SEARCH_CACHE_SIZE = 8*1024*1024
+# how long (in seconds) we keep full-text search results
+SEARCH_CACHE_TTL = 60*60
+
+# size (in bytes) of the cache of search results clients are paging through
+# (see Search-Page-Size) and how long (in seconds) we keep them. After that
+# we repeat the search when client asks for the next page
+SEARCH_CURSORS_SIZE = 4*1024*1024
+SEARCH_CURSOR_TTL = 15*60
+
+# how many requests a client can send over one connection with Keep-Alive.
+# After that we close the connection so that a client can't keep a connection
+# (and in -threaded mode, a thread) forever
+MAX_KEEP_ALIVE_REQUESTS = 100
+
 # contains info about all available databases. databse name is the key, value
 # is a DbInfo class describing given database
 g_allDbsInfo = None
@@ -73,6 +121,23 @@ class DbInfo:
         self.redirectsCount = redirectsCount
         self.minDefId = minDefId
         self.maxDefId = maxDefId
+        # RedirectsMap with all redirects from this database. Only loaded
+        # for databases currently used for a given language (see activateDbInfo())
+        self.redirects = None
+        # array with ids of all articles, used to pick a random article.
+        # Loaded by activateDbInfo() as well
+        self.articleIds = None
+        # TitleFilter with titles of all articles and redirects, so that we
+        # know which titles we don't have without querying the database.
+        # Built by activateDbInfo()
+        self.titleFilter = None
+        # SuggestionIndex with titles of all articles, used to suggest titles
+        # of articles we don't have. Loaded by activateDbInfo()
+        self.suggestions = None
+        # True if articles table has hash column (older databases don't)
+        self.fArticleHashes = False
+        # True if articles table has sections column
+        self.fArticleSections = False
 
 # severity of the log message
 # SEV_NONE is used to indicate that we don't do any logging at all
@@ -111,16 +176,190 @@ def getAllLangs():
 
 def createManagementConnection():
     #log(SEV_LOW,"creating management connection\n")
-    # TODO: should we reuse the connection?
     return MySQLdb.Connect(host=DB_HOST, user=DB_USER, passwd=DB_PWD, db=MANAGEMENT_DB)
 
 def createArticlesConnection(dbName):
     #log(SEV_LOW,"creating connection for db %s\n" % dbName)
-    # TODO: should we reuse the connection?
     return MySQLdb.Connect(host=DB_HOST, user=DB_USER, passwd=DB_PWD, db=dbName)
 
+# connections used while handling client requests are shared between worker
+# threads. There is at most one connection per database per worker thread
+g_connectionPool = ConnectionPool(createArticlesConnection, MAX_WORKER_THREADS_COUNT)
+
+# cache of responses to Get-Article requests. Most requests are for a small
+# number of popular articles, so this saves a lot of trips to the database.
+# Key is a tuple (database name, title as requested by the client folded with
+# foldTitle(), payload encoding, part of the article, True if with reverse
+# links, True if with Article-Hash), value is a tuple (title of the article,
+# response text, article hash)
+g_articleCache = LruCache(ARTICLE_CACHE_SIZE)
+
+# cache of full-text search results. Key is a tuple (database name, search
+# term normalized with normalizeSearchTerm(), offset), value is '\n'-separated
+# list of titles of matching articles (empty string if nothing matches)
+g_searchCache = LruCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+# results of searches that clients are paging through. Key is a tuple
+# (database name, cursor id), value is a tuple (search term, list of titles
+# of matching articles, page size)
+g_searchCursors = LruCache(SEARCH_CURSORS_SIZE, SEARCH_CURSOR_TTL)
+
+def logWriterError(txt):
+    log(SEV_HI, txt)
+
+# request_log, get_cookie_log and verify_reg_code_log are written by a
+# background thread in batches, so that logging doesn't make clients wait
+g_logWriter = BatchedLogWriter(g_connectionPool, MANAGEMENT_DB, logWriterError)
+
+# number of lookups done by each user, used to check if unregistered users
+# are over the limits
+g_lookupCounters = LookupCounters.LookupCounters(g_connectionPool, MANAGEMENT_DB, logWriterError)
+
+# maps cookies and reg codes to users, so that we don't have to query
+# the database to figure out who sent a request
+g_identityCache = IdentityCache()
+
+# return a list of valid (not disabled) registration codes
+def loadValidRegCodes():
+    global g_connectionPool
+    db = g_connectionPool.getConnection(MANAGEMENT_DB)
+    cursor = None
+    try:
+        cursor = db.cursor()
+        cursor.execute("""SELECT reg_code FROM reg_codes WHERE disabled_p='f'""")
+        regCodes = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+    except:
+        if cursor:
+            cursor.close()
+        g_connectionPool.discardConnection(MANAGEMENT_DB, db)
+        raise
+    g_connectionPool.releaseConnection(MANAGEMENT_DB, db)
+    return regCodes
+
+# (re)load data cached in g_identityCache. Must be called at startup and
+# after users or reg_codes tables were modified by something else than
+# the server
+def reloadIdentityCache():
+    global g_identityCache
+    g_identityCache.clear()
+    g_identityCache.setValidRegCodes(loadValidRegCodes())
+
+def buildTitleLowerTable():
+    upper = ""
+    lower = ""
+    for c in range(ord('A'), ord('Z')+1) + range(0xC0, 0xDF):
+        if 0xD7 == c:
+            # multiplication sign, doesn't have lower-case version
+            continue
+        upper += chr(c)
+        lower += chr(c + 0x20)
+    return string.maketrans(upper, lower)
+
+g_titleLowerTable = buildTitleLowerTable()
+
+# MySQL compares titles in a case-insensitive way and ignores trailing spaces.
+# When we use a title as a key in memory we have to normalize it the same way
+# so that we find the same article MySQL would find
+def normalizeTitle(title):
+    return title.rstrip(" ").translate(g_titleLowerTable)
+
+# latin1_swedish_ci collation of title columns also treats most accented
+# letters as the same letter (e.g. "Cafe" finds "Caf\xe9"). This table maps
+# each character to its weight in that collation (sort_order_latin1 in MySQL
+# sources). Swedish letters sort after Z with weights of "[", "\\" and "]",
+# so e.g. "\xc4" is the same as "\xc6" and "\\". "\xdc" is the same as "Y"
+def buildTitleFoldTable():
+    weights = range(256)
+    for c in range(ord('a'), ord('z')+1):
+        weights[c] = c - 0x20
+    # weights of 0xC0-0xCF and 0xD0-0xDF (and their lower-case versions)
+    upperWeights = "AAAA\\[\\CEEEEIIII" + "DNOOOO]\xd7\xd8UUUYY\xde\xdf"
+    for i in range(len(upperWeights)):
+        weights[0xC0 + i] = ord(upperWeights[i])
+        weights[0xE0 + i] = ord(upperWeights[i])
+    # division sign and y with diaeresis don't have upper-case versions
+    weights[0xF7] = 0xF7
+    weights[0xFF] = 0xFF
+    return string.join([chr(weight) for weight in weights], "")
+
+g_titleFoldTable = buildTitleFoldTable()
+
+# return a key that is the same for all titles MySQL considers equal. Unlike
+# normalizeTitle() it loses accents, so it's only used for keys we never turn
+# back into titles, like in RedirectsMap and TitleFilter
+def foldTitle(title):
+    return title.rstrip(" ").translate(g_titleFoldTable)
+
+# full-text search is case-insensitive and doesn't care about the order of
+# words, so searches for e.g. "New  York" and "york new" are the same search.
+# Return a search term that is the same for all such searches
+def normalizeSearchTerm(searchTerm):
+    words = searchTerm.translate(g_titleLowerTable).split()
+    words.sort()
+    return string.join(words, " ")
+
 lineSeparator =     "\n"
 
+def formatField(name, value=None):
+    if value:
+        return "%s: %s%s" % (name, value, lineSeparator)
+    return "%s:%s" % (name, lineSeparator)
+
+def formatPayloadField(name, payload):
+    return "%s: %d%s%s%s" % (name, len(payload), lineSeparator, payload, lineSeparator)
+
+# encodings of article payloads we support (see Accept-Encoding)
+ENCODING_ZLIB = "zlib"
+
+# return the hash of article body we send in Article-Hash. It's the same
+# as MD5(body) in MySQL, which is what hash column of articles table has
+def getArticleHash(body):
+    return md5.new(body).hexdigest()
+
+# return the text of the response with a given article, as sent in
+# response to Get-Article or Get-Random-Article. If encoding is given, body
+# and reverse links are compressed with it. If articleHash is given, it's
+# sent in Article-Hash. If body is only a part of the article, partInfo is a
+# tuple (offset of the part, length of the whole body, table of contents)
+def buildArticleResponse(title, body, reverseLinks, encoding=None, articleHash=None, partInfo=None):
+    parts = [formatField(iPediaFields.formatVersion, DEFINITION_FORMAT_VERSION),
+             formatField(iPediaFields.articleTitle, title)]
+    if None != articleHash:
+        parts.append(formatField(iPediaFields.articleHash, articleHash))
+    if None != partInfo:
+        parts.append(formatField(iPediaFields.articlePart, "%d %d" % (partInfo[0], partInfo[1])))
+    if ENCODING_ZLIB == encoding:
+        parts.append(formatField(iPediaFields.payloadEncoding, encoding))
+        body = zlib.compress(body)
+        if None != reverseLinks:
+            reverseLinks = zlib.compress(reverseLinks)
+    parts.append(formatPayloadField(iPediaFields.articleBody, body))
+    if None != partInfo:
+        parts.append(formatPayloadField(iPediaFields.tableOfContents, partInfo[2]))
+    if None != reverseLinks:
+        parts.append(formatPayloadField(iPediaFields.reverseLinks, reverseLinks))
+    return string.join(parts, "")
+
+# return the text of the response to Get-Reverse-Links. If encoding is
+# given, reverse links are compressed with it
+def buildReverseLinksResponse(title, reverseLinks, encoding=None):
+    parts = [formatField(iPediaFields.articleTitle, title)]
+    if ENCODING_ZLIB == encoding:
+        parts.append(formatField(iPediaFields.payloadEncoding, encoding))
+        reverseLinks = zlib.compress(reverseLinks)
+    parts.append(formatPayloadField(iPediaFields.reverseLinks, reverseLinks))
+    return string.join(parts, "")
+
+# return the text of the response for an article client already has (i.e.
+# it sent Article-Hash that matches the article)
+def buildNotModifiedResponse(title, articleHash):
+    parts = [formatField(iPediaFields.formatVersion, DEFINITION_FORMAT_VERSION),
+             formatField(iPediaFields.articleTitle, title),
+             formatField(iPediaFields.articleHash, articleHash),
+             formatField(iPediaFields.notModified)]
+    return string.join(parts, "")
+
 # A format of a request accepted by a server is very strict:
 # validClientRequest = validClientField ":" fieldValue? "\n"
 # fieldValue = " " string
@@ -245,7 +484,17 @@ def getReverseLinks(db,cursor,articleTitle):
 
 # return a tuple (articleId,articleTitle,articleBody) for a random
 # article from the datbase
-def getRandomArticle(cursor):
+# articleIds is an array of ids of all articles in the database. If given,
+# we pick the id from it, which always gives a valid id
+def getRandomArticle(cursor, articleIds=None):
+    if None != articleIds and len(articleIds) > 0:
+        termId = articleIds[random.randint(0, len(articleIds)-1)]
+        cursor.execute("""SELECT id, title, body FROM articles WHERE id=%d;""" % termId)
+        row = cursor.fetchone()
+        if row:
+            return (row[0], row[1], row[2])
+        # shouldn't happen since databases don't change, but if it does
+        # we still have the old way
     iterationsLeft = 10
     retVal = None
     while iterationsLeft>0:
@@ -265,34 +514,178 @@ def getRandomArticle(cursor):
 
 # return a tuple (articleId,articleTitle,articleBody) for an article with a
 # given title (or None if article with such title doesn't exists)
-def findArticle(db, cursor, title):
+# redirects is RedirectsMap for this database. If given, we resolve
+# redirects in memory instead of querying redirects table
+def findArticle(db, cursor, title, redirects=None):
+    return findArticleColumns(db, cursor, title, redirects, "id, title, body")
+
+# like findArticle() but return a tuple (articleId,articleTitle,articleHash)
+# so that we don't read the body. Only for databases with hash column
+def findArticleHash(db, cursor, title, redirects=None):
+    return findArticleColumns(db, cursor, title, redirects, "id, title, hash")
+
+# return a tuple (articleId,articleTitle,articleBody) for an article with
+# a given id (e.g. found with findArticleHash()) or None if there's no such
+# article
+def findArticleById(cursor, articleId):
+    cursor.execute("""SELECT id, title, body FROM articles WHERE id=%d;""" % articleId)
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return (row[0], row[1], row[2])
+
+# return a tuple with given columns of articles table for an article with
+# a given title, following redirects. The first two columns must be id, title
+def findArticleColumns(db, cursor, title, redirects, columns):
     # ifninite cycles shouldn't happen, but just in case we're limiting number of re-directs
     redirectsLeft = 10
     retVal = None
     while redirectsLeft>0:
         titleEscaped = db.escape_string(title)
-        query = """SELECT id, title, body FROM articles WHERE title='%s';""" % titleEscaped
+        query = """SELECT %s FROM articles WHERE title='%s';""" % (columns, titleEscaped)
         cursor.execute(query)
         row = cursor.fetchone()
         if row:
-            retVal = (row[0], row[1], row[2])
-            break
-        query = """SELECT redirect FROM redirects WHERE title='%s';""" % titleEscaped
-        cursor.execute(query)
-        row = cursor.fetchone()
-        if not row:
+            retVal = tuple(row)
             break
-        title=row[0]
+        if None != redirects:
+            title = redirects.getRedirect(foldTitle(title))
+            if None == title:
+                break
+        else:
+            query = """SELECT redirect FROM redirects WHERE title='%s';""" % titleEscaped
+            cursor.execute(query)
+            row = cursor.fetchone()
+            if not row:
+                break
+            title=row[0]
         redirectsLeft -= 1
     return retVal
 
+# return a list of titles, quoted and escaped for use in SQL IN (...)
+def buildTitlesInList(db, titles):
+    return string.join(["'%s'" % db.escape_string(title) for title in titles], ",")
+
+# like findArticle() but for many titles at once. Instead of a few queries per
+# title, we do one query for all titles we're still looking for per level of
+# redirects. Return a dictionary mapping folded titles (see foldTitle()) from
+# titles to (articleId,articleTitle,articleBody) of articles we've found.
+# MySQL finds "Caf\xe9" when we ask for "Cafe", so we match rows it returns
+# with the titles we asked for by folded titles too
+def findArticles(db, cursor, titles, redirects=None):
+    found = {}
+    # title we look for => folded titles from titles that lead to it
+    pending = {}
+    for title in titles:
+        pending.setdefault(title, []).append(foldTitle(title))
+    # ifninite cycles shouldn't happen, but just in case we're limiting number of re-directs
+    redirectsLeft = 10
+    while len(pending) > 0 and redirectsLeft > 0:
+        cursor.execute("""SELECT id, title, body FROM articles WHERE title IN (%s);""" % buildTitlesInList(db, pending.keys()))
+        rows = {}
+        for row in cursor.fetchall():
+            rows[foldTitle(row[1])] = (row[0], row[1], row[2])
+        notFound = []
+        for (title, keys) in pending.items():
+            row = rows.get(foldTitle(title))
+            if None == row:
+                notFound.append(title)
+                continue
+            for key in keys:
+                found[key] = row
+        if 0 == len(notFound):
+            break
+
+        if None != redirects:
+            redirectTo = {}
+            for title in notFound:
+                redirectTo[foldTitle(title)] = redirects.getRedirect(foldTitle(title))
+        else:
+            redirectTo = {}
+            cursor.execute("""SELECT title, redirect FROM redirects WHERE title IN (%s);""" % buildTitlesInList(db, notFound))
+            for row in cursor.fetchall():
+                redirectTo[foldTitle(row[0])] = row[1]
+
+        newPending = {}
+        for title in notFound:
+            redirect = redirectTo.get(foldTitle(title))
+            if None != redirect:
+                newPending.setdefault(redirect, []).extend(pending[title])
+        pending = newPending
+        redirectsLeft -= 1
+    return found
+
+# like getReverseLinks() but for many articles at once. Return a dictionary
+# mapping folded titles (see foldTitle()) to their reverse links. Articles we don't have
+# this information for are not in the dictionary
+def getReverseLinksForTitles(db, cursor, titles):
+    result = {}
+    if 0 == len(titles):
+        return result
+    cursor.execute("SELECT title, links_to_it FROM reverse_links WHERE title IN (%s);" % buildTitlesInList(db, titles))
+    for row in cursor.fetchall():
+        result[foldTitle(row[0])] = row[1]
+    return result
+
+# kinds of parts of an article client can ask for
+(PART_RANGE, PART_SECTION) = range(2)
+
+# return a tuple (start, end) with offsets of a given part in the body of
+# bodyLen bytes or None if there's no such part. part is a tuple (kind of the
+# part, value of Article-Range or Article-Section)
+def getPartRange(sections, part, bodyLen):
+    (partKind, value) = part
+    if PART_RANGE == partKind:
+        return (0, min(value, bodyLen))
+    if value >= ArticleSections.getSectionsCount(sections):
+        return None
+    return ArticleSections.getSectionRange(sections, value, bodyLen)
+
+# return a tuple (body part, part info) with a part of a given body. Part
+# info is what buildArticleResponse() needs. Body part is None if there's no
+# such part
+def getArticlePart(body, part):
+    sections = ArticleSections.findSections(body)
+    partRange = getPartRange(sections, part, len(body))
+    if None == partRange:
+        return (None, None)
+    (start, end) = partRange
+    bodyPart = body[start:end]
+    if PART_RANGE == part[0] and end < len(body):
+        bodyPart = ArticleSections.cutAtLineEnd(bodyPart)
+    return (bodyPart, (start, len(body), ArticleSections.buildToc(sections, len(body))))
+
+# like findArticleHash() but return a tuple (articleId, articleTitle,
+# articleHash, sections, length of body) with what readArticlePart() needs.
+# Only for databases with sections column
+def findArticlePartInfo(db, cursor, title, redirects=None):
+    return findArticleColumns(db, cursor, title, redirects, "id, title, hash, sections, LENGTH(body)")
+
+# like getArticlePart() but only reads the part of the body we need. partInfoRow
+# is what findArticlePartInfo() returned. Return a tuple (articleTitle,
+# articleHash, body part, part info)
+def readArticlePart(cursor, partInfoRow, part):
+    (articleId, articleTitle, articleHash, sectionsTxt, bodyLen) = partInfoRow
+    sections = ArticleSections.parseSections(sectionsTxt)
+    partRange = getPartRange(sections, part, bodyLen)
+    if None == partRange:
+        return (articleTitle, articleHash, None, None)
+    (start, end) = partRange
+    cursor.execute("""SELECT SUBSTRING(body, %d, %d) FROM articles WHERE id=%d;""" % (start + 1, end - start, articleId))
+    bodyPart = cursor.fetchone()[0]
+    if PART_RANGE == part[0] and end < bodyLen:
+        bodyPart = ArticleSections.cutAtLineEnd(bodyPart)
+    return (articleTitle, articleHash, bodyPart, (start, bodyLen, ArticleSections.buildToc(sections, bodyLen)))
+
 listLengthLimit = 200
 
 # given a search term, return a list of articles matching this term.
 # list can be empty (no matches)
 def findFullTextMatches(db, cursor, searchTerm, startOffset = None):
     words = searchTerm.split()
-    queryStr = string.join(words, " +")
+    # all words are required in boolean mode. That way the order of words
+    # doesn't matter
+    queryStr = string.join(["+" + word for word in words], " ")
     queryStrEscaped = db.escape_string(queryStr)
     searchTermEscaped = db.escape_string(searchTerm)
     log(SEV_LOW,"Performing full text search for '%s'\n" % queryStr)
@@ -306,8 +699,9 @@ def findFullTextMatches(db, cursor, searchTerm, startOffset = None):
     row = cursor.fetchone()
     if not row:
         log (SEV_LOW,"Performing non-boolean mode search for '%s'" % queryStr)
-        query = """SELECT id, title, match(title, body) AGAINST('%s') AS relevance FROM articles WHERE match(title, body) against('%s') ORDER BY relevance DESC %s""" % (searchTermEscaped, queryStrEscaped, limitStr)
+        query = """SELECT id, title, match(title, body) AGAINST('%s') AS relevance FROM articles WHERE match(title, body) against('%s') ORDER BY relevance DESC %s""" % (searchTermEscaped, searchTermEscaped, limitStr)
         cursor.execute(query)
+        row = cursor.fetchone()
 
     titleList=[]
     while row:
@@ -315,31 +709,76 @@ def findFullTextMatches(db, cursor, searchTerm, startOffset = None):
         row=cursor.fetchone()
     return titleList
 
+# return the value of Search-Cursor for the page of results of searchTerm
+# starting at offset. The cursor describes the search (instead of pointing to
+# results we keep), so that we can send the next page even if we don't have
+# the results anymore or another process (see -workers) did the search
+def formatSearchCursor(searchTerm, offset, pageSize):
+    return "%d-%d-%s" % (offset, pageSize, binascii.hexlify(searchTerm))
+
+# return a tuple (search term, offset, page size) from the value of
+# Search-Cursor or None if it's not a valid cursor
+def parseSearchCursor(cursor):
+    parts = cursor.split("-", 2)
+    if 3 != len(parts):
+        return None
+    try:
+        offset = int(parts[0])
+        pageSize = int(parts[1])
+        searchTerm = binascii.unhexlify(parts[2])
+    except (ValueError, TypeError):
+        return None
+    if offset <= 0 or pageSize < 1 or 0 == len(searchTerm):
+        return None
+    return (searchTerm, offset, pageSize)
+
 # differen types of requests to log (request_type column in request_log table)
 SEARCH_TYPE_STANDARD = 's'
 SEARCH_TYPE_EXTENDED = 'e'
 SEARCH_TYPE_RANDOM   = 'r'
+# Get-Reverse-Links. It's for an article client already got, so it's not
+# counted as a lookup
+SEARCH_TYPE_REVERSE_LINKS = 'l'
 
 class iPediaProtocol(LineReceiver):
 
     def __init__(self):
         self.delimiter = '\n'
 
+        self.dbManagement = None
+        self.dbArticles = None
+        # name of the database self.dbArticles is connected to. Needed to
+        # return the connection to the pool
+        self.dbArticlesName = None
+
+        # number of requests answered over this connection
+        self.requestsCount = 0
+
+        self.resetRequestState()
+
+    # forget everything about the current request. Called before the first
+    # request and after answering a request with Keep-Alive, since then the
+    # next request comes over the same connection
+    def resetRequestState(self):
         # info about the database we use for this client
         # must be set before we create articles connection (self.dbArticles)
         self.dbInfo = None
 
-        self.dbManagement = None
-        self.dbArticles = None
-
         # dictionary to keep values of client request fields parsed so far
         self.fields = {}
 
+        # True if we got the empty line that ends the request
+        self.fRequestComplete = False
+
         self.userId = None
         self.fRegisteredUser = False
+        self.fUserDisabled = False
 
         # used in logging, must be set when we handle search requests
         self.searchResult = None
+        # used in logging Get-Articles, a list of tuples (requested title,
+        # title of the article we sent or None if not found)
+        self.batchResults = []
 
     # return true if current request has a given field
     def fHasField(self,fieldName):
@@ -364,21 +803,41 @@ class iPediaProtocol(LineReceiver):
         self.fields[fieldName] = value
 
     def getManagementDatabase(self):
+        global g_connectionPool
         if not self.dbManagement:
-            self.dbManagement = createManagementConnection()
+            self.dbManagement = g_connectionPool.getConnection(MANAGEMENT_DB)
         return self.dbManagement
 
     def getArticlesDatabase(self):
+        global g_connectionPool
         if not self.dbArticles:
             assert self.dbInfo != None
-            self.dbArticles = createArticlesConnection(self.dbInfo.dbName)
+            self.dbArticlesName = self.dbInfo.dbName
+            self.dbArticles = g_connectionPool.getConnection(self.dbArticlesName)
         return self.dbArticles
 
+    # return connections to the pool. If fDiscard is True, there was a problem
+    # handling the request and connections might be in a bad state, so we
+    # close them instead
+    def releaseDatabases(self, fDiscard):
+        global g_connectionPool
+        if self.dbManagement:
+            if fDiscard:
+                g_connectionPool.discardConnection(MANAGEMENT_DB, self.dbManagement)
+            else:
+                g_connectionPool.releaseConnection(MANAGEMENT_DB, self.dbManagement)
+            self.dbManagement=None
+
+        if self.dbArticles:
+            if fDiscard:
+                g_connectionPool.discardConnection(self.dbArticlesName, self.dbArticles)
+            else:
+                g_connectionPool.releaseConnection(self.dbArticlesName, self.dbArticles)
+            self.dbArticles=None
+            self.dbArticlesName=None
+
     def outputField(self, name, value=None):
-        if value:
-            field = "%s: %s%s" % (name, value, lineSeparator)
-        else:
-            field = "%s:%s" % (name, lineSeparator)
+        field = formatField(name, value)
         self.transport.write(field)
         log(SEV_MED,field)
 
@@ -399,7 +858,8 @@ class iPediaProtocol(LineReceiver):
     def logRequestGeneric(self,userId,requestType,searchData,searchResult,error):
         assert SEARCH_TYPE_STANDARD  == requestType or \
                SEARCH_TYPE_EXTENDED  == requestType or \
-               SEARCH_TYPE_RANDOM    == requestType
+               SEARCH_TYPE_RANDOM    == requestType or \
+               SEARCH_TYPE_REVERSE_LINKS == requestType
 
         if SEARCH_TYPE_STANDARD == requestType:
             assert None != searchData
@@ -410,40 +870,20 @@ class iPediaProtocol(LineReceiver):
         if SEARCH_TYPE_RANDOM == requestType:
             assert None == searchData
 
-        cursor = None
-        try:
-            db = self.getManagementDatabase()
-            clientIp = self.getClientIp()
-            clientIpEscaped = db.escape_string(clientIp)
+        if SEARCH_TYPE_REVERSE_LINKS == requestType:
+            assert None != searchData
 
-            if None == searchData:
-                assert SEARCH_TYPE_RANDOM == requestType
-                searchDataTxt = "NULL"
-            else:
-                searchDataTxt = "'%s'" % db.escape_string(searchData)
+        if None == searchResult:
+            # a standard search might turn into full-text search if term
+            # is not found. We might not have reverse links of a title
+            assert (SEARCH_TYPE_EXTENDED == requestType) or (SEARCH_TYPE_STANDARD == requestType) or (SEARCH_TYPE_REVERSE_LINKS == requestType) or (None != error)
 
-            if None == searchResult:
-                # a standard search might turn into full-text search if term
-                # is not found.
-                assert (SEARCH_TYPE_EXTENDED == requestType) or (SEARCH_TYPE_STANDARD == requestType) or (None != error)
-                searchResultTxt = "NULL"
-            else:
-                searchResultTxt = "'%s'" % db.escape_string(searchResult)
-
-            if None == error:
-                errorTxt = "NULL"
-            else:
-                errorTxt = "'%d'" % error
-
-            sql = "INSERT INTO request_log (user_id,client_ip,log_date,request_type,search_data,search_result,error) VALUES (%d,'%s',now(),'%s', %s, %s, %s);" % (userId, clientIpEscaped, requestType, searchDataTxt,searchResultTxt,errorTxt)
-            cursor = db.cursor()
-            cursor.execute(sql)
-            cursor.close()
-        except _mysql_exceptions.Error, ex:
-            if cursor:
-                cursor.close()
-            log(SEV_HI, arsutils.exceptionAsStr(ex))
+        if LookupCounters.fCountedRequestType(requestType):
+            g_lookupCounters.addLookup(userId)
 
+        g_logWriter.log("request_log",
+            ("user_id", "client_ip", "log_date", "request_type", "search_data", "search_result", "error"),
+            (userId, self.getClientIp(), getLogDate(), requestType, searchData, searchResult, error))
 
     def logSearchRequest(self,userId,searchTerm,articleTitle,error):
         self.logRequestGeneric(userId,SEARCH_TYPE_STANDARD,searchTerm,articleTitle,error)
@@ -454,10 +894,9 @@ class iPediaProtocol(LineReceiver):
     def logRandomSearchRequest(self,userId,articleTitle,error):
         self.logRequestGeneric(userId,SEARCH_TYPE_RANDOM,None,articleTitle,error)
 
-    # TODO: in order to improve performance, we should do buffered logging i.e.
-    # we just cache N requests to log in memory. When we reach N (and/or some time
-    # has passed), we INSERT them in one go. This should be faster.
-    # Ideally we would also be able to flush cached logs via remote interface
+    def logReverseLinksRequest(self,userId,title,articleTitle,error):
+        self.logRequestGeneric(userId,SEARCH_TYPE_REVERSE_LINKS,title,articleTitle,error)
+
     def logRequest(self, error):
         # sometimes we have errors before we can establish userId
         if None == self.userId:
@@ -471,6 +910,30 @@ class iPediaProtocol(LineReceiver):
             self.logExtendedSearchRequest(self.userId,self.getFieldValue(iPediaFields.search),error)
         elif self.fHasField(iPediaFields.getRandom):
             self.logRandomSearchRequest(self.userId,self.searchResult,error)
+        elif self.fHasField(iPediaFields.getArticles):
+            if 0 == len(self.batchResults):
+                self.logSearchRequest(self.userId,self.getFieldValue(iPediaFields.getArticles),None,error)
+            # each article is a lookup, just like with Get-Article
+            for (title, articleTitle) in self.batchResults:
+                self.logSearchRequest(self.userId,title,articleTitle,error)
+        elif self.fHasField(iPediaFields.getReverseLinks):
+            self.logReverseLinksRequest(self.userId,self.getFieldValue(iPediaFields.getReverseLinks),self.searchResult,error)
+
+    # return True if we should keep the connection open for the next request
+    # after answering the current one. Only if the client asked for it and we
+    # know where the next request starts (i.e. we didn't stop parsing this
+    # one in the middle because of an error)
+    def fKeepAlive(self, error):
+        global MAX_KEEP_ALIVE_REQUESTS
+        if not self.fRequestComplete:
+            return False
+        if not self.fHasField(iPediaFields.keepAlive):
+            return False
+        if ServerErrors.serverFailure == error:
+            return False
+        if self.requestsCount >= MAX_KEEP_ALIVE_REQUESTS:
+            return False
+        return True
 
     # the last stage of processing a request: if there was an error, append
     # iPediaFields.error to the response, send the response to the client and
@@ -478,21 +941,30 @@ class iPediaProtocol(LineReceiver):
     def finish(self, error):
         if None != error:
             self.outputField(iPediaFields.error, str(error))
-        self.transport.loseConnection()
+        self.requestsCount += 1
+        fKeepAlive = self.fKeepAlive(error)
+        if fKeepAlive:
+            # an empty line marks the end of the response
+            self.outputField(iPediaFields.keepAlive)
+            self.transport.write(lineSeparator)
+        else:
+            self.transport.loseConnection()
 
         self.logRequest(error)
-        if self.dbManagement:
-            self.dbManagement.close()
-            self.dbManagement=None
-
-        if self.dbArticles:
-            self.dbArticles.close()
-            self.dbArticles=None
+        self.releaseDatabases(ServerErrors.serverFailure == error)
 
         log(SEV_MED, "--------------------------------------------------------------------------------\n")
 
+        if fKeepAlive:
+            self.resetRequestState()
+            self.transport.keepAlive()
+
     # return True if regCode exists in a list of valid registration codes
     def fRegCodeExists(self,regCode):
+        global g_identityCache
+        if g_identityCache.fKnownValidRegCode(regCode):
+            return True
+        # reg codes might have been added since we loaded them
         cursor = None
         try:
             db = self.getManagementDatabase()
@@ -502,6 +974,7 @@ class iPediaProtocol(LineReceiver):
             row = cursor.fetchone()
             cursor.close()
             if row and 'f'==row[1]:
+                g_identityCache.addValidRegCode(regCode)
                 return True
         except _mysql_exceptions.Error, ex:
             if cursor:
@@ -511,46 +984,54 @@ class iPediaProtocol(LineReceiver):
 
     # Log all Get-Cookie requests
     def logGetCookie(self,userId,deviceInfo,cookie):
-        cursor=None
-        try:
-            db = self.getManagementDatabase()
-            cursor = db.cursor()
-            clientIpEscaped = db.escape_string(self.getClientIp())
-            deviceInfoEscaped = db.escape_string(deviceInfo)
-            cookieEscaped = db.escape_string(cookie)
-            cursor.execute("""INSERT INTO get_cookie_log (user_id, client_ip, log_date, device_info, cookie) VALUES (%d, '%s', now(), '%s', '%s');""" % (userId, clientIpEscaped, deviceInfoEscaped, cookieEscaped))
-            cursor.close()
-        except _mysql_exceptions.Error, ex:
-            if cursor:
-                cursor.close()
-            log(SEV_HI, arsutils.exceptionAsStr(ex))
+        g_logWriter.log("get_cookie_log",
+            ("user_id", "client_ip", "log_date", "device_info", "cookie"),
+            (userId, self.getClientIp(), getLogDate(), deviceInfo, cookie))
 
-    # Log all attempts to verify registration code. We ignore all errors from here
+    # Log all attempts to verify registration code
     def logRegCodeToVerify(self,userId,regCode,fRegCodeValid):
         reg_code_valid_p = 'f'
         if fRegCodeValid:
             reg_code_valid_p = 't'
 
-        cursor=None
-        try:
-            db = self.getManagementDatabase()
-            cursor = db.cursor()
-            clientIpEscaped = db.escape_string(self.getClientIp())
-            regCodeEscaped = db.escape_string(regCode)
-            cursor.execute("""INSERT INTO verify_reg_code_log (user_id, client_ip, log_date, reg_code, reg_code_valid_p) VALUES (%d, '%s', now(), '%s', '%s');""" % (userId, clientIpEscaped,regCodeEscaped, reg_code_valid_p))
-            cursor.close()
-        except _mysql_exceptions.Error, ex:
-            if cursor:
-                cursor.close()
-            log(SEV_HI, arsutils.exceptionAsStr(ex))
+        g_logWriter.log("verify_reg_code_log",
+            ("user_id", "client_ip", "log_date", "reg_code", "reg_code_valid_p"),
+            (userId, self.getClientIp(), getLogDate(), regCode, reg_code_valid_p))
+
+    # return the encoding of article payloads we should use for this client
+    # or None if they're not compressed
+    def getPayloadEncoding(self):
+        if not self.fHasField(iPediaFields.acceptEncoding):
+            return None
+        if ENCODING_ZLIB in self.getFieldValue(iPediaFields.acceptEncoding).split():
+            return ENCODING_ZLIB
+        return None
+
+    # return True if we should send Reverse-Links along with articles
+    def fSendReverseLinks(self):
+        return not self.fHasField(iPediaFields.lazyReverseLinks)
+
+    # return True if we should send Article-Hash along with articles. Older
+    # clients don't know about it, so only if client sent a hash or asked
+    # for them
+    def fSendArticleHash(self):
+        return self.fHasField(iPediaFields.articleHash) or self.fHasField(iPediaFields.acceptArticleHash)
 
     def outputArticle(self, title, body, reverseLinks):
-        self.outputField(iPediaFields.formatVersion, DEFINITION_FORMAT_VERSION)
-        self.outputField(iPediaFields.articleTitle, title)
+        articleHash = None
+        if self.fSendArticleHash():
+            articleHash = getArticleHash(body)
+        self.outputArticleResponse(title, buildArticleResponse(title, body, reverseLinks, self.getPayloadEncoding(), articleHash))
+
+    # send response built with buildArticleResponse() for an article
+    # with a given title
+    def outputArticleResponse(self, title, response):
+        global g_fDumpPayload
         self.searchResult = title # for loggin
-        self.outputPayloadField(iPediaFields.articleBody, body)
-        if None != reverseLinks:
-            self.outputPayloadField(iPediaFields.reverseLinks, reverseLinks)
+        self.transport.write(response)
+        log(SEV_MED, formatField(iPediaFields.articleTitle, title))
+        if g_fDumpPayload:
+            log(SEV_HI, response)
 
     def preprocessArticleBody(self, body):
         # those macros are actually removed during conversion phase, so this
@@ -574,6 +1055,92 @@ class iPediaProtocol(LineReceiver):
         body=body.replace("{{CURRENTTIME}}",        time.strftime("%X"))
         return body
 
+    # return '\n'-separated list of titles of articles matching searchTerm
+    # (empty string if nothing matches). Results are cached in g_searchCache
+    def getFullTextMatches(self, searchTerm, startOffset=None):
+        global g_searchCache
+        # we search for normalized term so that all searches that share
+        # a cache entry really have the same results
+        searchTerm = normalizeSearchTerm(searchTerm)
+        cacheKey = (self.dbInfo.dbName, searchTerm, startOffset)
+        titles = g_searchCache.get(cacheKey)
+        if None != titles:
+            return titles
+
+        cursor = None
+        try:
+            db = self.getArticlesDatabase()
+            cursor = db.cursor()
+            titles = string.join(findFullTextMatches(db, cursor, searchTerm, startOffset), "\n")
+            cursor.close()
+        except _mysql_exceptions.Error, ex:
+            if cursor:
+                cursor.close()
+            raise
+        g_searchCache.put(cacheKey, titles, len(titles))
+        return titles
+
+    # return a tuple (error, pageSize) where pageSize is the value of
+    # Search-Page-Size or None if client didn't send it
+    def getSearchPageSize(self):
+        if not self.fHasField(iPediaFields.searchPageSize):
+            return (None, None)
+        try:
+            pageSize = int(self.getFieldValue(iPediaFields.searchPageSize))
+        except ValueError:
+            return (ServerErrors.malformedRequest, None)
+        if pageSize < 1:
+            return (ServerErrors.malformedRequest, None)
+        return (None, pageSize)
+
+    # return a list of titles of articles matching searchTerm, for a client
+    # paging through them. They're kept in g_searchCursors so that we don't
+    # split the results for each page. If we don't have them (they expired or
+    # another process did the search) we repeat the search
+    def getPagedSearchResults(self, searchTerm):
+        global g_searchCursors
+        cacheKey = (self.dbInfo.dbName, normalizeSearchTerm(searchTerm))
+        titles = g_searchCursors.get(cacheKey)
+        if None != titles:
+            return titles
+        titles = self.getFullTextMatches(searchTerm)
+        size = len(titles)
+        if 0 == size:
+            titles = []
+        else:
+            titles = titles.split("\n")
+        g_searchCursors.put(cacheKey, titles, size)
+        return titles
+
+    # send a page of search results: at most pageSize titles starting at
+    # offset and Search-Cursor if there are more
+    def outputSearchResults(self, searchTerm, titles, offset, pageSize):
+        end = min(offset + pageSize, len(titles))
+        self.outputField(iPediaFields.articleTitle, searchTerm)
+        self.outputPayloadField(iPediaFields.searchResults, string.join(titles[offset:end], "\n"))
+        if end < len(titles):
+            self.outputField(iPediaFields.searchCursor, formatSearchCursor(searchTerm, end, pageSize))
+
+    # return a tuple (error, part) where part is the part of the article
+    # client wants (see getPartRange()) or None if it wants the whole article
+    def getRequestedPart(self):
+        part = None
+        if self.fHasField(iPediaFields.articleRange):
+            part = (PART_RANGE, self.getFieldValue(iPediaFields.articleRange))
+        if self.fHasField(iPediaFields.articleSection):
+            if None != part:
+                return (ServerErrors.malformedRequest, None)
+            part = (PART_SECTION, self.getFieldValue(iPediaFields.articleSection))
+        if None == part:
+            return (None, None)
+        try:
+            part = (part[0], int(part[1]))
+        except ValueError:
+            return (ServerErrors.malformedRequest, None)
+        if part[1] < 0 or (PART_RANGE == part[0] and 0 == part[1]):
+            return (ServerErrors.malformedRequest, None)
+        return (None, part)
+
     def handleGetArticleURequest(self):
         assert self.fHasField(iPediaFields.getArticleU)
         title = self.getFieldValue(iPediaFields.getArticleU)
@@ -585,6 +1152,7 @@ class iPediaProtocol(LineReceiver):
         return self.handleGetArticleRequestGeneric(title,True)
 
     def handleGetArticleRequestGeneric(self, title, fCheckLookupLimit):
+        global g_articleCache
         if self.fHasField(iPediaFields.search) or self.fHasField(iPediaFields.getRandom):
             # those shouldn't be in the same request
             return ServerErrors.malformedRequest
@@ -593,28 +1161,243 @@ class iPediaProtocol(LineReceiver):
             if self.fOverUnregisteredLookupsLimit(self.userId):
                 return ServerErrors.lookupLimitReached
 
+        (error, part) = self.getRequestedPart()
+        if None != error:
+            return error
+
+        # responses are cached already compressed, so each encoding has
+        # its own cache entry. So does each part and responses without
+        # reverse links or Article-Hash
+        encoding = self.getPayloadEncoding()
+        fReverseLinks = self.fSendReverseLinks()
+        fArticleHash = self.fSendArticleHash()
+        # hash of the article client already has, if any
+        clientHash = self.getFieldValue(iPediaFields.articleHash)
+        cacheKey = (self.dbInfo.dbName, foldTitle(title), encoding, part, fReverseLinks, fArticleHash)
+        cached = g_articleCache.get(cacheKey)
+        if None != cached:
+            (articleTitle, response, articleHash) = cached
+            if clientHash == articleHash:
+                response = buildNotModifiedResponse(articleTitle, articleHash)
+            self.outputArticleResponse(articleTitle, response)
+            return None
+
+        titleFilter = self.dbInfo.titleFilter
+        if None != titleFilter and not titleFilter.fMightContain(foldTitle(title)):
+            # we know we don't have it, no point asking the database
+            return self.outputArticleNotFound(title)
+
         cursor = None
         try:
             db = self.getArticlesDatabase()
             cursor = db.cursor()
-            articleTuple = findArticle(db, cursor, title)
+            # (articleTitle, articleHash, body or its part, part info)
+            articleTuple = None
+            if None != part and self.dbInfo.fArticleSections:
+                # only read the part we send, and only if client doesn't
+                # have the article already
+                partInfoRow = findArticlePartInfo(db, cursor, title, self.dbInfo.redirects)
+                if partInfoRow and clientHash == partInfoRow[2]:
+                    self.outputArticleResponse(partInfoRow[1], buildNotModifiedResponse(partInfoRow[1], clientHash))
+                    cursor.close()
+                    return None
+                if partInfoRow:
+                    articleTuple = readArticlePart(cursor, partInfoRow, part)
+            else:
+                if None != clientHash and self.dbInfo.fArticleHashes:
+                    # check the hash first so that we don't read the body if
+                    # client already has it. If it doesn't, we read the body
+                    # by id instead of following redirects again
+                    hashTuple = findArticleHash(db, cursor, title, self.dbInfo.redirects)
+                    if hashTuple and clientHash == hashTuple[2]:
+                        self.outputArticleResponse(hashTuple[1], buildNotModifiedResponse(hashTuple[1], clientHash))
+                        cursor.close()
+                        return None
+                    articleRow = None
+                    if hashTuple:
+                        articleRow = findArticleById(cursor, hashTuple[0])
+                else:
+                    articleRow = findArticle(db, cursor, title, self.dbInfo.redirects)
+                if articleRow:
+                    (articleId, articleTitle, body) = articleRow
+                    articleHash = getArticleHash(body)
+                    partInfo = None
+                    if None != part:
+                        (body, partInfo) = getArticlePart(body, part)
+                    articleTuple = (articleTitle, articleHash, body, partInfo)
             if articleTuple:
-                (articleId, title, body) = articleTuple
-                reverseLinks = getReverseLinks(db,cursor,title)
+                (title, articleHash, body, partInfo) = articleTuple
+                if None == body:
+                    # there's no such section
+                    cursor.close()
+                    return ServerErrors.malformedRequest
+                reverseLinks = None
+                # reverse links are at the end of the article
+                if fReverseLinks and (None == partInfo or partInfo[0] + len(body) == partInfo[1]):
+                    reverseLinks = getReverseLinks(db,cursor,title)
                 # self.preprocessArticleBody(body)
-                self.outputArticle(title,body,reverseLinks)
+                responseHash = None
+                if fArticleHash:
+                    responseHash = articleHash
+                response = buildArticleResponse(title, body, reverseLinks, encoding, responseHash, partInfo)
+                g_articleCache.put(cacheKey, (title, response, articleHash), len(response))
+                if clientHash == articleHash:
+                    response = buildNotModifiedResponse(title, articleHash)
+                self.outputArticleResponse(title, response)
+                cursor.close()
+                return None
+            cursor.close()
+        except _mysql_exceptions.Error, ex:
+            if cursor:
+                cursor.close()
+            raise
+
+        if None != titleFilter:
+            titleFilter.noteFalsePositive()
+        return self.outputArticleNotFound(title)
+
+    # send titles similar to a title of an article we don't have if client
+    # wants them and we have any. Otherwise do full-text search
+    def outputArticleNotFound(self, title):
+        suggestions = self.dbInfo.suggestions
+        if None != suggestions and self.fHasField(iPediaFields.acceptSuggestions):
+            titles = suggestions.getSuggestions(normalizeTitle(title))
+            if len(titles) > 0:
+                self.outputField(iPediaFields.articleTitle, title)
+                self.outputPayloadField(iPediaFields.suggestions, string.join(titles, "\n"))
+                return None
+        return self.outputFullTextMatches(title)
+
+    # send titles of articles matching a title of an article we don't have
+    # or Not-Found if there are none
+    def outputFullTextMatches(self, title):
+        titles = self.getFullTextMatches(title)
+        if 0==len(titles):
+            self.outputField(iPediaFields.notFound)
+        else:
+            self.outputField(iPediaFields.articleTitle, title)
+            self.outputPayloadField(iPediaFields.searchResults, titles)
+        return None
+
+    def handleGetArticlesRequest(self):
+        global g_articleCache, g_batchTitlesLimit, g_batchBytesLimit
+        assert self.fHasField(iPediaFields.getArticles)
+        for field in [iPediaFields.getArticle, iPediaFields.getArticleU, iPediaFields.search, iPediaFields.getRandom]:
+            if self.fHasField(field):
+                # those shouldn't be in the same request
+                return ServerErrors.malformedRequest
+
+        titlesLimit = g_batchTitlesLimit
+        if not self.fRegisteredUser:
+            # each article is a lookup so unregistered users only get as many
+            # as they have left. Client will ask again for the rest and get
+            # lookupLimitReached
+            lookupsLeft = self.getUnregisteredLookupsLeft(self.userId)
+            if 0 == lookupsLeft:
+                return ServerErrors.lookupLimitReached
+            if None != lookupsLeft:
+                titlesLimit = min(titlesLimit, lookupsLeft)
+
+        titles = []
+        seen = {}
+        for title in self.getFieldValue(iPediaFields.getArticles).split("|"):
+            key = foldTitle(title)
+            if 0 == len(key) or seen.has_key(key):
+                continue
+            seen[key] = True
+            titles.append(title)
+            if len(titles) == titlesLimit:
+                break
+        if 0 == len(titles):
+            return ServerErrors.malformedRequest
+
+        # folded title => (article title, response built with buildArticleResponse(), article hash)
+        responses = {}
+        missing = []
+        encoding = self.getPayloadEncoding()
+        fReverseLinks = self.fSendReverseLinks()
+        fArticleHash = self.fSendArticleHash()
+        for title in titles:
+            cached = g_articleCache.get((self.dbInfo.dbName, foldTitle(title), encoding, None, fReverseLinks, fArticleHash))
+            if None != cached:
+                responses[foldTitle(title)] = cached
             else:
-                termList = findFullTextMatches(db, cursor, title)
-                if 0==len(termList):
-                    self.outputField(iPediaFields.notFound)
-                else:
-                    self.outputField(iPediaFields.articleTitle, title)
-                    self.outputPayloadField(iPediaFields.searchResults, string.join(termList, "\n"))
+                missing.append(title)
+
+        titleFilter = self.dbInfo.titleFilter
+        if None != titleFilter:
+            missing = [title for title in missing if titleFilter.fMightContain(foldTitle(title))]
+
+        if len(missing) > 0:
+            cursor = None
+            try:
+                db = self.getArticlesDatabase()
+                cursor = db.cursor()
+                articles = findArticles(db, cursor, missing, self.dbInfo.redirects)
+                if None != titleFilter:
+                    for i in range(len(missing) - len(articles)):
+                        titleFilter.noteFalsePositive()
+                reverseLinks = {}
+                if fReverseLinks:
+                    articleTitles = [articleTitle for (articleId, articleTitle, body) in articles.values()]
+                    reverseLinks = getReverseLinksForTitles(db, cursor, articleTitles)
+                cursor.close()
+            except _mysql_exceptions.Error, ex:
+                if cursor:
+                    cursor.close()
+                raise
+            for (key, (articleId, articleTitle, body)) in articles.items():
+                articleHash = getArticleHash(body)
+                responseHash = None
+                if fArticleHash:
+                    responseHash = articleHash
+                response = buildArticleResponse(articleTitle, body, reverseLinks.get(foldTitle(articleTitle)), encoding, responseHash)
+                g_articleCache.put((self.dbInfo.dbName, key, encoding, None, fReverseLinks, fArticleHash), (articleTitle, response, articleHash), len(response))
+                responses[key] = (articleTitle, response, articleHash)
+
+        parts = []
+        totalLen = 0
+        for title in titles:
+            articleTitle = None
+            response = formatField(iPediaFields.notFound)
+            if responses.has_key(foldTitle(title)):
+                (articleTitle, response, articleHash) = responses[foldTitle(title)]
+            entry = formatField(iPediaFields.requestedTitle, title) + response
+            # we always send at least one article, otherwise client could
+            # never get a big one
+            if len(parts) > 0 and totalLen + len(entry) > g_batchBytesLimit:
+                break
+            parts.append(entry)
+            totalLen += len(entry)
+            self.batchResults.append((title, articleTitle))
+        self.outputPayloadField(iPediaFields.articles, string.join(parts, ""))
+        return None
+
+    def handleGetReverseLinksRequest(self):
+        assert self.fHasField(iPediaFields.getReverseLinks)
+        for field in [iPediaFields.getArticle, iPediaFields.getArticleU, iPediaFields.getArticles, iPediaFields.search, iPediaFields.getRandom]:
+            if self.fHasField(field):
+                # those shouldn't be in the same request
+                return ServerErrors.malformedRequest
+
+        title = self.getFieldValue(iPediaFields.getReverseLinks)
+        cursor = None
+        try:
+            db = self.getArticlesDatabase()
+            cursor = db.cursor()
+            reverseLinks = getReverseLinks(db,cursor,title)
             cursor.close()
         except _mysql_exceptions.Error, ex:
             if cursor:
                 cursor.close()
             raise
+        if None == reverseLinks:
+            self.outputField(iPediaFields.notFound)
+            return None
+        response = buildReverseLinksResponse(title, reverseLinks, self.getPayloadEncoding())
+        self.searchResult = title # for logging
+        self.transport.write(response)
+        log(SEV_MED, formatField(iPediaFields.articleTitle, title))
         return None
 
     def handleGetAvailableLangs(self):
@@ -629,21 +1412,53 @@ class iPediaProtocol(LineReceiver):
             # those shouldn't be in the same request
             return ServerErrors.malformedRequest
 
+        (error, pageSize) = self.getSearchPageSize()
+        if None != error:
+            return error
+
         searchTerm = self.getFieldValue(iPediaFields.search)
-        cursor = None
         try:
-            db = self.getArticlesDatabase()
-            cursor = db.cursor()
-            termList = findFullTextMatches(db, cursor, searchTerm)
-            if 0==len(termList):
+            titles = self.getFullTextMatches(searchTerm)
+            if 0==len(titles):
                 self.outputField(iPediaFields.notFound)
-            else:
+            elif None == pageSize:
                 self.outputField(iPediaFields.articleTitle, searchTerm)
-                self.outputPayloadField(iPediaFields.searchResults, string.join(termList, "\n"))
-            cursor.close()
+                self.outputPayloadField(iPediaFields.searchResults, titles)
+            else:
+                self.outputSearchResults(searchTerm, self.getPagedSearchResults(searchTerm), 0, pageSize)
         except _mysql_exceptions.Error, ex:
-            if cursor:
-                cursor.close()
+            log(SEV_HI, arsutils.exceptionAsStr(ex))
+        return None
+
+    # next pages of search results usually come from g_searchCursors, so that
+    # we don't repeat the full-text search for each of them. They're not
+    # logged, the search was logged when client sent Search
+    def handleSearchNextRequest(self):
+        assert self.fHasField(iPediaFields.searchNext)
+        for field in [iPediaFields.getArticle, iPediaFields.getArticleU, iPediaFields.getArticles, iPediaFields.search, iPediaFields.getRandom, iPediaFields.getReverseLinks]:
+            if self.fHasField(field):
+                # those shouldn't be in the same request
+                return ServerErrors.malformedRequest
+
+        (error, pageSize) = self.getSearchPageSize()
+        if None != error:
+            return error
+
+        cursor = parseSearchCursor(self.getFieldValue(iPediaFields.searchNext))
+        if None == cursor:
+            return ServerErrors.malformedRequest
+        (searchTerm, offset, firstPageSize) = cursor
+        if None == pageSize:
+            pageSize = firstPageSize
+        try:
+            titles = self.getPagedSearchResults(searchTerm)
+            if offset >= len(titles):
+                # results changed since the client got the cursor (e.g. we
+                # switched to a new database)
+                return ServerErrors.searchCursorExpired
+            self.outputSearchResults(searchTerm, titles, offset, pageSize)
+        except _mysql_exceptions.Error, ex:
+            log(SEV_HI, arsutils.exceptionAsStr(ex))
         return None
 
     def handleGetRandomRequest(self):
@@ -657,8 +1472,10 @@ class iPediaProtocol(LineReceiver):
         try:
             db = self.getArticlesDatabase()
             cursor = db.cursor()
-            (articleId, title, body) = getRandomArticle(cursor)
-            reverseLinks = getReverseLinks(db,cursor,title)
+            (articleId, title, body) = getRandomArticle(cursor, self.dbInfo.articleIds)
+            reverseLinks = None
+            if self.fSendReverseLinks():
+                reverseLinks = getReverseLinks(db,cursor,title)
             # body = self.preprocessArticleBody(body)
             self.outputArticle(title,body,reverseLinks)
             cursor.close()
@@ -670,34 +1487,22 @@ class iPediaProtocol(LineReceiver):
     # Return True if a user identified by userId is over unregistered lookup
     # limits. False if not. Assumes that we don't call this if a user is registered
     def fOverUnregisteredLookupsLimit(self,userId):
-        global g_unregisteredLookupsDailyLimit, g_unregisteredLookupsLimit, g_fDisableRegistrationCheck
+        lookupsLeft = self.getUnregisteredLookupsLeft(userId)
+        if None == lookupsLeft:
+            return False
+        return 0 == lookupsLeft
+
+    # Return how many lookups a user identified by userId can do before going
+    # over unregistered lookup limits or None if there are no limits. Assumes
+    # that we don't call this if a user is registered
+    def getUnregisteredLookupsLeft(self,userId):
+        global g_unregisteredLookupsDailyLimit, g_unregisteredLookupsLimit, g_fDisableRegistrationCheck, g_lookupCounters
         assert not self.fRegisteredUser
-        cursor = None
-        fOverLimit = False
-        try:
-            db=self.getManagementDatabase()
-            cursor=db.cursor()
-            query="SELECT COUNT(*) FROM request_log WHERE NOT (request_type='r') AND user_id=%d" % userId
-            cursor.execute(query)
-            row=cursor.fetchone()
-            assert None!=row
-            totalLookups = row[0]
-            if totalLookups >= g_unregisteredLookupsLimit:
-                query="SELECT COUNT(*) FROM request_log WHERE user_id=%d AND NOT (request_type='r') AND log_date>DATE_SUB(CURDATE(), INTERVAL 1 DAY)" % self.userId
-                cursor.execute(query)
-                row=cursor.fetchone()
-                assert None != row
-                todayLookups = row[0]
-                if todayLookups >= g_unregisteredLookupsDailyLimit:
-                    fOverLimit=True
-            cursor.close()
-        except _mysql_exceptions.Error, ex:
-            if cursor:
-                cursor.close()
-            raise
         if g_fDisableRegistrationCheck:
-            fOverLimit = False
-        return fOverLimit
+            return None
+        (totalLookups, todayLookups) = g_lookupCounters.getLookupsCount(userId)
+        # a user is over limits only if over both of them
+        return max(g_unregisteredLookupsLimit - totalLookups, g_unregisteredLookupsDailyLimit - todayLookups, 0)
 
     # handle iPediaFields.verifyRegCode. If reg code is invalid append iPediaFields.regCodeValid
     # with value "0". If reg code is invalid, append iPediaFields.regCodeValid with value
@@ -705,11 +1510,12 @@ class iPediaProtocol(LineReceiver):
     # Return error if there was an error that requires aborting connection
     # Return None if all was ok
     def handleVerifyRegistrationCodeRequest(self):
+        global g_identityCache
         # by now we have to have it (from handling iPediaFields.getCookie, iPediaFields.cookie or iPediaFields.regCode)
         assert self.userId
         assert self.fHasField(iPediaFields.verifyRegCode)
         # those are the only fields that can come with iPediaFields.verifyRegCode
-        allowedFields = [iPediaFields.transactionId, iPediaFields.clientInfo, iPediaFields.protocolVersion, iPediaFields.cookie, iPediaFields.getCookie, iPediaFields.verifyRegCode, iPediaFields.getArticleCount, iPediaFields.getDatabaseTime, iPediaFields.getAvailableLangs]
+        allowedFields = [iPediaFields.transactionId, iPediaFields.clientInfo, iPediaFields.protocolVersion, iPediaFields.cookie, iPediaFields.getCookie, iPediaFields.verifyRegCode, iPediaFields.getArticleCount, iPediaFields.getDatabaseTime, iPediaFields.getAvailableLangs, iPediaFields.keepAlive, iPediaFields.acceptEncoding, iPediaFields.lazyReverseLinks, iPediaFields.acceptSuggestions]
         for field in self.fields.keys():
             if field not in allowedFields:
                 return ServerErrors.malformedRequest
@@ -736,6 +1542,11 @@ class iPediaProtocol(LineReceiver):
             cursor.execute("""UPDATE users SET reg_code='%s', registration_date=now() WHERE user_id=%d""" % (regCodeEscaped, self.userId))
             cursor.close()
 
+            disabledP = 'f'
+            if self.fUserDisabled:
+                disabledP = 't'
+            g_identityCache.putRegCodeUser(regCode, self.userId, disabledP)
+
             self.outputField(iPediaFields.regCodeValid, "1")
         except _mysql_exceptions.Error, ex:
             if cursor:
@@ -747,6 +1558,7 @@ class iPediaProtocol(LineReceiver):
     # Return error if there was a problem that requires aborting the connection
     # Return None if all was ok
     def handleRegistrationCodeRequest(self):
+        global g_identityCache
         assert self.fHasField(iPediaFields.regCode)
 
         if self.fHasField(iPediaFields.getCookie) or self.fHasField(iPediaFields.cookie):
@@ -754,33 +1566,38 @@ class iPediaProtocol(LineReceiver):
             return ServerErrors.malformedRequest
 
         regCode = self.getFieldValue(iPediaFields.regCode)
-        cursor = None
-        try:
-            db = self.getManagementDatabase()
-            cursor = db.cursor()
-            regCodeEscaped = db.escape_string(regCode)
+        row = g_identityCache.getRegCodeUser(regCode)
+        if None == row:
+            cursor = None
+            try:
+                db = self.getManagementDatabase()
+                cursor = db.cursor()
+                regCodeEscaped = db.escape_string(regCode)
 
-            cursor.execute("SELECT user_id,disabled_p FROM users WHERE reg_code='%s';" % regCodeEscaped)
-            row = cursor.fetchone()
-            cursor.close()
+                cursor.execute("SELECT user_id,disabled_p FROM users WHERE reg_code='%s';" % regCodeEscaped)
+                row = cursor.fetchone()
+                cursor.close()
+            except _mysql_exceptions.Error, ex:
+                if cursor:
+                    cursor.close()
+                raise
             if not row:
                 return ServerErrors.invalidRegCode
+            row = (int(row[0]), row[1])
+            g_identityCache.putRegCodeUser(regCode, row[0], row[1])
 
-            if 't'==row[1]:
-                return ServerErrors.userDisabled
+        if 't'==row[1]:
+            return ServerErrors.userDisabled
 
-            self.userId = int(row[0])
-            self.fRegisteredUser = True
-        except _mysql_exceptions.Error, ex:
-            if cursor:
-                cursor.close()
-            raise
+        self.userId = row[0]
+        self.fRegisteredUser = True
         return None
 
     # Set self.userId based on cookie given by client
     # Return error if there was a problem that requires aborting the connection
     # Return None if all was ok
     def handleCookieRequest(self):
+        global g_identityCache
         assert self.fHasField(iPediaFields.cookie)
 
         if self.fHasField(iPediaFields.getCookie) or self.fHasField(iPediaFields.regCode):
@@ -788,27 +1605,30 @@ class iPediaProtocol(LineReceiver):
             return ServerErrors.malformedRequest
 
         cookie = self.getFieldValue(iPediaFields.cookie)
-        cursor = None
-        try:
-            db = self.getManagementDatabase()
-            cursor = db.cursor()
-            cookieEscaped = db.escape_string(cookie)
-
-            cursor.execute("SELECT user_id,disabled_p FROM users WHERE cookie='%s';" % cookieEscaped)
-            row = cursor.fetchone()
-            cursor.close()
+        row = g_identityCache.getCookieUser(cookie)
+        if None == row:
+            cursor = None
+            try:
+                db = self.getManagementDatabase()
+                cursor = db.cursor()
+                cookieEscaped = db.escape_string(cookie)
 
+                cursor.execute("SELECT user_id,disabled_p FROM users WHERE cookie='%s';" % cookieEscaped)
+                row = cursor.fetchone()
+                cursor.close()
+            except _mysql_exceptions.Error, ex:
+                if cursor:
+                    cursor.close()
+                raise
             if not row:
                 return ServerErrors.invalidCookie
+            row = (int(row[0]), row[1])
+            g_identityCache.putCookieUser(cookie, row[0], row[1])
 
-            if 't'==row[1]:
-                return ServerErrors.userDisabled
+        if 't'==row[1]:
+            return ServerErrors.userDisabled
 
-            self.userId = int(row[0])
-        except _mysql_exceptions.Error, ex:
-            if cursor:
-                cursor.close()
-            raise
+        self.userId = row[0]
         return None
 
     # Assign a cookie to the user. Try to re-use cookie based on deviceInfo
@@ -816,6 +1636,7 @@ class iPediaProtocol(LineReceiver):
     # Return error if there was a problem that requires aborting the connection
     # Return None if all was ok
     def handleGetCookieRequest(self):
+        global g_identityCache
         assert self.fHasField(iPediaFields.getCookie)
 
         if self.fHasField(iPediaFields.regCode) or self.fHasField(iPediaFields.cookie):
@@ -834,12 +1655,13 @@ class iPediaProtocol(LineReceiver):
 
             fNeedsCookie = True
             if fDeviceInfoUnique(deviceInfo):
-                cursor.execute("SELECT user_id,cookie,reg_code FROM users WHERE device_info='%s';" % deviceInfoEscaped)
+                cursor.execute("SELECT user_id,cookie,reg_code,disabled_p FROM users WHERE device_info='%s';" % deviceInfoEscaped)
                 row = cursor.fetchone()
                 if row:
                     self.userId = int(row[0])
                     cookie = row[1]
                     fNeedsCookie = False
+                    self.fUserDisabled = ('t' == row[3])
                     # TODO: what to do if reg_code exists for this row?
                     # This can happen in the scenario:
                     #  - Get-Cookie
@@ -856,6 +1678,10 @@ class iPediaProtocol(LineReceiver):
                 cursor.execute(query)
                 self.userId=cursor.lastrowid
 
+            disabledP = 'f'
+            if self.fUserDisabled:
+                disabledP = 't'
+            g_identityCache.putCookieUser(cookie, self.userId, disabledP)
             self.outputField(iPediaFields.cookie, cookie)
             cursor.close()
 
@@ -974,6 +1800,7 @@ class iPediaProtocol(LineReceiver):
         try:
             # empty line marks end of request
             if request == "":
+                self.fRequestComplete = True
                 return self.answer(None)
 
             log(SEV_MED, "%s\n" % request)
@@ -1017,13 +1844,25 @@ clientFieldsHandlers = {
 
     iPediaFields.getArticle        : iPediaProtocol.handleGetArticleRequest,
     iPediaFields.getArticleU       : iPediaProtocol.handleGetArticleURequest,
+    iPediaFields.getArticles       : iPediaProtocol.handleGetArticlesRequest,
     iPediaFields.getRandom         : iPediaProtocol.handleGetRandomRequest,
     iPediaFields.search            : iPediaProtocol.handleSearchRequest,
+    iPediaFields.searchPageSize    : None,
+    iPediaFields.searchNext        : iPediaProtocol.handleSearchNextRequest,
     iPediaFields.getArticleCount   : None,
     iPediaFields.getDatabaseTime   : None,
 
     iPediaFields.getAvailableLangs : iPediaProtocol.handleGetAvailableLangs,
     iPediaFields.useLang           : None,
+    iPediaFields.keepAlive         : None,
+    iPediaFields.acceptEncoding    : None,
+    iPediaFields.articleHash       : None,
+    iPediaFields.acceptArticleHash : None,
+    iPediaFields.articleRange      : None,
+    iPediaFields.articleSection    : None,
+    iPediaFields.lazyReverseLinks  : None,
+    iPediaFields.acceptSuggestions : None,
+    iPediaFields.getReverseLinks   : iPediaProtocol.handleGetReverseLinksRequest,
 }
 
 def getFieldHandler(fieldName):
@@ -1046,12 +1885,143 @@ def getDbInfo(dbName):
     cursor.execute("""SELECT COUNT(*) FROM redirects""")
     row = cursor.fetchone()
     redirectsCount = row[0]
+    cursor.execute("""SHOW COLUMNS FROM articles LIKE 'hash'""")
+    fArticleHashes = (None != cursor.fetchone())
+    cursor.execute("""SHOW COLUMNS FROM articles LIKE 'sections'""")
+    fArticleSections = (None != cursor.fetchone())
     cursor.close()
     db.close()
 
     dbInfo = DbInfo(dbName,lang, articlesCount, dbDate, redirectsCount, minDefinitionId, maxDefinitionId)
+    dbInfo.fArticleHashes = fArticleHashes
+    # we need hashes of whole articles when we only read parts of them
+    dbInfo.fArticleSections = fArticleSections and fArticleHashes
     return dbInfo
 
+# load redirects table of a given database into RedirectsMap
+def loadRedirectsMap(dbName):
+    pairs = []
+    db = createArticlesConnection(dbName)
+    cursor = db.cursor()
+    cursor.execute("""SELECT title, redirect FROM redirects""")
+    while True:
+        rows = cursor.fetchmany(10000)
+        if 0 == len(rows):
+            break
+        for row in rows:
+            pairs.append((foldTitle(row[0]), row[1]))
+    cursor.close()
+    db.close()
+    return RedirectsMap(pairs)
+
+# return an array with ids of all articles in a given database
+def loadArticleIds(dbName):
+    articleIds = array.array('L')
+    db = createArticlesConnection(dbName)
+    cursor = db.cursor()
+    cursor.execute("""SELECT id FROM articles""")
+    while True:
+        rows = cursor.fetchmany(10000)
+        if 0 == len(rows):
+            break
+        for row in rows:
+            articleIds.append(row[0])
+    cursor.close()
+    db.close()
+    return articleIds
+
+# return a list of tuples (normalized title, title) of all articles in
+# a given database
+def loadArticleTitles(dbName):
+    pairs = []
+    db = createArticlesConnection(dbName)
+    cursor = db.cursor()
+    cursor.execute("""SELECT title FROM articles""")
+    while True:
+        rows = cursor.fetchmany(10000)
+        if 0 == len(rows):
+            break
+        for row in rows:
+            pairs.append((normalizeTitle(row[0]), row[0]))
+    cursor.close()
+    db.close()
+    return pairs
+
+def getSuggestionIndexFileName(dbName):
+    global g_suggestionsDir
+    return os.path.join(g_suggestionsDir, "%s.suggest" % dbName)
+
+# return SuggestionIndex of a database described by dbInfo. We load it from
+# the file if we have one built from the same articles (as far as we can tell
+# from their number and ids), otherwise we build it and save it for the next
+# time
+def loadSuggestionIndex(dbInfo):
+    global g_suggestionsDir
+    dbName = dbInfo.dbName
+    fileName = getSuggestionIndexFileName(dbName)
+    sourceStamp = (dbInfo.articlesCount, dbInfo.minDefId, dbInfo.maxDefId)
+    index = SuggestionIndex.loadSuggestionIndex(fileName, sourceStamp)
+    if None != index:
+        return index
+    print "Building suggestion index for '%s'" % dbName
+    index = SuggestionIndex.buildSuggestionIndex(loadArticleTitles(dbName))
+    try:
+        if not os.path.isdir(g_suggestionsDir):
+            os.makedirs(g_suggestionsDir)
+        index.save(fileName, sourceStamp)
+    except (IOError, OSError), ex:
+        # not a big deal, we'll build it again next time
+        print "Couldn't save suggestion index to '%s': %s" % (fileName, str(ex))
+    return index
+
+# return TitleFilter with all article titles (from SuggestionIndex, so that
+# we don't have to read them from the database again) and all titles in
+# redirects
+def buildTitleFilter(suggestions, redirects):
+    titleFilter = TitleFilter(suggestions.getCount() + redirects.getCount())
+    for title in suggestions.titles:
+        titleFilter.add(foldTitle(title))
+    # titles in RedirectsMap are already folded
+    for title in redirects.titles:
+        titleFilter.add(title)
+    return titleFilter
+
+# must be called before a database becomes the current database for its
+# language. Loads the data we keep in memory for current databases
+def activateDbInfo(dbInfo):
+    if None == dbInfo.redirects:
+        dbInfo.redirects = loadRedirectsMap(dbInfo.dbName)
+    if None == dbInfo.articleIds:
+        dbInfo.articleIds = loadArticleIds(dbInfo.dbName)
+    if None == dbInfo.suggestions:
+        dbInfo.suggestions = loadSuggestionIndex(dbInfo)
+    if None == dbInfo.titleFilter:
+        dbInfo.titleFilter = buildTitleFilter(dbInfo.suggestions, dbInfo.redirects)
+
+# called when a database stops being current database for its language
+# to free the memory used by activateDbInfo(). Requests that are still using
+# dbInfo will fall back to querying the database
+def deactivateDbInfo(dbInfo):
+    dbInfo.redirects = None
+    dbInfo.articleIds = None
+    dbInfo.titleFilter = None
+    dbInfo.suggestions = None
+
+# return a line describing memory we use for data loaded by activateDbInfo()
+def getDbInfoMemoryTxt(dbInfo):
+    parts = []
+    if None != dbInfo.redirects:
+        parts.append("%d redirects (%d kB)" % (dbInfo.redirects.getCount(), dbInfo.redirects.getMemoryUsage() / 1024))
+    if None != dbInfo.articleIds:
+        parts.append("%d article ids (%d kB)" % (len(dbInfo.articleIds), len(dbInfo.articleIds) * dbInfo.articleIds.itemsize / 1024))
+    if None != dbInfo.suggestions:
+        parts.append("%d titles for suggestions (%d kB)" % (dbInfo.suggestions.getCount(), dbInfo.suggestions.getMemoryUsage() / 1024))
+    if None != dbInfo.titleFilter:
+        parts.append("title filter (%d kB, %.2f%% false positives)" % (dbInfo.titleFilter.getMemoryUsage() / 1024, 100.0 * dbInfo.titleFilter.getFalsePositiveRate()))
+    if 0 == len(parts):
+        return "nothing in memory"
+    return "in memory: %s" % string.join(parts, ", ")
+
 dbDateRe = re.compile("[0-9]{8}", re.I)
 def fDbDate(dbDate):
     if not dbDateRe.match(dbDate):
@@ -1110,6 +2080,9 @@ class iPediaTelnetProtocol(LineReceiver):
 
     listRe=re.compile(r'\s*list\s*', re.I)
     useDbRe=re.compile(r'\s*use\s+(\w+)\s*', re.I)
+    statsRe=re.compile(r'\s*stats\s*', re.I)
+    flushLogsRe=re.compile(r'\s*flushlogs\s*', re.I)
+    reloadUsersRe=re.compile(r'\s*reloadusers\s*', re.I)
 
     def __init__(self):
         self.delimiter='\n'
@@ -1171,11 +2144,22 @@ class iPediaTelnetProtocol(LineReceiver):
             if dbInfo.articlesCount < requiredCount:
                 self.transport.write("Database '%s' doesn't have enough articles ('%d', at least %d required)\r\n" % (dbInfo.dbName, dbInfo.articlesCount, requiredCount))
                 return
+            activateDbInfo(dbInfo)
             setCurrDbForLang(dbInfo.lang, dbInfo)
+            # we won't be using the old database so no point keeping connections
+            # to it or cached articles from it
+            oldDbName = dbForLang.dbName
+            deactivateDbInfo(dbForLang)
+            g_connectionPool.closeIdleConnections(oldDbName)
+            g_articleCache.removeMatching(lambda key: key[0] == oldDbName)
+            g_searchCache.removeMatching(lambda key: key[0] == oldDbName)
+            g_searchCursors.removeMatching(lambda key: key[0] == oldDbName)
             self.transport.write("Switching to database %s, lang=%s\n" % (dbInfo.dbName, dbInfo.lang))
             self.transport.write("Number of Wikipedia articles: %d\n" % dbInfo.articlesCount)
             self.transport.write("Number of redirects: %d\n" % dbInfo.redirectsCount)
+            self.transport.write("%s\n" % getDbInfoMemoryTxt(dbInfo))
             self.transport.write("Databse date: %s\n" % dbInfo.dbDate)
+            return True
 
         except _mysql_exceptions.Error, ex:
             txt = arsutils.exceptionAsStr(ex)
@@ -1183,6 +2167,37 @@ class iPediaTelnetProtocol(LineReceiver):
             self.transport.write("exception: %s \r\n" % txt)
             return
 
+    # show statistics of various server subsystems
+    def showStats(self):
+        global g_connectionPool, g_articleCache, g_searchCache, g_searchCursors, g_logWriter, g_lookupCounters, g_identityCache, g_supportedLangs
+        self.transport.write("network:\n  %s\n" % EventServer.getStatsLine())
+        self.transport.write("connection pool:\n")
+        for line in g_connectionPool.getStatsLines():
+            self.transport.write("  %s\n" % line)
+        self.transport.write("article cache:\n  %s\n" % g_articleCache.getStatsLine())
+        self.transport.write("search cache:\n  %s\n" % g_searchCache.getStatsLine())
+        self.transport.write("search cursors:\n  %s\n" % g_searchCursors.getStatsLine())
+        self.transport.write("log writer:\n  %s\n" % g_logWriter.getStatsLine())
+        self.transport.write("lookup counters:\n  %s\n" % g_lookupCounters.getStatsLine())
+        self.transport.write("identity cache:\n")
+        for line in g_identityCache.getStatsLines():
+            self.transport.write("  %s\n" % line)
+        self.transport.write("databases:\n")
+        for lang in g_supportedLangs:
+            dbInfo = getCurrDbForLang(lang)
+            if None != dbInfo:
+                self.transport.write("  %s: %s, %s\n" % (lang, dbInfo.dbName, getDbInfoMemoryTxt(dbInfo)))
+                titleFilter = dbInfo.titleFilter
+                if None != titleFilter:
+                    self.transport.write("    title filter: %s\n" % titleFilter.getStatsLine())
+
+    # in -workers mode, the supervisor process doesn't serve clients. Commands
+    # are executed by all worker processes and we show what each of them said
+    def forwardToWorkers(self, request):
+        for (pid, output) in PreforkServer.sendCommandToWorkers(request.strip()):
+            self.transport.write("worker %d:\n" % pid)
+            self.transport.write(output)
+
     def lineReceived(self, request):
         # print "telnet: '%s'" % request
         if iPediaTelnetProtocol.listRe.match(request):
@@ -1191,13 +2206,44 @@ class iPediaTelnetProtocol(LineReceiver):
 
         match = iPediaTelnetProtocol.useDbRe.match(request)
         if match:
-            self.useDatabase(match.group(1))
+            fSwitched = self.useDatabase(match.group(1))
+            # the supervisor switches too, so that workers it starts
+            # from now on use the new database
+            if fSwitched and PreforkServer.fSupervisor():
+                self.forwardToWorkers(request)
+            return
+
+        if PreforkServer.fSupervisor():
+            if iPediaTelnetProtocol.statsRe.match(request) or iPediaTelnetProtocol.flushLogsRe.match(request) or iPediaTelnetProtocol.reloadUsersRe.match(request):
+                self.forwardToWorkers(request)
+            else:
+                self.transport.loseConnection()
+            return
+
+        if iPediaTelnetProtocol.statsRe.match(request):
+            self.showStats()
+            return
+
+        if iPediaTelnetProtocol.flushLogsRe.match(request):
+            g_logWriter.flush()
+            self.transport.write("log writer:\n  %s\n" % g_logWriter.getStatsLine())
+            return
+
+        if iPediaTelnetProtocol.reloadUsersRe.match(request):
+            try:
+                reloadIdentityCache()
+            except _mysql_exceptions.Error, ex:
+                txt = arsutils.exceptionAsStr(ex)
+                log(SEV_HI, txt)
+                self.transport.write("exception: %s \r\n" % txt)
+                return
+            self.transport.write("identity cache reloaded\n")
             return
 
         self.transport.loseConnection()
 
 def usageAndExit():
-    print "iPediaServer.py [-demon] [-verbose] [-usepsyco] [-listdbs] [-db name]"
+    print "iPediaServer.py [-demon] [-verbose] [-usepsyco] [-listdbs] [-db name] [-articlecache bytes] [-searchcache bytes] [-batchtitles N] [-batchbytes bytes] [-suggestdir dir] [-threaded] [-workers N]"
     sys.exit(0)
 
 def getLangFromDbName(dbName):
@@ -1261,8 +2307,13 @@ def getLatestDbForLang(lang):
                     latestDb = dbInfo
     return latestDb
 
+# SIGTERM (e.g. from killipedia.py) makes us exit as if on Ctrl-C, so that
+# buffered logs and counters are written
+def exitOnSigterm(signum, frame):
+    sys.exit(0)
+
 def main():
-    global g_fPsycoAvailable, g_acceptedLogSeverity, g_supportedLangs, g_fDisableRegistrationCheck
+    global g_fPsycoAvailable, g_acceptedLogSeverity, g_supportedLangs, g_fDisableRegistrationCheck, g_articleCache, g_searchCache, g_batchTitlesLimit, g_batchBytesLimit, g_suggestionsDir
 
     fDemon = arsutils.fDetectRemoveCmdFlag("-demon")
     if not fDemon:
@@ -1280,6 +2331,11 @@ def main():
     if None != arsutils.fDetectRemoveCmdFlag( "-verbose" ):
         g_acceptedLogSeverity = SEV_MED
 
+    fThreaded = arsutils.fDetectRemoveCmdFlag("-threaded")
+    workersCount = arsutils.getRemoveCmdArgInt("-workers")
+    if None != workersCount and (fThreaded or workersCount < 1):
+        usageAndExit()
+
     fUsePsyco = arsutils.fDetectRemoveCmdFlag("-usepsyco")
     if g_fPsycoAvailable and fUsePsyco:
         print "using psyco"
@@ -1296,6 +2352,28 @@ def main():
             print name
         sys.exit(0)
 
+    articleCacheSize = arsutils.getRemoveCmdArgInt("-articlecache")
+    if None != articleCacheSize:
+        g_articleCache = LruCache(articleCacheSize)
+
+    searchCacheSize = arsutils.getRemoveCmdArgInt("-searchcache")
+    if None != searchCacheSize:
+        g_searchCache = LruCache(searchCacheSize, SEARCH_CACHE_TTL)
+
+    batchTitlesLimit = arsutils.getRemoveCmdArgInt("-batchtitles")
+    if None != batchTitlesLimit:
+        if batchTitlesLimit < 1:
+            usageAndExit()
+        g_batchTitlesLimit = batchTitlesLimit
+
+    batchBytesLimit = arsutils.getRemoveCmdArgInt("-batchbytes")
+    if None != batchBytesLimit:
+        g_batchBytesLimit = batchBytesLimit
+
+    suggestionsDir = arsutils.getRemoveCmdArg("-suggestdir")
+    if None != suggestionsDir:
+        g_suggestionsDir = os.path.abspath(suggestionsDir)
+
     enDb = arsutils.getRemoveCmdArg("-en")
     frDb = arsutils.getRemoveCmdArg("-fr")
     deDb = arsutils.getRemoveCmdArg("-de")
@@ -1306,6 +2384,7 @@ def main():
     for lang in g_supportedLangs:
         dbInfo = getLatestDbForLang(lang)
         if None != dbInfo:
+            activateDbInfo(dbInfo)
             setCurrDbForLang(lang,dbInfo)
 
     allDbNames = getAllDbNames()
@@ -1316,6 +2395,7 @@ def main():
             print "No database for lang '%s'" % lang
         else:
             print "Using db '%s' for lang '%s', %d articles" % (dbInfo.dbName, lang, int(dbInfo.articlesCount))
+            print "  %s" % getDbInfoMemoryTxt(dbInfo)
 
     if None != enDb:
         # TODO: add selecting the db
@@ -1324,12 +2404,50 @@ def main():
     if fDemon:
         arsutils.daemonize('/dev/null','/ipedia/ipedia.log','/ipedia/ipedia.log')
 
+    signal.signal(signal.SIGTERM, exitOnSigterm)
+
     telnetPort = 9303 # a random number
-    runTelnetServer(telnetPort, iPediaTelnetProtocol)
+    reloadIdentityCache()
+    g_lookupCounters.load()
+    print "Loaded lookup counters of %d users" % g_lookupCounters.getUsersCount()
     port = 9000
-    runServer(port, iPediaProtocol)
-    while True:
-        time.sleep(10)
+    if None != workersCount:
+        # everything loaded so far is shared by workers (until they modify it)
+        startTelnetProc = lambda: runTelnetServer(telnetPort, iPediaTelnetProtocol)
+        PreforkServer.runPreforkServer(port, workersCount, runWorker, g_connectionPool.closeAllIdleConnections, getForkLocks(), startTelnetProc, iPediaTelnetProtocol)
+    else:
+        runTelnetServer(telnetPort, iPediaTelnetProtocol)
+        runWorker(None, fThreaded)
+
+# return locks of objects that telnet commands use in the supervisor process
+# of -workers mode. They must not be locked when we fork a worker
+def getForkLocks():
+    global g_connectionPool, g_articleCache, g_searchCache, g_searchCursors, g_logWriter, g_identityCache, g_lookupCounters
+    return [g_connectionPool.lock, g_articleCache.lock, g_searchCache.lock, g_searchCursors.lock, g_logWriter.queue.mutex, g_identityCache.lock, g_identityCache.cookies.lock, g_identityCache.regCodes.lock, g_lookupCounters.lock]
+
+# serve clients on port 9000. serverSocket is the listening socket inherited
+# from the supervisor in -workers mode
+def runWorker(serverSocket, fThreaded=False):
+    global g_logWriter, g_lookupCounters
+    port = 9000
+    fShared = None != serverSocket
+    if fShared:
+        # we're one of many worker processes. What the supervisor loaded
+        # might be out of date if we were restarted and other workers
+        # count lookups too, so we keep reloading counters
+        reloadIdentityCache()
+        g_lookupCounters.reload()
+    g_lookupCounters.start(fShared)
+    g_logWriter.start()
+    try:
+        if fThreaded:
+            runServer(port, iPediaProtocol)
+        else:
+            EventServer.runEventServer(port, iPediaProtocol, serverSocket=serverSocket)
+    finally:
+        # don't loose log records and counters that haven't been written yet
+        g_logWriter.close()
+        g_lookupCounters.close()
 
 if __name__ == "__main__":
     main()
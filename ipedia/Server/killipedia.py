@@ -1,18 +1,32 @@
-import os, string, arsutils
+import os, string, time, arsutils
 
-if __name__ == '__main__':
-    pidOwnerList = arsutils.pids("python2.4", "iPediaServer.py")
+# how long (in seconds) we give the server to write buffered logs and
+# counters after asking it nicely to stop
+SHUTDOWN_TIME = 10
+
+def getServerPids():
     user = os.environ["USER"] # who am i
     userId = os.getuid()
-    for [pid,owner] in pidOwnerList:
-        if str(owner) == str(user) or str(owner) == str(userId):
-            cmd = 'kill -9 %s' % pid
-            r = os.popen(cmd, 'r')
-            
+    pids = []
     # TODO: for now also kill those started with older python
-    pidOwnerList = arsutils.pids("python", "iPediaServer.py")
-    for [pid,owner] in pidOwnerList:
-        if str(owner) == str(user) or str(owner) == str(userId):
-            cmd = 'kill -9 %s' % pid
-            r = os.popen(cmd, 'r')
+    for program in ["python2.4", "python"]:
+        pidOwnerList = arsutils.pids(program, "iPediaServer.py")
+        for [pid,owner] in pidOwnerList:
+            if str(owner) == str(user) or str(owner) == str(userId):
+                pids.append(pid)
+    return pids
 
+def killPids(pids, signalOpt):
+    for pid in pids:
+        cmd = 'kill %s %s' % (signalOpt, pid)
+        r = os.popen(cmd, 'r')
+        r.close()
+
+if __name__ == '__main__':
+    # SIGTERM first, so that the server can shut down cleanly
+    killPids(getServerPids(), "")
+    for i in range(SHUTDOWN_TIME):
+        if 0 == len(getServerPids()):
+            break
+        time.sleep(1)
+    killPids(getServerPids(), "-9")
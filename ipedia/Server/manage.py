@@ -12,7 +12,7 @@ g_serverList = ["localhost:9303", "ipedia.arslexis.com:9303"]
 g_defaultServerNo = 1 # index within g_serverList
 
 def usageAndExit():
-    print "manage.py [-listdbs] [-use dbName]"
+    print "manage.py [-listdbs] [-use dbName] [-stats] [-flushlogs]"
     sys.exit(0)
 
 def getServerNamePort():
@@ -117,6 +117,12 @@ def findDbByNum(num):
 
 if __name__=="__main__":
     print "using server %s" % g_serverList[g_defaultServerNo]
+    if arsutils.fDetectRemoveCmdFlag("-stats"):
+        print getReqResponse("stats\n")
+        sys.exit(0)
+    if arsutils.fDetectRemoveCmdFlag("-flushlogs"):
+        print getReqResponse("flushlogs\n")
+        sys.exit(0)
     readAndDisplayListOfDatabases()
     while True:
         input = raw_input("Enter db number to use or q to exit: ")
@@ -19,10 +19,13 @@
 #             Don't use if ipedia.articles isn't empty
 # -nopsyco : if used, won't use psyco
 # -revlinksonly : only do reverse links
+# -addhashes : only add hash column to articles table of an existing database
+# -addsections : only add sections column to articles table of an existing database
+# -jobs n : convert articles in n processes (on systems with fork())
 # fileName : convert directly from sql file, no need for enwiki.cur database
 
-import sys, os, string, MySQLdb
-import  arsutils, wikipediasql,articleconvert,iPediaServer
+import sys, os, string, marshal, signal, MySQLdb
+import  arsutils, wikipediasql,articleconvert,iPediaServer,LookupCounters,ArticleSections
 try:
     import psyco
     g_fPsycoAvailable = True
@@ -47,7 +50,7 @@ DB_PWD         = 'ipedia'
 MANAGEMENT_DB  = 'ipedia_manage'
 
 def usageAndExit():
-    print "wikiToDbConvert.py [-verbose] [-revlinksonly] [-limit n] [-showdups] [-nopsyco] [-recreatedb] [-recreatedatadb] sqlDumpName"
+    print "wikiToDbConvert.py [-verbose] [-revlinksonly] [-addhashes] [-addsections] [-limit n] [-jobs n] [-showdups] [-nopsyco] [-recreatedb] [-recreatedatadb] sqlDumpName"
     sys.exit(0)
 
 def getOneResult(conn,query):
@@ -227,6 +230,114 @@ def getDbNameFromFileName(sqlFileName):
     dbName = "ipedia_%s_%s" % (lang, date)
     return dbName
 
+# return the value of sections column for a converted article
+def getSectionsTxt(converted):
+    return ArticleSections.formatSections(ArticleSections.findSections(converted))
+
+# convert article text to our format and remove links to articles we don't have
+def convertArticleText(title, txt, redirects, articleTitles):
+    converted = articleconvert.convertArticle(title, txt)
+    try:
+        noLinks = articleconvert.removeInvalidLinks(converted,redirects,articleTitles)
+    except:
+        print "exception in articleconvert.removeInvalidLinks"
+        print "title: _%s_" % title
+        print "txt:\n_%s_" % txt
+        print "converted:\n_%s_" % converted
+
+        raise
+    if noLinks:
+        converted = noLinks
+    return converted
+
+# iterate over articles in the cache of sqlDump, returning tuples
+# (article, converted text). Converted text is None for redirects
+def iterConvertedArticles(sqlDump, articleLimit, redirects, articleTitles):
+    for article in wikipediasql.iterWikipediaArticles(sqlDump, articleLimit, True, False):
+        converted = None
+        if not article.fRedirect():
+            converted = convertArticleText(article.getTitle(), article.getText(), redirects, articleTitles)
+        yield (article, converted)
+
+# runs in a process forked by startConversionJobs(). Converts every
+# jobsCount-th article (not counting redirects), starting with jobNo-th and
+# writes converted texts to fo
+def convertArticlesJob(sqlDump, articleLimit, redirects, articleTitles, jobNo, jobsCount, fo):
+    articleNo = 0
+    for article in wikipediasql.iterWikipediaArticles(sqlDump, articleLimit, True, False):
+        if article.fRedirect():
+            continue
+        if jobNo == articleNo % jobsCount:
+            converted = convertArticleText(article.getTitle(), article.getText(), redirects, articleTitles)
+            marshal.dump(converted, fo)
+        articleNo += 1
+    fo.close()
+
+# start jobsCount processes converting articles for
+# iterConvertedArticlesParallel(). We fork after redirects and articleTitles
+# are built, so processes share them (copy-on-write). Return a list of tuples
+# (pid, file with converted texts), which must be passed to
+# stopConversionJobs() when we're done, even if something failed
+def startConversionJobs(sqlDump, articleLimit, redirects, articleTitles, jobsCount):
+    # so that buffered output isn't written by forked processes again
+    sys.stdout.flush()
+    sys.stderr.flush()
+    jobs = []
+    for jobNo in range(jobsCount):
+        (fdRead, fdWrite) = os.pipe()
+        pid = os.fork()
+        if 0 == pid:
+            exitCode = 1
+            try:
+                try:
+                    os.close(fdRead)
+                    for (jobPid, fi) in jobs:
+                        fi.close()
+                    convertArticlesJob(sqlDump, articleLimit, redirects, articleTitles, jobNo, jobsCount, os.fdopen(fdWrite, "wb"))
+                    exitCode = 0
+                except Exception, ex:
+                    print "exception in conversion job %d" % jobNo
+                    print arsutils.exceptionAsStr(ex)
+            finally:
+                # don't run cleanup of the parent (e.g. closing its MySQL connection)
+                sys.stdout.flush()
+                os._exit(exitCode)
+        os.close(fdWrite)
+        jobs.append((pid, os.fdopen(fdRead, "rb")))
+    return jobs
+
+# kill processes started with startConversionJobs() (they might still be
+# converting if we stopped reading, e.g. because of an error) and wait for them
+def stopConversionJobs(jobs):
+    for (pid, fi) in jobs:
+        fi.close()
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            # already exited
+            pass
+    for (pid, fi) in jobs:
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+# like iterConvertedArticles() but converted texts come from processes
+# started with startConversionJobs(). We read them in the order of articles,
+# so the result is exactly the same as with iterConvertedArticles()
+def iterConvertedArticlesParallel(sqlDump, articleLimit, jobs):
+    articleNo = 0
+    for article in wikipediasql.iterWikipediaArticles(sqlDump, articleLimit, True, False):
+        converted = None
+        if not article.fRedirect():
+            jobNo = articleNo % len(jobs)
+            try:
+                converted = marshal.load(jobs[jobNo][1])
+            except EOFError:
+                raise Exception("conversion job %d failed, see the log" % jobNo)
+            articleNo += 1
+        yield (article, converted)
+
 # First pass: go over all articles, either directly from
 # sql dump or from cache and gather the following cache
 # data:
@@ -238,7 +349,7 @@ def getDbNameFromFileName(sqlFileName):
 # case-sensitive but our title column in the database is not. Currently we just
 # over-write. It's ok for redirects but for real articles we need to investigate
 # how often that happens and decide what to do about that
-def convertArticles(sqlDump, articleLimit):
+def convertArticles(sqlDump, articleLimit, jobsCount=None):
     count = 0
     redirects = {}
     articleTitles = {}
@@ -292,67 +403,67 @@ def convertArticles(sqlDump, articleLimit):
     count = 0
     convWriter = wikipediasql.ConvertedArticleCacheWriter(sqlDump)
     convWriter.open()
-    for article in wikipediasql.iterWikipediaArticles(sqlDump, articleLimit, True, False):
-        title = article.getTitle()
-        articleSize = 0 # 0 is for redirects, which we don't log
-        if article.fRedirect():
-            convertedArticle = ConvertedArticleRedirect(article.getNamespace(), title, article.getRedirect())
-        else:
-            txt = article.getText()
-            converted = articleconvert.convertArticle(title, txt)
-            try:
-                noLinks = articleconvert.removeInvalidLinks(converted,redirects,articleTitles)
-            except:
-                print "exception in articleconvert.removeInvalidLinks"
-                print "title: _%s_" % title
-                print "txt:\n_%s_" % txt
-                print "converted:\n_%s_" % converted
-
-                raise
-            if noLinks:
-                converted = noLinks
-            convertedArticle = ConvertedArticle(article.getNamespace(), article.getTitle(), converted)
-            articleSize = len(converted)
-
-        if article.fRedirect():
-            if redirectsExisting.has_key(title):
-                redirect = redirectsExisting[title]
+    # jobs read articles from the cache, which exists after the first pass
+    jobs = []
+    if None != jobsCount and jobsCount > 1 and hasattr(os, "fork") and wikipediasql.fCacheExists(sqlDump):
+        print "converting articles in %d processes" % jobsCount
+        jobs = startConversionJobs(sqlDump, articleLimit, redirects, articleTitles, jobsCount)
+        convertedArticles = iterConvertedArticlesParallel(sqlDump, articleLimit, jobs)
+    else:
+        convertedArticles = iterConvertedArticles(sqlDump, articleLimit, redirects, articleTitles)
+    # if something fails, jobs might still be converting (or waiting for
+    # us to read what they converted), so we always stop them
+    try:
+        for (article, converted) in convertedArticles:
+            title = article.getTitle()
+            articleSize = 0 # 0 is for redirects, which we don't log
+            if article.fRedirect():
+                convertedArticle = ConvertedArticleRedirect(article.getNamespace(), title, article.getRedirect())
+            else:
+                convertedArticle = ConvertedArticle(article.getNamespace(), article.getTitle(), converted)
+                articleSize = len(converted)
+
+            if article.fRedirect():
+                if redirectsExisting.has_key(title):
+                    redirect = redirectsExisting[title]
+                    try:
+                        title = title.replace("_", " ")
+                        redirect = redirect.replace("_", " ")
+                        ipedia_write_cur.execute("""INSERT INTO redirects (title, redirect) VALUES ('%s', '%s')""" % (dbEscape(title), dbEscape(redirect)))
+                    except:
+                        print "DUP REDERICT '%s' => '%s'" % (title, redirect)
+            else:
+                title = title.replace("_", " ")
+                if g_fVerbose:
+                    log_txt = "title: %s " % title
                 try:
-                    title = title.replace("_", " ")
-                    redirect = redirect.replace("_", " ")
-                    ipedia_write_cur.execute("""INSERT INTO redirects (title, redirect) VALUES ('%s', '%s')""" % (dbEscape(title), dbEscape(redirect)))
+                    ipedia_write_cur.execute("""INSERT INTO articles (title, body, hash, sections) VALUES ('%s', '%s', '%s', '%s')""" % (dbEscape(title), dbEscape(converted), iPediaServer.getArticleHash(converted), dbEscape(getSectionsTxt(converted))))
+                    if g_fVerbose:
+                        log_txt += "*New record"
                 except:
-                    print "DUP REDERICT '%s' => '%s'" % (title, redirect)
-        else:
-            title = title.replace("_", " ")
-            if g_fVerbose:
-                log_txt = "title: %s " % title
-            try:
-                ipedia_write_cur.execute("""INSERT INTO articles (title, body) VALUES ('%s', '%s')""" % (dbEscape(title), dbEscape(converted)))
-                if g_fVerbose:
-                    log_txt += "*New record"
-            except:
-                # assuming that the exception happend because of trying to insert
-                # item with a duplicate title (duplication due to lower-case
-                # conversion might convert 2 differnt titles into the same,
-                # lower-cased title)
-                if g_fShowDups:
-                    print "dup: " + title
+                    # assuming that the exception happend because of trying to insert
+                    # item with a duplicate title (duplication due to lower-case
+                    # conversion might convert 2 differnt titles into the same,
+                    # lower-cased title)
+                    if g_fShowDups:
+                        print "dup: " + title
+                    if g_fVerbose:
+                        log_txt += "Update existing record"
+                    print "DUP ARTICLE: '%s'" % title
+                    ipedia_write_cur.execute("""UPDATE articles SET body='%s', hash='%s', sections='%s' WHERE title='%s'""" % (dbEscape(converted), iPediaServer.getArticleHash(converted), dbEscape(getSectionsTxt(converted)), dbEscape(title)))
                 if g_fVerbose:
-                    log_txt += "Update existing record"
-                print "DUP ARTICLE: '%s'" % title
-                ipedia_write_cur.execute("""UPDATE articles SET body='%s' WHERE title='%s'""" % (dbEscape(converted), dbEscape(title)))
-            if g_fVerbose:
-                print log_txt
-        convWriter.write(convertedArticle)
-        if articleSize != 0:
-            if not sizeStats.has_key(articleSize):
-                sizeStats[articleSize] = 1
-            else:
-                sizeStats[articleSize] = sizeStats[articleSize]+1
-        count += 1
-        if count % 1000 == 0:
-            sys.stderr.write("phase 2 processed %d, last title=%s\n" % (count,article.getTitle()))
+                    print log_txt
+            convWriter.write(convertedArticle)
+            if articleSize != 0:
+                if not sizeStats.has_key(articleSize):
+                    sizeStats[articleSize] = 1
+                else:
+                    sizeStats[articleSize] = sizeStats[articleSize]+1
+            count += 1
+            if count % 1000 == 0:
+                sys.stderr.write("phase 2 processed %d, last title=%s\n" % (count,article.getTitle()))
+    finally:
+        stopConversionJobs(jobs)
     convWriter.close()
     # dump size stats to a file
     statsFileName = wikipediasql.getSizeStatsFileName(sqlDump)
@@ -450,6 +561,8 @@ CREATE TABLE `articles` (
   `id` int(10) unsigned NOT NULL auto_increment,
   `title` varchar(255) NOT NULL,
   `body` mediumtext NOT NULL,
+  `hash` char(32) NOT NULL default '',
+  `sections` text NOT NULL,
   PRIMARY KEY  (`id`),
   UNIQUE KEY `title_index` (`title`)
 ) TYPE=MyISAM;
@@ -510,10 +623,11 @@ requestLogSql = """CREATE TABLE request_log (
     -- 'r' is random search
     -- 's' is standard search
     -- 'e' is extended search
+    -- 'l' is reverse links (not counted as a lookup)
     request_type    CHAR(1),
-    -- for 's' and 'e' this is the search term, for 'r' it's NULL
+    -- for 's' and 'e' this is the search term, for 'l' the title, for 'r' it's NULL
     search_data  VARCHAR(255) NULL,
-    -- for 'r' and 's' this the title of returned article
+    -- for 'r', 's' and 'l' this the title of returned article
     search_result VARCHAR(255) NULL,
     -- if not NULL, there was an error processing the request and this is the 
     -- error number
@@ -574,6 +688,7 @@ def createDataDb(conn):
     cur.execute(getCookieLogSql)
     cur.execute(verifyRegCodeLogSql)
     cur.execute(regCodesSql)
+    cur.execute(LookupCounters.lookupCountersSql)
     cur.execute("GRANT ALL ON %s.* TO '%s'@'%s' IDENTIFIED BY '%s';" % (MANAGEMENT_DB,DB_USER,DB_HOST,DB_PWD))
     insertRegCode(cur, iPediaServer.testValidRegCode, True)
     insertRegCode(cur, iPediaServer.testDisabledRegCode, False)
@@ -625,6 +740,56 @@ def revLinksOnly(sqlDump):
     finally:
         deinitDatabase()
 
+# add hash column to articles table of a database created before we had it.
+# MD5() in MySQL gives the same hash as iPediaServer.getArticleHash()
+def addHashesOnly(sqlDump):
+    try:
+        dbName = getDbNameFromFileName(sqlDump)
+
+        if dbName not in getDbList():
+            print "Database '%s' doesn't exist and we need it for -addhashes" % dbName
+            return
+        cur = getIpediaConnection(dbName).cursor()
+        cur.execute("ALTER TABLE articles ADD COLUMN hash CHAR(32) NOT NULL DEFAULT '';")
+        cur.execute("UPDATE articles SET hash=MD5(body);")
+        cur.close()
+    finally:
+        deinitDatabase()
+
+# add sections column to articles table of a database created before we
+# had it. Server only uses sections if there's hash column too, so we add
+# it if it's not there
+def addSectionsOnly(sqlDump):
+    try:
+        dbName = getDbNameFromFileName(sqlDump)
+
+        if dbName not in getDbList():
+            print "Database '%s' doesn't exist and we need it for -addsections" % dbName
+            return
+        conn = getIpediaConnection(dbName)
+        cur = conn.cursor()
+        cur.execute("SHOW COLUMNS FROM articles LIKE 'hash'")
+        if None == cur.fetchone():
+            cur.execute("ALTER TABLE articles ADD COLUMN hash CHAR(32) NOT NULL DEFAULT '';")
+            cur.execute("UPDATE articles SET hash=MD5(body);")
+        cur.execute("ALTER TABLE articles ADD COLUMN sections TEXT NOT NULL;")
+        # bodies of all articles don't fit in memory, so we go in batches
+        lastId = -1
+        count = 0
+        while True:
+            cur.execute("SELECT id, body FROM articles WHERE id>%d ORDER BY id LIMIT 1000" % lastId)
+            rows = cur.fetchall()
+            if 0 == len(rows):
+                break
+            for (articleId, body) in rows:
+                cur.execute("""UPDATE articles SET sections='%s' WHERE id=%d""" % (dbEscape(getSectionsTxt(body)), articleId))
+                lastId = articleId
+            count += len(rows)
+            sys.stderr.write("added sections of %d articles\n" % count)
+        cur.close()
+    finally:
+        deinitDatabase()
+
 if __name__=="__main__":
 
     fNoPsyco = arsutils.fDetectRemoveCmdFlag("-nopsyco")
@@ -638,6 +803,9 @@ if __name__=="__main__":
     fRecreateDataDb = arsutils.fDetectRemoveCmdFlag("-recreatedatadb")
     articleLimit = arsutils.getRemoveCmdArgInt("-limit")
     fRevLinksOnly = arsutils.fDetectRemoveCmdFlag("-revlinksonly")
+    fAddHashesOnly = arsutils.fDetectRemoveCmdFlag("-addhashes")
+    fAddSectionsOnly = arsutils.fDetectRemoveCmdFlag("-addsections")
+    jobsCount = arsutils.getRemoveCmdArgInt("-jobs")
 
     # we always need to try to create it
     recreateDataDb(fRecreateDataDb)
@@ -654,6 +822,14 @@ if __name__=="__main__":
         revLinksOnly(sqlDump)
         sys.exit(0) 
 
+    if fAddHashesOnly:
+        addHashesOnly(sqlDump)
+        sys.exit(0)
+
+    if fAddSectionsOnly:
+        addSectionsOnly(sqlDump)
+        sys.exit(0)
+
     foLog = None
     try:
         createIpediaDb(sqlDump,fRecreateDb)
@@ -664,7 +840,7 @@ if __name__=="__main__":
         foLog = open(logFileName, "wb", 64)
         sys.stdout = foLog
         # sys.stderr = foLog
-        convertArticles(sqlDump,articleLimit)
+        convertArticles(sqlDump,articleLimit,jobsCount)
         calcReverseLinks(sqlDump)
         timer.stop()
         timer.dumpInfo("converting database: ")
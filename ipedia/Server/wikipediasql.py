@@ -97,15 +97,33 @@ def utf8ToLatin1(text):
     encoded = unicodeToLatin1(decoded)
     return encoded
 
-class WikipediaArticleFromSql:
+# return int value of a number column from a row of cur table or None if
+# we didn't read it
+def getIntOrNone(val):
+    if None == val:
+        return None
+    return int(val)
+
+# An article from sql dump. We only keep the fields we need (and not the whole
+# row) and use __slots__, since we might keep a lot of those.
+class WikipediaArticleFromSql(object):
+    __slots__ = ["id", "ns", "title", "text", "redirect", "viewCount", "timestamp", "md5Hash"]
+
+    # row is a list with values of columns of cur table (None for those
+    # that we didn't read)
     def __init__(self, row, isUtf8 = False):
-        self.row = row
         assert not fInvalidRedirect(row)
+        self.id = getIntOrNone(row[CUR_ID])
+        self.ns = int(row[CUR_NAMESPACE])
+        self.viewCount = getIntOrNone(row[CUR_COUNTER])
+        self.timestamp = row[CUR_TIMESTAMP]
         self.md5Hash = None
-        txt = row[CUR_TEXT]
+        self.title = row[CUR_TITLE]
+        self.text = row[CUR_TEXT]
+        txt = self.text
         if isUtf8:
-            title = utf8ToLatin1(self.row[CUR_TITLE])
-            self.row[CUR_TITLE] = entities.convertNumberedEntities(title, title)
+            title = utf8ToLatin1(self.title)
+            self.title = entities.convertNumberedEntities(title)
             txt = utf8ToLatin1(txt)
             
         #redirectNum = int(row[CUR_IS_REDIRECT])
@@ -118,23 +136,23 @@ class WikipediaArticleFromSql:
         # we treat it as redirect anyway
         redirect = getRedirectFromText(txt)
         if redirect:
-            self.redirect = entities.convertNumberedEntities(self.row[CUR_TITLE], redirect.replace(" ", "_"))
+            self.redirect = entities.convertNumberedEntities(redirect.replace(" ", "_"))
             if int(row[CUR_IS_REDIRECT])==0:
                 # redirect not marked as such
                 print "%s is a redirect but not marked as such" % self.getTitle()
         else:
-            self.row[CUR_TEXT] = txt.strip()
-    def getId(self):  return int(self.row[CUR_ID])
-    def getNamespace(self): return int(self.row[CUR_NAMESPACE])
-    def getTitle(self): return self.row[CUR_TITLE]
-    def getText(self): return self.row[CUR_TEXT]
+            self.text = txt.strip()
+    def getId(self):  return self.id
+    def getNamespace(self): return self.ns
+    def getTitle(self): return self.title
+    def getText(self): return self.text
     def fRedirect(self):
         if self.redirect:
             return True
         return False
     def getRedirect(self): return self.redirect
-    def getViewCount(self): return int(self.row[CUR_COUNTER])
-    def getTimestamp(self): return self.row[CUR_TIMESTAMP]
+    def getViewCount(self): return self.viewCount
+    def getTimestamp(self): return self.timestamp
     def getHash(self):
         if self.md5Hash == None:
             md5Obj = md5.new(self.getText())
@@ -516,6 +534,155 @@ class SQLTokenizer:
         assert token != TOKEN_NONE
         return token
 
+# escapes in strings (other than \\) and characters they stand for. It's
+# a reverse of mysql_sub_escape_string in libmysqld\libmysql.c. Escaped 0
+# happens for 'Irish_building', not really sure if it should be 0x0
+g_sqlEscapes = [('\\n', '\n'), ('\\r', '\r'), ('\\\'', '\''), ('\\"', '"'), ('\\Z', chr(26)), ('\\0', '0')]
+
+# return a string from sql dump with escapes replaced by characters they
+# stand for or None if there's an escape we don't know. We split the string
+# on \\ first, then each part has only one-character escapes that can be
+# replaced with str.replace()
+def unescapeSqlStr(txt):
+    parts = txt.split("\\\\")
+    for i in range(len(parts)):
+        part = parts[i]
+        if -1 == part.find("\\"):
+            continue
+        for (escape, c) in g_sqlEscapes:
+            part = part.replace(escape, c)
+        if -1 != part.find("\\"):
+            return None
+        parts[i] = part
+    return string.join(parts, "\\")
+
+# matches quotes that might end a string: those not after a backslash (which
+# are escaped, with the exception of a quote after \\, i.e. an escaped
+# backslash, which we also match and check)
+sqlStrEndRe = re.compile(r"'(?:(?<!\\')|(?<=\\\\'))")
+# matches a number, after its first character
+sqlNumRestRe = re.compile(r"[0-9.e\-]*")
+
+FAST_BUF_SIZE = 256*1024
+
+# Returns the same tokens as SQLTokenizer but instead of reading one character
+# at a time, it finds the end of a string with a regular expression and replaces escapes
+# with str.replace(), so text of articles is never processed in python one
+# character at a time. Values can span buffers, bufSize is only a parameter
+# for tests.
+class FastSQLTokenizer(SQLTokenizer):
+    def __init__(self,fileName,bufSize=FAST_BUF_SIZE):
+        SQLTokenizer.__init__(self,fileName)
+        self.bufSize = bufSize
+        self.buf = ""
+
+    # read more data into the buffer, keeping the part we haven't processed
+    # yet. Return False if there's no more data
+    def fReadMore(self):
+        data = self.fo.read(self.bufSize)
+        if 0 == len(data):
+            return False
+        self.buf = self.buf[self.curPos:] + data
+        self.curPos = 0
+        self.bufLen = len(self.buf)
+        return True
+
+    def fSkipUntilTxt(self,txt):
+        while True:
+            pos = self.buf.find(txt, self.curPos)
+            if -1 != pos:
+                self.curPos = pos + len(txt)
+                return True
+            # txt might start at the end of the buffer
+            self.curPos = max(self.curPos, self.bufLen - len(txt) + 1)
+            if not self.fReadMore():
+                return False
+
+    # return the text of a string, we're after its opening quote. If fKeepVal
+    # is False, we only skip the string and return None
+    def getStr(self, fKeepVal=True):
+        start = self.curPos
+        searchPos = start
+        while True:
+            match = sqlStrEndRe.search(self.buf, searchPos)
+            if None == match:
+                # the string continues in the next buffer. We keep all of it
+                # in the buffer
+                searchPos = self.bufLen - start
+                self.curPos = start
+                assert self.fReadMore()
+                start = 0
+                continue
+            pos = match.start()
+            # a quote after odd number of backslashes is escaped
+            backslashes = 0
+            while pos - backslashes > start and '\\' == self.buf[pos - backslashes - 1]:
+                backslashes += 1
+            if 0 == backslashes % 2:
+                break
+            searchPos = pos + 1
+        self.curPos = pos + 1
+        if not fKeepVal:
+            return None
+        txt = self.buf[start:pos]
+        if -1 == txt.find("\\"):
+            return txt
+        unescaped = unescapeSqlStr(txt)
+        if None == unescaped:
+            # catch all the cases we didn't predict of escaped characters
+            print "got unknown escape in %s" % txt
+            self.dumpBeforeAfterBuf()
+            assert 0
+        return unescaped
+
+    # return the text of a number, we're at its first character
+    def getNum(self):
+        while True:
+            match = sqlNumRestRe.match(self.buf, self.curPos + 1)
+            if match.end() < self.bufLen:
+                break
+            # the number might continue in the next buffer
+            assert self.fReadMore()
+        num = self.buf[self.curPos:match.end()]
+        self.curPos = match.end()
+        if ',' != self.buf[self.curPos]:
+            print "got %s, num=%s" % (self.buf[self.curPos],num)
+            self.dumpBeforeAfterBuf()
+        assert ',' == self.buf[self.curPos]
+        return num
+
+    # if fKeepVal is False, a string is skipped without copying it and its
+    # value is None
+    def getToken(self, fKeepVal=True):
+        if self.curPos == self.bufLen:
+            if not self.fReadMore():
+                self.dumpBeforeAfterBuf()
+                assert 0
+        c = self.buf[self.curPos]
+        token = TOKEN_NONE
+        if c=='(':
+            token = TOKEN_LEFT_BRACE
+        elif c==')':
+            token = TOKEN_RIGHT_BRACE
+        elif c==',':
+            token = TOKEN_COMMA
+        elif c==';':
+            token = TOKEN_SEP
+        elif c=='\'':
+            self.curPos += 1
+            self.curVal = self.getStr(fKeepVal)
+            return TOKEN_STR
+        elif (c>='0' and c<='9') or c=='.' or c=='-':
+            self.curVal = self.getNum()
+            if -1 != self.curVal.find('.'):
+                return TOKEN_FLOAT
+            return TOKEN_NUM
+        self.curPos += 1
+        if token == TOKEN_NONE:
+            self.dumpBeforeAfterBuf()
+        assert token != TOKEN_NONE
+        return token
+
 ST_NONE = 0
 ST_AFTER_LEFT_BRACE = 1
 ST_AFTER_VALUE = 2
@@ -571,12 +738,21 @@ def iterConvertedArticles(sqlFileName):
     return    
 
 
+# columns of cur table we read from sql dump by default, i.e. those used by
+# WikipediaArticleFromSql methods we call. Values of other columns are skipped
+ARTICLE_COLUMNS = [CUR_NAMESPACE, CUR_TITLE, CUR_TEXT, CUR_COUNTER, CUR_IS_REDIRECT]
+# columns we always need to tell which rows are articles
+REQUIRED_COLUMNS = [CUR_NAMESPACE, CUR_TITLE, CUR_TEXT, CUR_IS_REDIRECT]
+
 # an iterator that given a *.sql or *.sql.bz2 or *.sql.gz wikipedia dump file
 # returns WikpediaArticle instances representing one wikipedia article
 # If fUseCache is True, then uses (if exists) or creates *.txt cache files
+# columns is a list of columns (CUR_*) we need when reading from sql dump,
+# ARTICLE_COLUMNS if not given. Values of other columns are skipped without
+# copying them and are None
 #TODO: split this into smaller functions. However, don't know how to do it
 #  and be able to use yield as well
-def iterWikipediaArticles(sqlFileName, limit=None, fUseCache=False, fRecreateCache=False):
+def iterWikipediaArticles(sqlFileName, limit=None, fUseCache=False, fRecreateCache=False, columns=None):
     #if limit:
     #    assert fUseCache==False
     print "fUseCache %d, fRecreateCache=%d" % (fUseCache, fRecreateCache)
@@ -654,11 +830,26 @@ def iterWikipediaArticles(sqlFileName, limit=None, fUseCache=False, fRecreateCac
         fo.close()
         return    
 
-    st = SQLTokenizer(sqlFileName)
+    # fColumns[n] is True if we need a value of column n
+    if None == columns:
+        columns = ARTICLE_COLUMNS
+    fColumns = [False] * EXPECTED_ARGS_COUNT
+    for column in columns + REQUIRED_COLUMNS:
+        fColumns[column] = True
+    if cacheWriter:
+        fColumns[CUR_COUNTER] = True
+
+    st = FastSQLTokenizer(sqlFileName)
     fSkipped = st.fSkipUntilTxt(BEG_TXT)
     assert fSkipped
     curState = ST_NONE
-    args = []
+    # values of the row, None for those we skip
+    args = None
+    # number of values of the row so far
+    argsCount = 0
+    # False once we know that the row is not in NS_MAIN, so that we skip
+    # the rest of it (including the text)
+    fMainNs = True
     count = 0
     while True:
         if curState == ST_NONE:
@@ -668,49 +859,54 @@ def iterWikipediaArticles(sqlFileName, limit=None, fUseCache=False, fRecreateCac
         elif curState == ST_AFTER_LEFT_BRACE:
             token = st.getToken()
             assert token == TOKEN_NUM
-            args.append(st.getTokenVal())
+            args = [None] * EXPECTED_ARGS_COUNT
+            args[CUR_ID] = st.getTokenVal()
+            argsCount = 1
+            fMainNs = True
             curState = ST_AFTER_VALUE
         elif curState == ST_AFTER_VALUE:
             token = st.getToken()
             if token == TOKEN_COMMA:
                 curState = ST_AFTER_COMMA
             elif token == TOKEN_RIGHT_BRACE:
-                if len(args) != EXPECTED_ARGS_COUNT:
-                    print "expect len(args)=%d and is %d" % (EXPECTED_ARGS_COUNT,len(args))
+                if argsCount != EXPECTED_ARGS_COUNT:
+                    print "expect len(args)=%d and is %d" % (EXPECTED_ARGS_COUNT,argsCount)
                     print args
-                assert len(args) == EXPECTED_ARGS_COUNT
+                assert argsCount == EXPECTED_ARGS_COUNT
                 curState = ST_AFTER_ARGS
                 # filter out all namespaces except NS_MAIN
-                if NS_MAIN != int(args[CUR_NAMESPACE]):
-                    args = []
+                if not fMainNs:
                     continue
                 if fInvalidRedirect(args):
                     print "rejected '%s' as invalid redirect" % args[CUR_TITLE].strip()
                     print args[CUR_TEXT].strip()
-                    args = []
                     continue
                 args[CUR_TITLE] = args[CUR_TITLE].strip()
                 if 0==len(args[CUR_TITLE]):
                     # reject titles consisting only of spaces and newlines
                     print "rejected '%s' as invalid (len==0) title" % args[CUR_TEXT]
-                    args = []
                     continue
                 article = WikipediaArticleFromSql(args, isUtf8)
+                args = None
                 if cacheWriter:
                     cacheWriter.write(article)
                 yield article
                 count += 1
                 if limit and count >= limit:
                     break
-                args = []
             else:
                 print "got token %s(%d), expected fTokenValue() or TOKEN_RIGHT_BRACE or TOKEN_COMMA" % (getTokenName(token),token)
                 st.dumpBeforeAfterBuf()
                 assert 0
         elif curState == ST_AFTER_COMMA:
-            token = st.getToken()
+            fKeepVal = fMainNs and argsCount < EXPECTED_ARGS_COUNT and fColumns[argsCount]
+            token = st.getToken(fKeepVal)
             if fTokenVal(token):
-                args.append(st.getTokenVal())
+                if fKeepVal:
+                    args[argsCount] = st.getTokenVal()
+                    if CUR_NAMESPACE == argsCount:
+                        fMainNs = (NS_MAIN == int(args[CUR_NAMESPACE]))
+                argsCount += 1
             else:
                 print "got token %s(%d), expected fTokenVal()" % (getTokenName(token),token)
                 st.dumpBeforeAfterBuf()